@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# da incrementare quando cambia il formato dei file
+CACHE_VERSION = 1
+
+
+class GraphCache:
+    """
+    On-disk cache of the GraphMap graphs: the networkx graph and the nearest-node index are pickled and the node
+    coordinates are saved as numpy arrays, keyed by territory, mode, bbox, network type and hash of the source file.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path.rstrip("/")
+        self.lock = threading.Lock()
+
+
+    def get_file_hash(self, file_path: str) -> str:
+        """SHA-256 of the source file, recomputed only when its size or mtime change."""
+        stat = os.stat(file_path)
+        hashes_path = f"{self.cache_path}/file_hashes.json"
+        with self.lock:
+            hashes = {}
+            if os.path.exists(hashes_path):
+                with open(hashes_path, "r", encoding="utf-8") as file:
+                    hashes = json.load(file)
+            entry = hashes.get(os.path.abspath(file_path))
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                return entry["hash"]
+            sha256 = hashlib.sha256()
+            with open(file_path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    sha256.update(block)
+            hashes[os.path.abspath(file_path)] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": sha256.hexdigest()}
+            os.makedirs(self.cache_path, exist_ok=True)
+            with open(hashes_path, "w", encoding="utf-8") as file:
+                json.dump(hashes, file, indent=2)
+            return sha256.hexdigest()
+
+
+    def get_key(self, territory_id: str, mode_type: str, source: str, bbox: list, network_type: str, file_hash: str = None) -> str:
+        body = json.dumps([CACHE_VERSION, territory_id.upper(), mode_type, source, bbox, network_type, file_hash],
+                          separators=(",", ":"))
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+    def get_filename(self, territory_id: str, mode_type: str, key: str) -> str:
+        """Base name of the files of the graph, without the extension."""
+        return f"{self.cache_path}/{territory_id.upper()}/{mode_type}_{key[:16]}"
+
+
+    def load(self, territory_id: str, mode_type: str, key: str, max_age: float = None) -> tuple:
+        """
+        Returns the graph, the node arrays (ids, x, y) and the node index (None if not saved), None on a miss.
+        With max_age (seconds) the entries saved earlier are misses, so that they are rebuilt from the source.
+        """
+        base_path = self.get_filename(territory_id, mode_type, key)
+        try:
+            if max_age is not None and time.time() - os.path.getmtime(f"{base_path}.graph.pkl") > max_age:
+                logger.info(f"Expired graph cache entry {base_path}")
+                return None
+            with open(f"{base_path}.graph.pkl", "rb") as file:
+                G = pickle.load(file)
+            node_index = None
+            if os.path.exists(f"{base_path}.index.pkl"):
+                with open(f"{base_path}.index.pkl", "rb") as file:
+                    node_index = pickle.load(file)
+            with np.load(f"{base_path}.nodes.npz", allow_pickle=True) as nodes:
+                return G, (nodes["ids"], nodes["x"], nodes["y"]), node_index
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Invalid graph cache entry {base_path}: {e}")
+            return None
+
+
+    def save(self, territory_id: str, mode_type: str, key: str, G, nodes: tuple, node_index=None):
+        base_path = self.get_filename(territory_id, mode_type, key)
+        os.makedirs(os.path.dirname(base_path), exist_ok=True)
+        # scrittura atomica: i file vengono rinominati solo quando completi, il grafo per ultimo
+        tmp_path = f"{base_path}.{threading.get_ident()}.tmp"
+        ids, x, y = nodes
+        with open(tmp_path, "wb") as file:
+            np.savez(file, ids=ids, x=x, y=y)
+        os.replace(tmp_path, f"{base_path}.nodes.npz")
+        if node_index is not None:
+            self.save_index(territory_id, mode_type, key, node_index)
+        with open(tmp_path, "wb") as file:
+            pickle.dump(G, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, f"{base_path}.graph.pkl")
+
+
+    def save_index(self, territory_id: str, mode_type: str, key: str, node_index):
+        base_path = self.get_filename(territory_id, mode_type, key)
+        tmp_path = f"{base_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(node_index, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, f"{base_path}.index.pkl")
@@ -1,5 +1,7 @@
 import pyrosm 
 import osmnx as ox
+import numpy as np
+from sklearn.neighbors import KDTree
 
 import json
 import os
@@ -7,8 +9,64 @@ import logging
 
 from datetime import datetime
 
+from graph.graph_cache import GraphCache
+from valhalla.trace_preprocess import get_cos_lat0, project_lonlat
+
 logger = logging.getLogger(__name__)
 
+
+class NodeIndex:
+    """KD-tree of the graph nodes, on a local equirectangular projection in meters."""
+
+    def __init__(self, node_x, node_y):
+        self.cos_lat0 = get_cos_lat0(node_y)
+        self.tree = KDTree(np.column_stack(self.project(node_x, node_y))) if len(node_x) > 0 else None
+
+
+    def project(self, lons, lats) -> tuple:
+        return project_lonlat(lons, lats, self.cos_lat0)
+
+
+    def query(self, lons, lats) -> np.ndarray:
+        """Positions (in the node arrays) of the nodes nearest to the points."""
+        if self.tree is None:
+            raise ValueError("Empty graph")
+        x, y = self.project(lons, lats)
+        return self.tree.query(np.column_stack((x, y)), k=1, return_distance=False)[:, 0]
+
+
+class NearestNodeBatch:
+    """
+    Collects the points of many tracks and snaps them to the nearest nodes of the graph in a single
+    vectorized query: the node_id of the registered rows is set when the batch is flushed.
+    """
+
+    def __init__(self, graph_map):
+        self.graph_map = graph_map
+        self.batch_points = int(os.getenv("GRAPH_NEAREST_BATCH_POINTS", "50000"))
+        self.rows = []
+        self.lons = []
+        self.lats = []
+
+
+    def add(self, rows:list, lons:list, lats:list):
+        self.rows.extend(rows)
+        self.lons.extend(lons)
+        self.lats.extend(lats)
+        if len(self.rows) >= self.batch_points:
+            self.flush()
+
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        node_ids = self.graph_map.find_nearest_nodes(self.lons, self.lats, f"batch of {len(self.rows)} points")
+        for row, node_id in zip(self.rows, node_ids.tolist()):
+            row['node_id'] = str(node_id)
+        self.rows = []
+        self.lons = []
+        self.lats = []
+
 class GraphMap:
     def __init__(self):
         self.net_walking = 'walking'
@@ -16,6 +74,61 @@ class GraphMap:
         self.net_driving = 'driving'     
         self.net_service = 'driving+service' 
         self.net_all = 'all'
+        # sorgente della rete: "bbox" (osmnx, scaricata da OSM) o "pbf" (pyrosm, file di data/territory_map.json)
+        self.graph_source = os.getenv("GRAPH_SOURCE", "bbox")
+        # cache su disco dei grafi (disabilitata se GRAPH_CACHE_PATH è vuoto)
+        cache_path = os.getenv("GRAPH_CACHE_PATH", "./files/graphs")
+        self.graph_cache = GraphCache(cache_path) if cache_path else None
+        # età massima (giorni) dei grafi bbox in cache, che non hanno un file sorgente da confrontare, 0 per non farli scadere
+        max_age_days = float(os.getenv("GRAPH_CACHE_MAX_AGE_DAYS", "7"))
+        self.graph_cache_max_age = max_age_days * 24 * 3600 if max_age_days > 0 else None
+        self.G = None
+        self.node_ids = None
+        self.node_x = None
+        self.node_y = None
+        self.node_index = None
+
+
+    def set_graph(self, G, nodes:tuple=None, node_index:NodeIndex=None):
+        """Sets the graph, the arrays of its node ids and coordinates and the nearest-node index."""
+        self.G = G
+        if nodes is None:
+            ids = list(G.nodes)
+            nodes = (np.array(ids), np.array([G.nodes[node]["x"] for node in ids], dtype=float), 
+                     np.array([G.nodes[node]["y"] for node in ids], dtype=float))
+        self.node_ids, self.node_x, self.node_y = nodes
+        # indice costruito una sola volta per grafo, invece che a ogni ricerca
+        self.node_index = node_index if node_index is not None else NodeIndex(self.node_x, self.node_y)
+
+
+    def load_cached_graph(self, territory_id: str, mode_type: str, key: str, max_age: float = None) -> bool:
+        if self.graph_cache is None:
+            return False
+        start = datetime.now()
+        cached = self.graph_cache.load(territory_id, mode_type, key, max_age)
+        if cached is None:
+            return False
+        G, nodes, node_index = cached
+        self.set_graph(G, nodes, node_index)
+        if node_index is None:
+            # voce salvata senza indice: viene aggiunto
+            self.graph_cache.save_index(territory_id, mode_type, key, self.node_index)
+        stop = datetime.now()
+        logger.info(f"Graph loaded from cache - Territory ID: {territory_id}, Mode: {mode_type}, Time:{(stop - start).total_seconds()} seconds")
+        return True
+
+
+    def save_cached_graph(self, territory_id: str, mode_type: str, key: str):
+        if self.graph_cache is not None:
+            self.graph_cache.save(territory_id, mode_type, key, self.G, (self.node_ids, self.node_x, self.node_y), self.node_index)
+
+
+    def load_territory_graph(self, territory_id: str, mode_type: str):
+        """Loads the graph of the mode from the source selected by GRAPH_SOURCE."""
+        if self.graph_source == "pbf":
+            self.load_graph(territory_id, mode_type)
+        else:
+            self.load_graph_from_bbox(territory_id, mode_type)
     
 
     def get_osm_file(self, territory_id: str):
@@ -77,11 +190,19 @@ class GraphMap:
         osm_file = self.get_osm_file(territory_id)
         if not osm_file:
             raise ValueError(f"No OSM file found for territory ID: {territory_id}")
+        key = None
+        if self.graph_cache is not None:
+            key = self.graph_cache.get_key(territory_id, mode_type, "pbf", self.get_bbox(territory_id), network_type, 
+                                           self.graph_cache.get_file_hash(osm_file))
+            if self.load_cached_graph(territory_id, mode_type, key):
+                return
         logger.info(f"Start loading Graph - Territory ID: {territory_id}, Mode: {mode_type}")
         start = datetime.now()
         osm = pyrosm.OSM(osm_file)
         nodes, edges = osm.get_network(nodes=True, network_type=network_type)
-        self.G = osm.to_graph(nodes, edges, graph_type="networkx")
+        self.set_graph(osm.to_graph(nodes, edges, graph_type="networkx"))
+        if key is not None:
+            self.save_cached_graph(territory_id, mode_type, key)
         stop = datetime.now()
         logger.info(f"Graph loaded - Territory ID: {territory_id}, Mode: {mode_type}, Time:{(stop - start).total_seconds()} seconds")
 
@@ -89,11 +210,18 @@ class GraphMap:
     def load_graph_from_bbox(self, territory_id: str, mode_type: str):
         network_type = self.get_osmnx_network_type(mode_type)
         #ox.settings.bidirectional_network_types += network_type
+        bbox = self.get_bbox(territory_id)
+        key = None
+        if self.graph_cache is not None:
+            key = self.graph_cache.get_key(territory_id, mode_type, "bbox", bbox, network_type)
+            if self.load_cached_graph(territory_id, mode_type, key, self.graph_cache_max_age):
+                return
         logger.info(f"Start loading Graph BBOX - Territory ID: {territory_id}, Mode: {mode_type}")
         start = datetime.now()
-        bbox = self.get_bbox(territory_id)
         ox.settings.use_cache = False
-        self.G = ox.graph.graph_from_bbox(bbox, network_type=network_type)
+        self.set_graph(ox.graph.graph_from_bbox(bbox, network_type=network_type))
+        if key is not None:
+            self.save_cached_graph(territory_id, mode_type, key)
         stop = datetime.now()
         logger.info(f"Graph loaded from BBOX - Territory ID: {territory_id}, Mode: {mode_type}, Time:{(stop - start).total_seconds()} seconds")
 
@@ -103,14 +231,14 @@ class GraphMap:
         Find the nearest edges in the graph for the given points.
         """
         start = datetime.now()
-        nearest_nodes = ox.distance.nearest_nodes(self.G, lon_array, lat_array, return_dist=False)
+        nearest_nodes = self.node_ids[self.node_index.query(lon_array, lat_array)]
         stop = datetime.now()
         logger.info(f"Track ID: {track_id}, Nodes: {len(nearest_nodes)}, Time:{(stop - start).total_seconds()} seconds")
         return nearest_nodes
     
 
     def find_nearest_node(self, lon, lat):
-        return ox.distance.nearest_nodes(self.G, lon, lat, return_dist=False)
+        return self.node_ids[self.node_index.query([lon], [lat])[0]]
 
 
     def is_point_in_bbox(self, lon: float, lat: float, bbox: list[float]) -> bool:
@@ -0,0 +1,325 @@
+import os
+import math
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import networkx as nx
+from sklearn.neighbors import KDTree
+
+from valhalla.valhalla_engine import TraceRoute, convert_tracked_instance_to_points, encode_polyline, get_trace_columns
+from valhalla.trace_preprocess import TracePreprocessor, get_cos_lat0, project_lonlat, unproject_xy
+
+logger = logging.getLogger(__name__)
+
+
+def get_travel_mode(track_mode: str) -> str:
+    """travel_mode reported by Valhalla for the costing of the mode (see get_transit_mode)."""
+    match track_mode:
+        case "walk":
+            return "pedestrian"
+        case "bike":
+            return "bicycle"
+        case _:
+            return "drive"
+
+
+def get_way_id(osmid) -> int:
+    # gli archi semplificati da osmnx possono avere una lista di way
+    if isinstance(osmid, (list, tuple)):
+        osmid = osmid[0]
+    return int(osmid)
+
+
+class HmmMatcher:
+    """
+    Hidden-Markov-model map matcher over the GraphMap.G network (Newson & Krumm): the candidates of each point
+    are the nearest edges within the search radius, found with a KD-tree over the densified edge segments in a
+    local metric projection; the transitions compare the network distance between the candidates (bounded
+    Dijkstra) with the distance between the points, and the best sequence is found with Viterbi.
+    The result has the same form of ValhallaEngine.match_window.
+    """
+
+    def __init__(self, G, track_mode: str):
+        self.G = G
+        self.travel_mode = get_travel_mode(track_mode)
+        # raggio di ricerca dei candidati (metri), deviazione standard del GPS e scala delle transizioni
+        self.search_radius = float(os.getenv("HMM_SEARCH_RADIUS", "30"))
+        self.sigma = float(os.getenv("HMM_GPS_SIGMA", "5"))
+        self.beta = float(os.getenv("HMM_BETA", "5"))
+        self.max_candidates = int(os.getenv("HMM_MAX_CANDIDATES", "8"))
+        # lunghezza massima dei segmenti indicizzati (metri)
+        self.segment_length = float(os.getenv("HMM_SEGMENT_LENGTH", "20"))
+        # limite della distanza di rete tra due punti: fattore della distanza in linea d'aria più un margine (metri)
+        self.route_factor = float(os.getenv("HMM_ROUTE_FACTOR", "3"))
+        self.route_margin = float(os.getenv("HMM_ROUTE_MARGIN", "100"))
+        self.trace_preprocessor = TracePreprocessor()
+        self.build()
+
+
+    def project(self, lons, lats) -> tuple:
+        return project_lonlat(lons, lats, self.cos_lat0)
+
+
+    def unproject(self, x, y) -> tuple:
+        return unproject_xy(x, y, self.cos_lat0)
+
+
+    def build(self):
+        """Builds the edge arrays and the KD-tree of the densified segments."""
+        start = datetime.now()
+        self.cos_lat0 = get_cos_lat0([data["y"] for _, data in self.G.nodes(data=True)])
+        edge_u = []
+        edge_v = []
+        edge_way_ids = []
+        edge_lengths = []
+        segments = []
+        # geometria del primo arco di ogni way, per le shape senza /locate
+        self.way_geometries = {}
+        for u, v, data in self.G.edges(data=True):
+            if "geometry" in data:
+                lons, lats = zip(*data["geometry"].coords)
+            else:
+                lons = (self.G.nodes[u]["x"], self.G.nodes[v]["x"])
+                lats = (self.G.nodes[u]["y"], self.G.nodes[v]["y"])
+            x, y = self.project(lons, lats)
+            lengths = np.hypot(np.diff(x), np.diff(y))
+            offsets = np.concatenate(([0.0], np.cumsum(lengths)))
+            edge = len(edge_u)
+            for i in range(len(lengths)):
+                # segmenti densificati, al più segment_length metri
+                pieces = max(1, int(math.ceil(lengths[i] / self.segment_length)))
+                t = np.linspace(0.0, 1.0, pieces + 1)
+                px = x[i] + (x[i + 1] - x[i]) * t
+                py = y[i] + (y[i + 1] - y[i]) * t
+                segments.append(np.column_stack((px[:-1], py[:-1], px[1:], py[1:], np.full(pieces, edge), offsets[i] + lengths[i] * t[:-1])))
+            edge_u.append(u)
+            edge_v.append(v)
+            way_id = get_way_id(data.get("osmid", -1))
+            edge_way_ids.append(way_id)
+            if way_id not in self.way_geometries:
+                self.way_geometries[way_id] = (tuple(lons), tuple(lats))
+            edge_lengths.append(offsets[-1])
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.edge_way_ids = np.array(edge_way_ids, dtype=np.int64)
+        self.edge_lengths = np.array(edge_lengths, dtype=float)
+        segments = np.concatenate(segments) if segments else np.zeros((0, 6))
+        self.seg_a = segments[:, 0:2]
+        self.seg_b = segments[:, 2:4]
+        self.seg_edge = segments[:, 4].astype(np.int64)
+        self.seg_offset = segments[:, 5]
+        self.tree = KDTree((self.seg_a + self.seg_b) / 2) if len(segments) > 0 else None
+        stop = datetime.now()
+        logger.info(f"HMM matcher built - Edges: {len(edge_u)}, Segments: {len(segments)}, Time:{(stop - start).total_seconds()} seconds")
+
+
+    def get_way_shape(self, way_id) -> str:
+        """Shape of the way from the geometry of its edge in the graph, as the edge shape of /locate; None if not in the graph."""
+        geometry = self.way_geometries.get(way_id)
+        if geometry is None:
+            return None
+        return encode_polyline([{"longitude": float(lon), "latitude": float(lat)} for lon, lat in zip(*geometry)])
+
+
+    def get_candidates(self, px, py) -> list:
+        """For each point the nearest edges within the search radius: (edge, position along the edge, distance, x, y) arrays."""
+        candidates = []
+        if self.tree is None:
+            return [None] * len(px)
+        # i punti medi dei segmenti distano al più mezzo segmento dal punto più vicino
+        neighbors = self.tree.query_radius(np.column_stack((px, py)), r=self.search_radius + self.segment_length / 2)
+        for i, segs in enumerate(neighbors):
+            if len(segs) == 0:
+                candidates.append(None)
+                continue
+            a = self.seg_a[segs]
+            ab = self.seg_b[segs] - a
+            ap = np.array([px[i], py[i]]) - a
+            ab2 = np.einsum("ij,ij->i", ab, ab)
+            t = np.clip(np.einsum("ij,ij->i", ap, ab) / np.where(ab2 > 0, ab2, 1.0), 0.0, 1.0)
+            c = a + ab * t[:, None]
+            distances = np.hypot(c[:, 0] - px[i], c[:, 1] - py[i])
+            order = np.argsort(distances)
+            order = order[distances[order] <= self.search_radius]
+            # il segmento più vicino di ogni arco
+            edges, first = np.unique(self.seg_edge[segs][order], return_index=True)
+            best = order[np.sort(first)][:self.max_candidates]
+            if len(best) == 0:
+                candidates.append(None)
+                continue
+            positions = self.seg_offset[segs][best] + t[best] * np.sqrt(ab2[best])
+            candidates.append((self.seg_edge[segs][best], positions, distances[best], c[best, 0], c[best, 1]))
+        return candidates
+
+
+    def get_routes(self, prev, cand, max_distance: float) -> tuple:
+        """Network distances (and node paths) between the previous and the current candidates, inf if farther than max_distance."""
+        prev_edges, prev_positions = prev[0], prev[1]
+        edges, positions = cand[0], cand[1]
+        distances = np.full((len(prev_edges), len(edges)), np.inf)
+        paths = {}
+        for i, (e1, p1) in enumerate(zip(prev_edges.tolist(), prev_positions.tolist())):
+            remaining = self.edge_lengths[e1] - p1
+            lengths = None
+            for j, (e2, p2) in enumerate(zip(edges.tolist(), positions.tolist())):
+                if e1 == e2 and p2 >= p1:
+                    distances[i, j] = p2 - p1
+                    paths[(i, j)] = []
+                    continue
+                if remaining > max_distance:
+                    continue
+                if lengths is None:
+                    lengths, node_paths = nx.single_source_dijkstra(self.G, self.edge_v[e1], cutoff=max_distance - remaining,
+                                                                    weight="length")
+                u2 = self.edge_u[e2]
+                if u2 in lengths:
+                    distance = remaining + lengths[u2] + p2
+                    if distance <= max_distance:
+                        distances[i, j] = distance
+                        paths[(i, j)] = node_paths[u2]
+        return distances, paths
+
+
+    def match(self, points) -> tuple:
+        """
+        Matches the points (sorted by time). Returns the shape, the indexes of the matched points and their
+        columns (see TRACE_COLUMNS), as ValhallaEngine.match_window.
+        """
+        if len(points) == 0:
+            return None, np.zeros(0, dtype=np.int64), get_trace_columns()
+        px, py = self.project([point["longitude"] for point in points], [point["latitude"] for point in points])
+        candidates = self.get_candidates(px, py)
+
+        # catene di Viterbi: una nuova catena inizia dove non esiste una transizione possibile
+        chains = []
+        layers = []
+        prev_index = None
+        for index, cand in enumerate(candidates):
+            if cand is None:
+                continue
+            scores = -0.5 * (cand[2] / self.sigma) ** 2
+            back = None
+            paths = None
+            if prev_index is not None:
+                gc = math.hypot(px[index] - px[prev_index], py[index] - py[prev_index])
+                distances, paths = self.get_routes(candidates[prev_index], cand, gc * self.route_factor + self.route_margin)
+                transitions = layers[-1][3][:, None] - np.abs(distances - gc) / self.beta
+                back = np.argmax(transitions, axis=0)
+                transition_scores = transitions[back, np.arange(len(back))]
+                if np.all(np.isinf(transition_scores)):
+                    chains.append(layers)
+                    layers = []
+                    back = None
+                    paths = None
+                else:
+                    scores = transition_scores + scores
+            layers.append((index, back, paths, scores))
+            prev_index = index
+        if len(layers) > 0:
+            chains.append(layers)
+
+        indexes = []
+        selected = []
+        coordinates = []
+        for layers in chains:
+            for index, j, path in self.backtrack(layers):
+                cand = candidates[index]
+                indexes.append(index)
+                selected.append((int(cand[0][j]), float(cand[1][j]), float(cand[2][j]), float(cand[3][j]), float(cand[4][j])))
+                # shape: nodi del percorso dal punto precedente e punto associato
+                for node in path:
+                    coordinates.append((self.G.nodes[node]["x"], self.G.nodes[node]["y"]))
+                coordinates.append(self.unproject(cand[3][j], cand[4][j]))
+        return self.get_result(points, indexes, selected, coordinates)
+
+
+    def backtrack(self, layers) -> list:
+        """(point index, candidate, node path from the previous point) of the best sequence of a chain."""
+        j = int(np.argmax(layers[-1][3]))
+        chain = []
+        for index, back, paths, scores in reversed(layers):
+            if back is None:
+                chain.append((index, j, []))
+            else:
+                i = int(back[j])
+                chain.append((index, j, paths[(i, j)]))
+                j = i
+        chain.reverse()
+        return chain
+
+
+    def get_result(self, points, indexes, selected, coordinates) -> tuple:
+        shape = None
+        if len(coordinates) > 0:
+            shape = encode_polyline([{"longitude": float(lon), "latitude": float(lat)} for lon, lat in coordinates])
+        edges = np.array([values[0] for values in selected], dtype=np.int64)
+        # indice progressivo degli archi lungo il percorso, come edge_index di Valhalla
+        edge_index = np.concatenate(([0], np.cumsum(edges[1:] != edges[:-1]))) if len(edges) > 0 else edges
+        lons, lats = self.unproject([values[3] for values in selected], [values[4] for values in selected])
+        times = np.array([point["time"] for point in points], dtype=np.int64)
+        indexes = np.array(indexes, dtype=np.int64)
+        columns = get_trace_columns({
+            'edge_index': edge_index,
+            'distance_from_trace_point': [values[2] for values in selected],
+            # frazione dell'arco, come distance_along_edge di Valhalla
+            'distance_along_edge': [values[1] / self.edge_lengths[values[0]] if self.edge_lengths[values[0]] > 0 else 0.0 
+                                    for values in selected],
+            'lon': lons,
+            'lat': lats,
+            'way_id': self.edge_way_ids[edges] if len(edges) > 0 else [],
+            'travel_mode': [self.travel_mode] * len(selected),
+            'timestamp': times[indexes]
+        })
+        return shape, indexes, columns
+
+
+    def match_track(self, track, track_id: str) -> TraceRoute:
+        """Matches the valid track, with the same decimation and simplification of the Valhalla matching."""
+        points = sorted(convert_tracked_instance_to_points(track), key=lambda x: x["time"])
+        shape, indexes, columns = self.match(self.trace_preprocessor.prepare(points))
+        return TraceRoute(track_id=track_id, shape=shape, columns=columns)
+
+
+# matcher del processo worker, inizializzato da HmmMatcherPool
+worker_matcher = None
+
+
+def init_worker(matcher: HmmMatcher):
+    global worker_matcher
+    worker_matcher = matcher
+
+
+def match_track_worker(track, track_id: str) -> TraceRoute:
+    try:
+        return worker_matcher.match_track(track, track_id)
+    except Exception as e:
+        traceback.print_exc()
+        logger.error(f"Exception[{track_id}]: {e}")
+        return TraceRoute(track_id=track_id)
+
+
+class HmmMatcherPool:
+    """Process pool matching the tracks with a HmmMatcher, built once and shared with the workers at startup."""
+
+    def __init__(self, matcher: HmmMatcher):
+        self.workers = int(os.getenv("HMM_WORKERS", "0")) or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(matcher,))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+    def submit(self, track):
+        return self.executor.submit(match_track_worker, track, str(track["_id"]))
@@ -8,6 +8,7 @@ from datetime import datetime
 from import_tracks_data import import_campaign_tracks_data, import_campaign_groups_data, import_nearest_edges_by_trace 
 from import_tracks_data import get_df_info_list, merge_campaign_tracks_groups, import_campaign_tracks_info_data, import_campaigns_data
 from import_duckdb_data import import_duckdb_data
+from import_dump_data import import_dump_data
 
 app = Flask(__name__)
 server_port = os.getenv("SERVER_PORT", 8078)
@@ -32,7 +33,9 @@ def api_import_campaign_tracks_data():
     start_time = request.args.get('start_time', type=str)
     end_time = request.args.get('end_time', default=None, type=str)
     save_csv = request.args.get('save_csv', default=False, type=bool)
-    info_map = import_campaign_tracks_data(territory_id, start_time, end_time, save_csv)
+    incremental = request.args.get('incremental', default=False, type=bool)
+    columnar = request.args.get('columnar', default=False, type=bool)
+    info_map = import_campaign_tracks_data(territory_id, start_time, end_time, save_csv, incremental, columnar)
     stop = datetime.now()
     print(f"api_import_campaign_tracks_data Territory ID: {territory_id}, Time:{(stop - start).total_seconds()} seconds")
     return info_map
@@ -43,7 +46,8 @@ def api_import_campaign_groups_data():
     start = datetime.now()
     territory_id = request.args.get('territory_id', type=str)
     save_csv = request.args.get('save_csv', default=False, type=bool)
-    info_map = import_campaign_groups_data(territory_id, save_csv)
+    columnar = request.args.get('columnar', default=False, type=bool)
+    info_map = import_campaign_groups_data(territory_id, save_csv, columnar)
     stop = datetime.now()
     print(f"api_import_campaign_groups_data Territory ID: {territory_id}, Time:{(stop - start).total_seconds()} seconds")
     return info_map
@@ -56,7 +60,9 @@ def api_import_campaign_tracks_info_data():
     start_time = request.args.get('start_time', type=str)
     end_time = request.args.get('end_time', default=None, type=str)
     save_csv = request.args.get('save_csv', default=False, type=bool)
-    info_map = import_campaign_tracks_info_data(territory_id, start_time, end_time, save_csv)
+    incremental = request.args.get('incremental', default=False, type=bool)
+    columnar = request.args.get('columnar', default=False, type=bool)
+    info_map = import_campaign_tracks_info_data(territory_id, start_time, end_time, save_csv, incremental, columnar)
     stop = datetime.now()
     print(f"api_import_campaign_tracks_info_data Territory ID: {territory_id}, Time:{(stop - start).total_seconds()} seconds")
     return info_map
@@ -70,12 +76,37 @@ def api_import_nearest_edges_by_trace():
     end_time = request.args.get('end_time', default=None, type=str)
     track_modes = request.args.getlist('mode', type=str)
     save_csv = request.args.get('save_csv', default=False, type=bool)
-    info_map = import_nearest_edges_by_trace(territory_id, start_time, track_modes, end_time, save_csv)
+    incremental = request.args.get('incremental', default=False, type=bool)
+    async_io = request.args.get('async_io', default=False, type=bool)
+    single_pass = request.args.get('single_pass', default=False, type=bool)
+    campaign_tracks_only = request.args.get('campaign_tracks_only', default=False, type=bool)
+    info_map = import_nearest_edges_by_trace(territory_id, start_time, track_modes, end_time, save_csv, incremental, async_io, 
+                                             single_pass=single_pass, campaign_tracks_only=campaign_tracks_only)
     stop = datetime.now()
     print(f"api_import_nearest_edges_by_trace Territory ID: {territory_id}, Time:{(stop - start).total_seconds()} seconds")
     return info_map
 
 
+@app.route('/api/import/dump', methods=['GET'])
+def api_import_dump_data():
+    start = datetime.now()
+    territory_id = request.args.get('territory_id', type=str)
+    start_time = request.args.get('start_time', type=str)
+    end_time = request.args.get('end_time', default=None, type=str)
+    track_modes = request.args.getlist('mode', type=str)
+    tracks_file = request.args.get('tracks_file', default=None, type=str)
+    campaign_tracks_file = request.args.get('campaign_tracks_file', default=None, type=str)
+    campaigns_file = request.args.get('campaigns_file', default=None, type=str)
+    save_csv = request.args.get('save_csv', default=False, type=bool)
+    columnar = request.args.get('columnar', default=False, type=bool)
+    campaign_tracks_only = request.args.get('campaign_tracks_only', default=False, type=bool)
+    info_map = import_dump_data(territory_id, start_time, track_modes, end_time, tracks_file, campaign_tracks_file, 
+                                campaigns_file, save_csv, columnar, campaign_tracks_only)
+    stop = datetime.now()
+    print(f"api_import_dump_data Territory ID: {territory_id}, Time:{(stop - start).total_seconds()} seconds")
+    return info_map
+
+
 @app.route('/api/import/info', methods=['GET'])
 def api_info_df():
     start = datetime.now()
@@ -0,0 +1,41 @@
+import os
+import logging
+
+from playandgo.pg_dump_source import DumpTrackSource
+from storage.storage_engine import FileStorage
+from import_tracks_data import import_nearest_edges_by_trace, import_campaign_tracks_data
+
+logger = logging.getLogger(__name__)
+
+
+def get_dump_path(file_storage:FileStorage, file_name:str) -> str:
+    """Resolves a dump file name inside the dumps directory of the storage."""
+    if file_name is None:
+        return None
+    if os.path.basename(file_name) != file_name:
+        raise ValueError(f"Invalid dump file name: {file_name}")
+    file_path = f"{file_storage.store_path}/dumps/{file_name}"
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Dump file not found: {file_path}")
+    return file_path
+
+
+def import_dump_data(territory_id:str, start_time:str, track_modes:list, end_time:str=None, tracks_file:str=None, 
+                     campaign_tracks_file:str=None, campaigns_file:str=None, save_csv=False, columnar=False, 
+                     campaign_tracks_only=False):
+    """
+    Backfills nearest edges and campaign tracks from trackedInstances / campaignPlayerTracks exports
+    (mongodump .bson or extended-JSON lines, optionally .gz) stored in {STORAGE_PATH}/dumps.
+    """
+    logger.info(f"import_dump_data")
+    file_storage = FileStorage()
+    dump_source = DumpTrackSource(get_dump_path(file_storage, tracks_file), get_dump_path(file_storage, campaign_tracks_file), 
+                                  get_dump_path(file_storage, campaigns_file))
+    infos = []
+    if tracks_file is not None:
+        infos.extend(import_nearest_edges_by_trace(territory_id, start_time, track_modes, end_time, save_csv, 
+                                                   track_source=dump_source, campaign_tracks_only=campaign_tracks_only))
+    if campaign_tracks_file is not None:
+        infos.append(import_campaign_tracks_data(territory_id, start_time, end_time, save_csv, columnar=columnar, 
+                                                 track_source=dump_source))
+    return infos
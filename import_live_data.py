@@ -0,0 +1,220 @@
+import os
+import time
+import logging
+import threading
+import pandas as pd
+
+from datetime import datetime, timezone
+from pymongo.errors import OperationFailure
+
+from playandgo.pg_engine import CampaignTrack, get_campaign_track_row, get_utc_datetime
+from storage.storage_engine import FileStorage
+from valhalla.valhalla_engine import ValhallaEngine
+from graph.graphmap import GraphMap
+from import_tracks_data import NearestEdgesImport, get_playandgo_engine, get_last_start_time, update_watermark
+from import_tracks_data import merge_campaign_tracks_groups
+from import_duckdb_data import import_duckdb_data
+
+logger = logging.getLogger(__name__)
+
+# codice di errore MongoDB per un resume token non più presente nell'oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class LiveIngestionWorker:
+    """
+    Long-running ingestion of the tracks of a territory: tails the trackedInstances and campaignPlayerTracks
+    change streams and appends the newly validated tracks to the storage in micro-batches.
+    The resume token of each stream is saved after every flush, so a restarted worker continues
+    from the last stored micro-batch (at-least-once: the merges deduplicate the reprocessed tracks).
+    """
+
+    def __init__(self, territory_id:str, track_modes:list, save_csv:bool=False):
+        self.territory_id = territory_id
+        self.track_modes = track_modes
+        self.save_csv = save_csv
+        # dimensione massima e durata massima di un micro-batch
+        self.batch_size = int(os.getenv("LIVE_BATCH_SIZE", "100"))
+        self.batch_seconds = float(os.getenv("LIVE_BATCH_SECONDS", "60"))
+        # attesa prima di riaprire un change stream interrotto da un errore
+        self.retry_seconds = float(os.getenv("LIVE_RETRY_SECONDS", "10"))
+        # aggiornamento dei file DuckDB delle campagne toccate (0 = disabilitato)
+        self.duckdb_refresh_seconds = float(os.getenv("LIVE_DUCKDB_REFRESH_SECONDS", "0"))
+        self.set_group_id = eval(os.getenv("LIVE_SET_GROUP_ID", "False"))
+        self.set_campaign_info = eval(os.getenv("LIVE_SET_CAMPAIGN_INFO", "False"))
+
+        self.playandgo_engine = get_playandgo_engine()
+        self.file_storage = FileStorage()
+        self.valhalla_engine = ValhallaEngine()
+        # grafi caricati una sola volta per modalità, None se la modalità non è importabile
+        self.graph_maps = {}
+        # HmmMatcher per modalità, costruiti una volta sola (vedi HMM_MATCHER_MODES)
+        self.hmm_matchers = {}
+        # i flush dei due stream e l'aggiornamento DuckDB scrivono file condivisi
+        self.storage_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.pending_campaigns = set()
+        self.last_duckdb_refresh = time.monotonic()
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def run(self):
+        """Tails both change streams until stop() is called."""
+        logger.info(f"Start live ingestion - Territory ID: {self.territory_id}, Modes: {self.track_modes}")
+        threads = [
+            threading.Thread(target=self.tail, name="live-tracks",
+                             args=("live_tracks", self.playandgo_engine.watch_tracks, self.flush_tracks)),
+            threading.Thread(target=self.tail, name="live-campaign-tracks",
+                             args=("live_campaign_tracks", self.playandgo_engine.watch_campaign_tracks, self.flush_campaign_tracks)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f"Stop live ingestion - Territory ID: {self.territory_id}")
+
+
+    def tail(self, dataset:str, watch, flush):
+        """
+        Reads the change stream returned by watch and calls flush with the documents of each micro-batch.
+        On errors the stream is reopened from the last saved resume token.
+        """
+        while not self.stop_event.is_set():
+            watermark = self.file_storage.load_watermark(self.territory_id, dataset)
+            resume_token = watermark.get("resume_token") if watermark else None
+            try:
+                with watch(self.territory_id, resume_after=resume_token) as stream:
+                    logger.info(f"Change stream {dataset} opened - Territory ID: {self.territory_id}, Resume: {resume_token is not None}")
+                    self.read_stream(dataset, stream, flush)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # il token è uscito dall'oplog: si riparte da ora, il buco va coperto con un import incrementale
+                    logger.error(f"Change stream {dataset} history lost, restarting from now: {e}")
+                    self.file_storage.save_watermark(self.territory_id, dataset, {})
+                else:
+                    logger.error(f"Change stream {dataset} error: {e}")
+                    self.stop_event.wait(self.retry_seconds)
+            except Exception as e:
+                logger.error(f"Change stream {dataset} error: {e}")
+                self.stop_event.wait(self.retry_seconds)
+
+
+    def read_stream(self, dataset:str, stream, flush):
+        batch = []
+        saved_token = None
+        deadline = time.monotonic() + self.batch_seconds
+        while not self.stop_event.is_set():
+            change = stream.try_next()
+            if change is not None:
+                batch.append(change["fullDocument"])
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    self.flush_batch(flush, batch)
+                    batch = []
+                # il token avanza anche senza eventi utili (post batch resume token)
+                if stream.resume_token != saved_token:
+                    self.save_resume_token(dataset, stream.resume_token)
+                    saved_token = stream.resume_token
+                deadline = time.monotonic() + self.batch_seconds
+        if batch:
+            self.flush_batch(flush, batch)
+            self.save_resume_token(dataset, stream.resume_token)
+
+
+    def flush_batch(self, flush, batch:list):
+        start = datetime.now()
+        with self.storage_lock:
+            flush(batch)
+        stop = datetime.now()
+        logger.info(f"Flushed {flush.__name__} - Territory ID: {self.territory_id}, Documents: {len(batch)}, Time:{(stop - start).total_seconds()} seconds")
+        self.refresh_duckdb()
+
+
+    def save_resume_token(self, dataset:str, resume_token:dict):
+        if resume_token is not None:
+            self.file_storage.save_watermark(self.territory_id, dataset,
+                                             {"resume_token": resume_token, "updated_at": datetime.now(timezone.utc).isoformat()})
+
+
+    def get_graph_map(self, track_mode:str) -> GraphMap:
+        if track_mode not in self.graph_maps:
+            graph_map = GraphMap()
+            if track_mode != "train":
+                try:
+                    graph_map.load_territory_graph(self.territory_id, track_mode)
+                except ValueError as e:
+                    logger.info(f"Error loading graph for territory {self.territory_id} with mode {track_mode}: {e}")
+                    graph_map = None
+            self.graph_maps[track_mode] = graph_map
+        return self.graph_maps[track_mode]
+
+
+    def flush_tracks(self, tracks:list):
+        # una importazione per anno, i file di storage sono annuali
+        tracks_by_year = {}
+        for track in tracks:
+            if track.get("freeTrackingTransport") not in self.track_modes:
+                continue
+            tracks_by_year.setdefault(track["startTime"].strftime("%Y"), []).append(track)
+        for year_tracks in tracks_by_year.values():
+            nearest_edges_import = NearestEdgesImport(self.territory_id, self.file_storage, self.valhalla_engine, None, self.hmm_matchers)
+            for track in year_tracks:
+                track_mode = track["freeTrackingTransport"]
+                graph_map = self.get_graph_map(track_mode)
+                if graph_map is not None:
+                    nearest_edges_import.process_track(track_mode, track, graph_map)
+            nearest_edges_import.save(get_utc_datetime(year_tracks[0]["startTime"]).isoformat(), self.save_csv)
+
+
+    def flush_campaign_tracks(self, tracks:list):
+        campaign_map = self.playandgo_engine.get_campaign_map(self.territory_id)
+        if any(track.get("campaignId") not in campaign_map for track in tracks):
+            # campagna creata dopo il caricamento della cache: le campagne vengono rilette una volta
+            self.playandgo_engine.invalidate_campaigns(self.territory_id)
+            campaign_map = self.playandgo_engine.get_campaign_map(self.territory_id)
+
+        df_columns = ['territory_id', 'player_id', 'track_id', 'campaign_id', 'campaign_type',
+                      'start_time', 'end_time', 'mode', 'validation_result', 'distance', 'duration']
+        ls_tracks_by_year = {}
+        last_start_time = None
+        for track in tracks:
+            if track.get("campaignId") not in campaign_map:
+                logger.warning(f"Dropped campaign track {track.get('_id')}: unknown campaign {track.get('campaignId')}")
+                continue
+            row = get_campaign_track_row(self.territory_id, campaign_map, track)
+            if row is None:
+                continue
+            c_track = CampaignTrack(*row)
+            c_track.start_time = get_utc_datetime(c_track.start_time)
+            c_track.end_time = get_utc_datetime(c_track.end_time)
+            last_start_time = get_last_start_time(last_start_time, c_track.start_time)
+            ls_tracks_by_year.setdefault(c_track.start_time.strftime("%Y"), []).append(c_track.__dict__)
+            self.pending_campaigns.add((c_track.start_time.strftime("%Y"), c_track.campaign_id))
+
+        for year, ls_tracks in ls_tracks_by_year.items():
+            df = pd.DataFrame(ls_tracks, columns=df_columns)
+            self.file_storage.merge_campaign_tracks(self.territory_id, year, df, self.save_csv)
+        # mantiene allineato l'import incrementale batch
+        update_watermark(self.file_storage, self.territory_id, self.file_storage.campaign_tracks, last_start_time)
+
+
+    def refresh_duckdb(self):
+        """Rebuilds the mapped groups and the DuckDB files of the campaigns touched since the last refresh."""
+        if self.duckdb_refresh_seconds <= 0:
+            return
+        if time.monotonic() - self.last_duckdb_refresh < self.duckdb_refresh_seconds:
+            return
+        with self.storage_lock:
+            pending_campaigns = self.pending_campaigns
+            self.pending_campaigns = set()
+            self.last_duckdb_refresh = time.monotonic()
+            for year, campaign_id in sorted(pending_campaigns):
+                try:
+                    merge_campaign_tracks_groups(self.territory_id, year, campaign_id,
+                                                 self.set_group_id, self.set_campaign_info, self.save_csv)
+                    import_duckdb_data(self.territory_id, campaign_id)
+                except Exception as e:
+                    logger.warning(f"Error refreshing DuckDB for campaign {campaign_id}, year {year}: {e}")
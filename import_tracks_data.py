@@ -1,32 +1,122 @@
+import os
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 import h3
 
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 
-from playandgo.pg_engine import PlayAndGoEngine
-from valhalla.valhalla_engine import ValhallaEngine, convert_tracked_instance_to_points
+from playandgo.pg_engine import PlayAndGoEngine, CampaignTrack, CampaignGroup, SpecificCampaingTrackInfo
+from playandgo.pg_async_engine import AsyncPlayAndGoEngine
+from valhalla.matching_executor import MatchingExecutor
+from valhalla.valhalla_engine import ValhallaEngine, convert_tracked_instance_to_points, get_transit_mode
 from storage.storage_engine import FileStorage
-from graph.graphmap import GraphMap
+from graph.graphmap import GraphMap, NearestNodeBatch
+from graph.hmm_matcher import HmmMatcher, HmmMatcherPool
 
 logger = logging.getLogger(__name__)
 
 h3_res = 13  # H3 resolution level
 
+# margine di sovrapposizione degli import incrementali rispetto al watermark, per le tracce caricate in ritardo
+watermark_overlap = timedelta(minutes=int(os.getenv("IMPORT_WATERMARK_OVERLAP_MINUTES", "60")))
+
+# numero di tracce lette in anticipo dal cursore asincrono mentre si elabora la traccia corrente
+async_prefetch = int(os.getenv("IMPORT_ASYNC_PREFETCH", "100"))
+
+# engine condiviso tra le chiamate di import, per riusare i pool di connessioni MongoDB
+_playandgo_engine = None
+_playandgo_engine_lock = threading.Lock()
+
+
+def get_playandgo_engine() -> PlayAndGoEngine:
+    """
+    Returns the process-wide PlayAndGoEngine, so that its MongoDB connection pools are reused across imports.
+    """
+    global _playandgo_engine
+    if _playandgo_engine is None:
+        with _playandgo_engine_lock:
+            if _playandgo_engine is None:
+                _playandgo_engine = PlayAndGoEngine()
+    return _playandgo_engine
+
 def get_utc_datetime(dt):
     dt = dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
     return dt
 
 
+def get_incremental_start_time(file_storage:FileStorage, territory_id:str, dataset:str, start_time:str) -> str:
+    """
+    Returns the start time of an incremental import: the watermark of the dataset, minus the overlap margin,
+    when it is later than the requested start time.
+    """
+    watermark = file_storage.load_watermark(territory_id, dataset)
+    if watermark is None:
+        return start_time
+    start_time_dt = get_utc_datetime(datetime.fromisoformat(start_time))
+    watermark_dt = get_utc_datetime(datetime.fromisoformat(watermark["start_time"])) - watermark_overlap
+    if watermark_dt > start_time_dt:
+        logger.info(f"Incremental import {territory_id}/{dataset} from {watermark_dt.isoformat()}")
+        return watermark_dt.isoformat()
+    return start_time
+
+
+def update_watermark(file_storage:FileStorage, territory_id:str, dataset:str, last_start_time:datetime):
+    """
+    Moves the watermark of the dataset forward to the start time of the last imported document.
+    """
+    if last_start_time is None:
+        return
+    last_start_time = get_utc_datetime(last_start_time)
+    watermark = file_storage.load_watermark(territory_id, dataset)
+    if watermark is not None and get_utc_datetime(datetime.fromisoformat(watermark["start_time"])) >= last_start_time:
+        return
+    file_storage.save_watermark(territory_id, dataset, {"start_time": last_start_time.isoformat(), 
+                                                        "updated_at": datetime.now(timezone.utc).isoformat()})
+
+
+def get_last_start_time(last_start_time:datetime, start_time:datetime) -> datetime:
+    start_time = get_utc_datetime(start_time)
+    if last_start_time is None or start_time > last_start_time:
+        return start_time
+    return last_start_time
+
+
+def get_table_last_start_time(table:pa.Table) -> datetime:
+    return pc.max(table["start_time"]).as_py() if table.num_rows > 0 else None
+
+
+def get_years(start_times, default_year:str) -> list:
+    """Storage year of each start time, default_year when the start time is missing."""
+    return [start_time.strftime("%Y") if start_time is not None and not pd.isna(start_time) else default_year 
+            for start_time in start_times]
+
+
+def split_by_year(df:pd.DataFrame, years) -> dict:
+    """Splits the rows of the dataframe by year (one value per row), the storage files are yearly."""
+    if len(df) == 0:
+        return {}
+    years = pd.Series(list(years), index=df.index)
+    return {year: df_year for year, df_year in df.groupby(years, sort=True)}
+
+
 def import_campaigns_data(territory_id:str, save_csv=False):
     logger.info(f"import_campaigns_data")
     # Inizializza gli engine
-    playandgo_engine = PlayAndGoEngine()
+    playandgo_engine = get_playandgo_engine()
     file_storage = FileStorage()
 
+    # le campagne importate vengono sempre rilette da PlayAndGo
+    playandgo_engine.invalidate_campaigns(territory_id)
+
     # Ottieni i dati da PlayAndGo
     # columns=['territory_id', 'campaign_id', 'type', 'dateFrom', 'dateTo', 'description']
     ls_campaigns = []
@@ -55,7 +145,7 @@ def import_campaigns_data(territory_id:str, save_csv=False):
 
 
 def import_nearest_edges_by_locate(territory_id, start_time, end_time=None):
-    playandgo_engine = PlayAndGoEngine()
+    playandgo_engine = get_playandgo_engine()
     valhalla_engine = ValhallaEngine()
 
     nearest_edges = []
@@ -67,7 +157,109 @@ def import_nearest_edges_by_locate(territory_id, start_time, end_time=None):
     logger.info(f"Found {len(nearest_edges)} unique edges.")
 
 
-def extract_track_data_osm(territory_id, track, ls_tracks, ls_tracks_info, df_way_shapes, ls_nearest_edges, valhalla_engine, graph_map):
+class WayShapeIndex:
+    """
+    Way ids of the stored way shapes, loaded once per import, and the shapes of the new ways.
+    The unknown ways found in the tracks are deduplicated and resolved in batches with a single
+    /locate request (see ValhallaEngine.find_way_shapes_by_locate), or read from the graph edges
+    for the tracks matched on the graph (see HmmMatcher.get_way_shape).
+    The /locate batches run on a small thread pool while the tracks are processed, and are joined
+    by resolve() without a costing.
+    """
+
+    def __init__(self, territory_id:str, file_storage:FileStorage, valhalla_engine:ValhallaEngine):
+        self.valhalla_engine = valhalla_engine
+        try:
+            # le shape già salvate non servono, solo gli id
+            size, df_way_ids = file_storage.load_dataframe(territory_id, file_storage.way_shapes, columns=['way_id'])
+            self.way_ids = set(df_way_ids['way_id'].tolist())
+        except FileNotFoundError:
+            self.way_ids = set()
+        # way_id -> shape delle nuove way
+        self.way_shapes = {}
+        # costing -> {way_id: (lon, lat)} delle way da risolvere
+        self.pending = {}
+        # way non trovate da /locate, non vengono richieste di nuovo nello stesso import
+        self.missing = set()
+        # richieste /locate in corso: way richieste e future con (batch, way_id -> shape)
+        self.concurrency = int(os.getenv("VALHALLA_LOCATE_CONCURRENCY", "2"))
+        self.executor = None
+        self.requested = set()
+        self.futures = []
+
+
+    def __contains__(self, way_id) -> bool:
+        return way_id in self.way_ids or way_id in self.way_shapes or way_id in self.missing or way_id in self.requested
+
+
+    def add(self, costing:str, way_id, lon:float, lat:float, shape_source:HmmMatcher=None):
+        """
+        Registers a way of the tracks, resolved when the batch of its costing is full.
+        With shape_source the shape is taken from its graph, without /locate.
+        """
+        if way_id is None or way_id in self:
+            return
+        if shape_source is not None:
+            shape = shape_source.get_way_shape(way_id)
+            if shape is not None:
+                self.way_shapes[way_id] = shape
+            else:
+                self.missing.add(way_id)
+            return
+        pending = self.pending.setdefault(costing, {})
+        if way_id not in pending:
+            pending[way_id] = (lon, lat)
+            if len(pending) >= self.valhalla_engine.locate_batch_size:
+                self.resolve(costing)
+
+
+    def resolve(self, costing:str=None):
+        """
+        Submits the pending ways of the costing to the thread pool; without a costing submits the ways
+        of all the costings and waits for all the requests.
+        """
+        costings = list(self.pending.keys()) if costing is None else [costing]
+        for pending_costing in costings:
+            pending = self.pending.pop(pending_costing, {})
+            ways = [(way_id, lon, lat) for way_id, (lon, lat) in pending.items()]
+            for index in range(0, len(ways), self.valhalla_engine.locate_batch_size):
+                batch = ways[index:index + self.valhalla_engine.locate_batch_size]
+                self.submit(pending_costing, batch)
+        self.collect(wait=costing is None)
+        if costing is None and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+    def submit(self, costing:str, batch:list):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="valhalla-locate")
+        self.requested.update(way_id for way_id, lon, lat in batch)
+        self.futures.append((batch, self.executor.submit(self.valhalla_engine.find_way_shapes_by_locate, costing, batch)))
+
+
+    def collect(self, wait:bool=False):
+        """Stores the shapes of the completed requests, of all the requests with wait."""
+        running = []
+        for batch, future in self.futures:
+            if not wait and not future.done():
+                running.append((batch, future))
+                continue
+            way_shapes = future.result()
+            self.way_shapes.update(way_shapes)
+            self.missing.update(way_id for way_id, lon, lat in batch if way_id not in way_shapes)
+            self.requested.difference_update(way_id for way_id, lon, lat in batch)
+        self.futures = running
+
+
+    def get_dataframe(self) -> pd.DataFrame:
+        """The new way shapes, columns=['way_id', 'shape']."""
+        self.resolve()
+        return pd.DataFrame(list(self.way_shapes.items()), columns=['way_id', 'shape'])
+
+
+def extract_track_data_osm(territory_id, track, ls_tracks, ls_tracks_info, way_shape_index:WayShapeIndex, ls_nearest_edges, valhalla_engine, graph_map,
+                           trace_route=None, node_batch:NearestNodeBatch=None, hmm_matcher:HmmMatcher=None):
     start = datetime.now()
 
     bbox = graph_map.get_bbox(territory_id)
@@ -79,52 +271,45 @@ def extract_track_data_osm(territory_id, track, ls_tracks, ls_tracks_info, df_wa
                   'mode': track['freeTrackingTransport'], 'start_time': get_utc_datetime(track['startTime'])}
     ls_tracks_info.append(track_info)
 
-    trace_route = valhalla_engine.find_nearest_edges_by_trace(track, track_id) 
+    # il matching può essere già stato eseguito in parallelo (vedi MatchingExecutor)
+    if trace_route is None:
+        trace_route = valhalla_engine.find_nearest_edges_by_trace(track, track_id) 
 
     # columns=['track_id', 'shape']
     track_shape = {'track_id': track_id, 'shape': trace_route.shape}
     ls_tracks.append(track_shape)
 
-    if len(trace_route.trace_infos) > 0:
-        lon_array =[]
-        lat_array =[]
-        for index, trace_info in enumerate(trace_route.trace_infos):
+    if len(trace_route) > 0:
+        costing = get_transit_mode(track)
+        lon_array = trace_route.lon.tolist()
+        lat_array = trace_route.lat.tolist()
+        way_ids = trace_route.way_id.tolist()
+        timestamps = trace_route.timestamp.tolist()
+        for way_id, lon, lat in zip(way_ids, lon_array, lat_array):
             try:
-                # check way shape
-                if not trace_info.way_id in df_way_shapes['way_id'].values:
-                    try:
-                        edge_info = valhalla_engine.find_nearest_edges_by_osm_way(track, trace_info.way_id, 
-                                                                                trace_info.lon, trace_info.lat)
-                        if edge_info is not None:
-                            if df_way_shapes.empty:
-                                df_way_shapes.loc[0] = [edge_info.way_id, edge_info.shape]
-                            else:
-                                df_way_shapes.loc[df_way_shapes.index.max() + 1] = [edge_info.way_id, edge_info.shape]
-                    except Exception as e1:
-                        logger.warning(f"Error processing edge_info: {trace_info}, Error: {e1}")
+                # check way shape: le way sconosciute vengono risolte a blocchi
+                # con HmmMatcher le shape vengono dagli archi del grafo, senza Valhalla
+                way_shape_index.add(costing, way_id, lon, lat, hmm_matcher)
             except Exception as e2:
-                logger.warning(f"Error processing trace_info: {trace_info}, Error: {e2}")
-
-            lon_array.append(trace_info.lon)
-            lat_array.append(trace_info.lat)
+                logger.warning(f"Error processing way: {way_id}, Error: {e2}")
 
         # check if trace is in bbox
-        if graph_map.are_points_in_bbox(lon_array, lat_array, bbox):
-            nearest_node = graph_map.find_nearest_nodes(lon_array, lat_array, track_id)
-            for index, node_id in enumerate(nearest_node):
-                trace_info = trace_route.trace_infos[index]
-                cell = h3.latlng_to_cell(trace_info.lat, trace_info.lon, h3_res)
-                #df_nearest_edges = ['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal']
-                nearest_edge = {'track_id': track_id, 'h3': str(cell), 'timestamp': trace_info.timestamp, 
-                                'node_id': str(node_id), 'way_id': str(trace_info.way_id), 'ordinal': index}
-                ls_nearest_edges.append(nearest_edge)
+        in_bbox = graph_map.are_points_in_bbox(lon_array, lat_array, bbox)
+        if in_bbox and node_batch is None:
+            node_ids = [str(node_id) for node_id in graph_map.find_nearest_nodes(lon_array, lat_array, track_id)]
         else:
-            for index, trace_info in enumerate(trace_route.trace_infos):
-                cell = h3.latlng_to_cell(trace_info.lat, trace_info.lon, h3_res)
-                #df_nearest_edges = ['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal']
-                nearest_edge = {'track_id': track_id, 'h3': str(cell), 'timestamp': trace_info.timestamp, 
-                                'node_id': "-1", 'way_id': str(trace_info.way_id), 'ordinal': index}
-                ls_nearest_edges.append(nearest_edge)
+            # con node_batch i nodi vengono assegnati insieme a quelli delle altre tracce
+            node_ids = ["-1"] * len(lon_array)
+        rows = []
+        for index, node_id in enumerate(node_ids):
+            cell = h3.latlng_to_cell(lat_array[index], lon_array[index], h3_res)
+            #df_nearest_edges = ['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal']
+            nearest_edge = {'track_id': track_id, 'h3': str(cell), 'timestamp': timestamps[index], 
+                            'node_id': node_id, 'way_id': str(way_ids[index]), 'ordinal': index}
+            rows.append(nearest_edge)
+        ls_nearest_edges.extend(rows)
+        if in_bbox and node_batch is not None:
+            node_batch.add(rows, lon_array, lat_array)
 
     stop = datetime.now()
     logger.info(f"Track ID: {track_id}, Time:{(stop - start).total_seconds()} seconds")
@@ -153,151 +338,418 @@ def extract_track_data_h3(track, ls_tracks_info, ls_nearest_edges):
     logger.info(f"Track ID: {track_id}, Time:{(stop - start).total_seconds()} seconds")
 
 
-def import_nearest_edges_by_trace(territory_id, start_time, track_modes, end_time=None, save_csv=False):
-    logger.info(f"import_nearest_edges_by_trace")
-    playandgo_engine = PlayAndGoEngine()
-    valhalla_engine = ValhallaEngine()
-    file_storage = FileStorage()
-    graph_map = GraphMap()
-
-    dim = 0
-    try:
-        size, df_way_shapes = file_storage.load_dataframe(territory_id, file_storage.way_shapes)
-        dim =  df_way_shapes.shape[0]
-    except FileNotFoundError:
-        df_way_shapes = pd.DataFrame(columns=['way_id', 'shape'])
-    
-    # columns=['track_id', 'shape']
-    ls_tracks = [] 
-    
-    # columns=['player_id', 'track_id', 'multimodal_id', 'mode', 'start_time']
-    ls_tracks_info = []
-
-    # columns=['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal']
-    ls_nearest_edges = []
-
-    #track_modes = ["walk", "bike", "bus", "train", "car"]
+class NearestEdgesImport:
+    """
+    Collects the tracks, tracks info, way shapes and nearest edges extracted from the tracked instances
+    of a territory and merges them into the storage.
+    """
+
+    def __init__(self, territory_id:str, file_storage:FileStorage, valhalla_engine:ValhallaEngine, graph_map:GraphMap,
+                 hmm_matchers:dict=None):
+        self.territory_id = territory_id
+        self.file_storage = file_storage
+        self.valhalla_engine = valhalla_engine
+        self.graph_map = graph_map
+        self.matching_executor = MatchingExecutor(valhalla_engine)
+        # modalità associate alla rete con HmmMatcher invece di Valhalla, es. "bike,walk"
+        self.hmm_modes = [mode.strip() for mode in os.getenv("HMM_MATCHER_MODES", "").split(",") if mode.strip() and mode.strip() != "train"]
+        # matcher per modalità, condivisibili tra più import (es. LiveIngestionWorker)
+        self.hmm_matchers = hmm_matchers if hmm_matchers is not None else {}
+        # punti da associare ai nodi di ogni grafo con un'unica ricerca per più tracce
+        self.node_batches = {}
+
+        self.way_shape_index = WayShapeIndex(territory_id, file_storage, valhalla_engine)
+
+        # columns=['track_id', 'shape']
+        self.ls_tracks = [] 
+        
+        # columns=['player_id', 'track_id', 'multimodal_id', 'mode', 'start_time']
+        self.ls_tracks_info = []
 
-    for track_mode in track_modes:
-        logger.info(f"Processing mode: {track_mode}")
-        if track_mode != "train":
-            try:
-                graph_map.load_graph_from_bbox(territory_id, track_mode)
-            except ValueError as e:
-                logger.info(f"Error loading graph for territory {territory_id} with mode {track_mode}: {e}")
-                continue
+        # columns=['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal']
+        self.ls_nearest_edges = []
 
-            count = 0
-            for track in playandgo_engine.get_tracks(territory_id, start_time, end_time, track_mode):
-                try:
-                    extract_track_data_osm(territory_id, track, ls_tracks, ls_tracks_info, df_way_shapes, ls_nearest_edges, valhalla_engine, graph_map)
-                    logger.info(f"Track {track_mode} {count} processed.")
-                except Exception as e:
-                    logger.warning(f"Error processing track {track_mode} {count}: {e}")
-                    extract_track_data_h3(track, ls_tracks_info, ls_nearest_edges)
-                count += 1
+        # startTime dell'ultima traccia importata e numero di tracce per ogni modalità
+        self.last_start_times = {}
+        self.counts = {}
 
-        else:
-            count = 0
-            for track in playandgo_engine.get_tracks(territory_id, start_time, end_time, track_mode):
-                extract_track_data_h3(track, ls_tracks_info, ls_nearest_edges)
-                logger.info(f"Track {track_mode} {count} processed.")
-                count += 1
 
+    def get_dataset(self, track_mode:str) -> str:
+        return f"{self.file_storage.nearest_edges}_{track_mode}"
 
-    start_time_dt = datetime.fromisoformat(start_time)
-    year = start_time_dt.strftime("%Y")
 
-    infos = []
+    def get_start_time(self, track_mode:str, start_time:str, incremental:bool=False) -> str:
+        if incremental:
+            return get_incremental_start_time(self.file_storage, self.territory_id, self.get_dataset(track_mode), start_time)
+        return start_time
 
-    df_tracks = pd.DataFrame(ls_tracks, columns=['track_id', 'shape'])
-    rows, columns = df_tracks.shape
-    logger.info(f"Imported Tracks Rows: {rows}, Columns: {columns}")
-    file_storage.merge_tracks(territory_id, year, df_tracks, save_csv)
-    info_map = {"name": file_storage.tracks, "rows": rows}
-    infos.append(info_map)
 
-    df_tracks_info = pd.DataFrame(ls_tracks_info, columns=['player_id', 'track_id', 'multimodal_id', 'mode', 'start_time'])
-    rows, columns = df_tracks_info.shape
-    logger.info(f"Imported Tracks Info Rows: {rows}, Columns: {columns}")
-    file_storage.merge_tracks_info(territory_id, year, df_tracks_info, save_csv)
-    info_map = {"name": file_storage.tracks_info, "rows": rows}
-    infos.append(info_map)
+    def load_graph(self, track_mode:str, graph_map:GraphMap=None) -> bool:
+        """Load the graph used to snap the tracks of the mode, False if the mode cannot be imported."""
+        graph_map = graph_map or self.graph_map
+        if track_mode == "train":
+            return True
+        # i punti in attesa vanno associati ai nodi del grafo corrente prima di caricarne un altro
+        if id(graph_map) in self.node_batches:
+            self.node_batches[id(graph_map)].flush()
+        try:
+            graph_map.load_territory_graph(self.territory_id, track_mode)
+            return True
+        except ValueError as e:
+            logger.info(f"Error loading graph for territory {self.territory_id} with mode {track_mode}: {e}")
+            return False
+
+
+    def prepare_modes(self, track_modes:list, start_time:str, incremental:bool=False) -> str:
+        """
+        Loads a graph for each mode, for a single pass over the tracks of all the modes.
+        Returns the start time of the query, the earliest of the start times of the modes.
+        """
+        self.graph_maps = {}
+        self.mode_start_times = {}
+        for track_mode in track_modes:
+            graph_map = GraphMap()
+            if self.load_graph(track_mode, graph_map):
+                self.graph_maps[track_mode] = graph_map
+                mode_start_time = self.get_start_time(track_mode, start_time, incremental)
+                self.mode_start_times[track_mode] = get_utc_datetime(datetime.fromisoformat(mode_start_time))
+        if len(self.mode_start_times) == 0:
+            return start_time
+        return min(self.mode_start_times.values()).isoformat()
+
+
+    def is_dispatched(self, track) -> bool:
+        """True if the track of the single pass has to be processed."""
+        track_mode = track.get("freeTrackingTransport")
+        if track_mode not in self.graph_maps:
+            return False
+        # con l'import incrementale le modalità possono partire da istanti diversi
+        return get_utc_datetime(track["startTime"]) > self.mode_start_times[track_mode]
+
+
+    def dispatch_track(self, track, trace_route=None):
+        """Processes a track of the single pass with the graph of its mode."""
+        if self.is_dispatched(track):
+            track_mode = track["freeTrackingTransport"]
+            self.process_track(track_mode, track, self.graph_maps[track_mode], trace_route)
+
+
+    def get_hmm_matcher(self, track_mode:str, graph_map:GraphMap=None) -> HmmMatcher:
+        """The HmmMatcher of the graph of the mode, None if the mode is matched by Valhalla."""
+        if track_mode not in self.hmm_modes:
+            return None
+        graph_map = graph_map or self.graph_map
+        hmm_matcher = self.hmm_matchers.get(track_mode)
+        # il grafo della modalità può essere stato ricaricato
+        if hmm_matcher is None or hmm_matcher.G is not graph_map.G:
+            hmm_matcher = HmmMatcher(graph_map.G, track_mode)
+            self.hmm_matchers[track_mode] = hmm_matcher
+        return hmm_matcher
+
+
+    def get_node_batch(self, graph_map:GraphMap) -> NearestNodeBatch:
+        node_batch = self.node_batches.get(id(graph_map))
+        if node_batch is None:
+            node_batch = NearestNodeBatch(graph_map)
+            self.node_batches[id(graph_map)] = node_batch
+        return node_batch
+
+
+    def flush(self):
+        """Resolves the pending way shapes and nearest nodes of the processed tracks."""
+        self.way_shape_index.resolve()
+        for node_batch in self.node_batches.values():
+            node_batch.flush()
+
+
+    def process_tracks(self, tracks, track_mode:str=None):
+        """
+        Processes the tracks of a mode, or dispatches them by mode in the single pass when track_mode is None.
+        The matching of the next tracks runs concurrently (see MatchingExecutor), in the order of tracks:
+        the modes of HMM_MATCHER_MODES are matched by a pool of HmmMatcher processes, the others by Valhalla.
+        """
+        if track_mode is None:
+            graph_maps = self.graph_maps
+            needs_matching = lambda track: self.is_dispatched(track) and track["freeTrackingTransport"] != "train"
+        else:
+            graph_maps = {track_mode: self.graph_map}
+            needs_matching = lambda track: track_mode != "train"
+        local_matchers = {mode: HmmMatcherPool(self.get_hmm_matcher(mode, graph_map)) 
+                          for mode, graph_map in graph_maps.items() if mode in self.hmm_modes}
+        try:
+            for track, trace_route in self.matching_executor.map(tracks, needs_matching, local_matchers):
+                if track_mode is None:
+                    self.dispatch_track(track, trace_route)
+                else:
+                    self.process_track(track_mode, track, trace_route=trace_route)
+        finally:
+            for local_matcher in local_matchers.values():
+                local_matcher.close()
+
+
+    def process_track(self, track_mode:str, track, graph_map:GraphMap=None, trace_route=None):
+        graph_map = graph_map or self.graph_map
+        dataset = self.get_dataset(track_mode)
+        self.last_start_times[dataset] = get_last_start_time(self.last_start_times.get(dataset), track['startTime'])
+        count = self.counts.get(track_mode, 0)
+        if track_mode != "train":
+            try:
+                hmm_matcher = self.get_hmm_matcher(track_mode, graph_map)
+                if hmm_matcher is not None and trace_route is None:
+                    trace_route = hmm_matcher.match_track(track, str(track["_id"]))
+                extract_track_data_osm(self.territory_id, track, self.ls_tracks, self.ls_tracks_info, self.way_shape_index, 
+                                       self.ls_nearest_edges, self.valhalla_engine, graph_map, trace_route, 
+                                       self.get_node_batch(graph_map), hmm_matcher)
+                logger.info(f"Track {track_mode} {count} processed.")
+            except Exception as e:
+                logger.warning(f"Error processing track {track_mode} {count}: {e}")
+                extract_track_data_h3(track, self.ls_tracks_info, self.ls_nearest_edges)
+        else:
+            extract_track_data_h3(track, self.ls_tracks_info, self.ls_nearest_edges)
+            logger.info(f"Track {track_mode} {count} processed.")
+        self.counts[track_mode] = count + 1
+
+
+    def save(self, start_time:str, save_csv:bool=False) -> list:
+        """
+        Merges the collected rows into the storage, in the yearly files of the startTime of each track
+        (start_time gives the year of the tracks without one).
+        """
+        territory_id = self.territory_id
+        file_storage = self.file_storage
+        self.flush()
+
+        default_year = datetime.fromisoformat(start_time).strftime("%Y")
+        # anno di ogni traccia, dallo startTime salvato nelle info
+        track_years = {track_info['track_id']: year for track_info, year in 
+                       zip(self.ls_tracks_info, get_years([track_info['start_time'] for track_info in self.ls_tracks_info], default_year))}
+
+        infos = []
+
+        df_tracks = pd.DataFrame(self.ls_tracks, columns=['track_id', 'shape'])
+        rows, columns = df_tracks.shape
+        logger.info(f"Imported Tracks Rows: {rows}, Columns: {columns}")
+        for year, df_year in split_by_year(df_tracks, df_tracks['track_id'].map(track_years).fillna(default_year)).items():
+            file_storage.merge_tracks(territory_id, year, df_year, save_csv)
+        info_map = {"name": file_storage.tracks, "rows": rows}
+        infos.append(info_map)
+
+        df_tracks_info = pd.DataFrame(self.ls_tracks_info, columns=['player_id', 'track_id', 'multimodal_id', 'mode', 'start_time'])
+        rows, columns = df_tracks_info.shape
+        logger.info(f"Imported Tracks Info Rows: {rows}, Columns: {columns}")
+        for year, df_year in split_by_year(df_tracks_info, df_tracks_info['track_id'].map(track_years).fillna(default_year)).items():
+            file_storage.merge_tracks_info(territory_id, year, df_year, save_csv)
+        info_map = {"name": file_storage.tracks_info, "rows": rows}
+        infos.append(info_map)
+
+        df_way_shapes = self.way_shape_index.get_dataframe()
+        rows, columns = df_way_shapes.shape
+        logger.info(f"Imported Way Shapes Rows: {rows}, Columns: {columns}")
+        file_storage.merge_way_shapes(territory_id, df_way_shapes, save_csv)
+        info_map = {"name": file_storage.way_shapes, "rows": rows}
+        infos.append(info_map)
+
+        df_nearest_edges = pd.DataFrame(self.ls_nearest_edges, columns=['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal'])
+        rows, columns = df_nearest_edges.shape
+        logger.info(f"Imported Nearest Edges Rows: {rows}, Columns: {columns}")
+        for year, df_year in split_by_year(df_nearest_edges, df_nearest_edges['track_id'].map(track_years).fillna(default_year)).items():
+            file_storage.merge_nearest_edges(territory_id, year, df_year, save_csv)
+        info_map = {"name": file_storage.nearest_edges, "rows": rows}
+        infos.append(info_map)
+
+        for dataset, last_start_time in self.last_start_times.items():
+            update_watermark(file_storage, territory_id, dataset, last_start_time)
+
+        #rows, columns = df_h3_info.shape
+        #logger.info(f"Imported H3 Rows: {rows}, Columns: {columns}")
+        #file_storage.merge_h3_info(territory_id, year, df_h3_info, save_csv)
+        #info_map = {"name": file_storage.h3_info, "rows": rows}
+        #infos.append(info_map)
+
+        return infos
+
+
+def get_campaign_track_ids(playandgo_engine, territory_id:str, start_time:str, end_time:str=None, campaign_tracks_only:bool=False) -> set:
+    """
+    Returns the ids of the tracks referenced by the non-personal campaigns in the window when campaign_tracks_only
+    is set, None (all the tracks) otherwise.
+    """
+    if not campaign_tracks_only:
+        return None
+    return playandgo_engine.get_campaign_track_ids(territory_id, start_time, end_time)
+
+
+def import_nearest_edges_by_trace(territory_id, start_time, track_modes, end_time=None, save_csv=False, incremental=False,
+                                  async_io=False, track_source=None, single_pass=False, campaign_tracks_only=False):
+    """
+    Imports the nearest edges of the valid tracks of the given modes. The tracks are read from
+    PlayAndGo, or from track_source (e.g. a DumpTrackSource) when given.
+    With single_pass the tracks of all the modes are read by a single query and dispatched
+    by freeTrackingTransport, instead of one query per mode. A track_source is always read in a
+    single pass, since every query re-parses the whole dump.
+    With campaign_tracks_only only the tracks of non-personal campaigns (the ones that reach the analyses) are matched.
+    """
+    logger.info(f"import_nearest_edges_by_trace")
+    if async_io and track_source is None:
+        return asyncio.run(import_nearest_edges_by_trace_async(territory_id, start_time, track_modes, end_time, save_csv, 
+                                                               incremental, single_pass, campaign_tracks_only))
+
+    playandgo_engine = track_source or get_playandgo_engine()
+    nearest_edges_import = NearestEdgesImport(territory_id, FileStorage(), ValhallaEngine(), GraphMap())
+
+    if single_pass or track_source is not None:
+        query_start_time = nearest_edges_import.prepare_modes(track_modes, start_time, incremental)
+        query_modes = list(nearest_edges_import.graph_maps)
+        if len(query_modes) > 0:
+            track_ids = get_campaign_track_ids(playandgo_engine, territory_id, query_start_time, end_time, campaign_tracks_only)
+            tracks = playandgo_engine.get_tracks(territory_id, query_start_time, end_time, query_modes, track_ids=track_ids)
+            nearest_edges_import.process_tracks(tracks)
+        return nearest_edges_import.save(start_time, save_csv)
 
-    rows, columns = df_way_shapes.shape
-    logger.info(f"Imported Way Shapes Rows: {rows}, Columns: {columns}")
-    file_storage.merge_way_shapes(territory_id, df_way_shapes, save_csv)
-    info_map = {"name": file_storage.way_shapes, "rows": (rows - dim)}
-    infos.append(info_map)
+    #track_modes = ["walk", "bike", "bus", "train", "car"]
 
-    df_nearest_edges = pd.DataFrame(ls_nearest_edges, columns=['track_id', 'h3', 'timestamp', 'node_id', 'way_id', 'ordinal'])
-    rows, columns = df_nearest_edges.shape
-    logger.info(f"Imported Nearest Edges Rows: {rows}, Columns: {columns}")
-    file_storage.merge_nearest_edges(territory_id, year, df_nearest_edges, save_csv)
-    info_map = {"name": file_storage.nearest_edges, "rows": rows}
-    infos.append(info_map)
+    for track_mode in track_modes:
+        logger.info(f"Processing mode: {track_mode}")
+        if not nearest_edges_import.load_graph(track_mode):
+            continue
+        mode_start_time = nearest_edges_import.get_start_time(track_mode, start_time, incremental)
+        track_ids = get_campaign_track_ids(playandgo_engine, territory_id, mode_start_time, end_time, campaign_tracks_only)
+        tracks = playandgo_engine.get_tracks(territory_id, mode_start_time, end_time, track_mode, track_ids=track_ids)
+        nearest_edges_import.process_tracks(tracks, track_mode)
+
+    return nearest_edges_import.save(start_time, save_csv)
+
+
+async def import_nearest_edges_by_trace_async(territory_id, start_time, track_modes, end_time=None, save_csv=False, incremental=False,
+                                              single_pass=False, campaign_tracks_only=False):
+    """
+    Same as import_nearest_edges_by_trace, but the tracks are fetched by an async MongoDB cursor while
+    the previous ones are being matched by NearestEdgesImport.process_tracks in a worker thread, so that 
+    fetching and the concurrent matching overlap.
+    """
+    logger.info(f"import_nearest_edges_by_trace_async")
+    nearest_edges_import = NearestEdgesImport(territory_id, FileStorage(), ValhallaEngine(), GraphMap())
+    done = object()
+
+    async def fetch_tracks(async_engine, query_start_time, query_mode, track_queue):
+        try:
+            track_ids = await asyncio.to_thread(get_campaign_track_ids, async_engine.settings, territory_id, query_start_time, 
+                                                end_time, campaign_tracks_only)
+            async for track in async_engine.get_tracks(territory_id, query_start_time, end_time, query_mode, track_ids=track_ids):
+                await track_queue.put(track)
+        finally:
+            await track_queue.put(done)
+
+    async def import_tracks(async_engine, query_start_time, query_mode, track_mode):
+        loop = asyncio.get_running_loop()
+        track_queue = asyncio.Queue(maxsize=async_prefetch)
+        fetch_task = asyncio.create_task(fetch_tracks(async_engine, query_start_time, query_mode, track_queue))
+
+        def iter_tracks():
+            # generatore sincrono sulla coda asincrona, consumato da process_tracks nel thread di lavoro
+            while True:
+                track = asyncio.run_coroutine_threadsafe(track_queue.get(), loop).result()
+                if track is done:
+                    return
+                yield track
 
-    #rows, columns = df_h3_info.shape
-    #logger.info(f"Imported H3 Rows: {rows}, Columns: {columns}")
-    #file_storage.merge_h3_info(territory_id, year, df_h3_info, save_csv)
-    #info_map = {"name": file_storage.h3_info, "rows": rows}
-    #infos.append(info_map)
+        try:
+            await asyncio.to_thread(nearest_edges_import.process_tracks, iter_tracks(), track_mode)
+            # propaga eventuali errori della lettura
+            await fetch_task
+        finally:
+            fetch_task.cancel()
+
+    async with AsyncPlayAndGoEngine(get_playandgo_engine()) as async_engine:
+        if single_pass:
+            query_start_time = await asyncio.to_thread(nearest_edges_import.prepare_modes, track_modes, start_time, incremental)
+            query_modes = list(nearest_edges_import.graph_maps)
+            if len(query_modes) > 0:
+                await import_tracks(async_engine, query_start_time, query_modes, None)
+        else:
+            for track_mode in track_modes:
+                logger.info(f"Processing mode: {track_mode}")
+                if not await asyncio.to_thread(nearest_edges_import.load_graph, track_mode):
+                    continue
+                mode_start_time = nearest_edges_import.get_start_time(track_mode, start_time, incremental)
+                await import_tracks(async_engine, mode_start_time, track_mode, track_mode)
 
-    return infos
+    return await asyncio.to_thread(nearest_edges_import.save, start_time, save_csv)
 
 
-def import_campaign_tracks_data(territory_id, start_time, end_time=None, save_csv=False):
+def import_campaign_tracks_data(territory_id, start_time, end_time=None, save_csv=False, incremental=False, columnar=False,
+                                track_source=None):
     logger.info(f"import_campaign_tracks_data")
-    # Inizializza gli engine
-    playandgo_engine = PlayAndGoEngine()
+    # Inizializza gli engine: i dati arrivano da PlayAndGo o da una sorgente alternativa (es. dump)
+    playandgo_engine = track_source or get_playandgo_engine()
     file_storage = FileStorage()
 
-    # Ottieni i dati da PlayAndGo
-    # columns=['territory_id', 'player_id', 'track_id', 'campaign_id', 'campaign_type', 
-    #                           'start_time', 'end_time', 'mode', 'validation_result', 'distance', 'duration']
-    ls_tracks = []
-    for c_track in playandgo_engine.get_campaign_tracks(territory_id, start_time, end_time):
-        try:
-            c_track.start_time = get_utc_datetime(c_track.start_time)
-            c_track.end_time = get_utc_datetime(c_track.end_time)
-            ls_tracks.append(c_track.__dict__)
-            logger.info(f"Processed campaign track: {c_track.track_id}")
-        except Exception as e:
-            logger.warning(f"Error processing campaign track: {c_track.track_id}, Error: {e}")
-            continue
+    query_start_time = start_time
+    if incremental:
+        query_start_time = get_incremental_start_time(file_storage, territory_id, file_storage.campaign_tracks, start_time)
+    last_start_time = None
+
+    df_columns = ['territory_id', 'player_id', 'track_id', 'campaign_id', 'campaign_type', 
+                  'start_time', 'end_time', 'mode', 'validation_result', 'distance', 'duration']
+    if columnar:
+        # estrazione colonnare: i batch Arrow arrivano allo storage senza oggetti per riga
+        batches = playandgo_engine.get_campaign_tracks_batches(territory_id, query_start_time, end_time)
+        table = pa.Table.from_batches(list(batches), schema=CampaignTrack.arrow_schema)
+        last_start_time = get_table_last_start_time(table)
+        df = file_storage.table_to_df(table, df_columns)
+    else:
+        # Ottieni i dati da PlayAndGo
+        ls_tracks = []
+        for c_track in playandgo_engine.get_campaign_tracks(territory_id, query_start_time, end_time):
+            try:
+                c_track.start_time = get_utc_datetime(c_track.start_time)
+                c_track.end_time = get_utc_datetime(c_track.end_time)
+                last_start_time = get_last_start_time(last_start_time, c_track.start_time)
+                ls_tracks.append(c_track.__dict__)
+                logger.info(f"Processed campaign track: {c_track.track_id}")
+            except Exception as e:
+                logger.warning(f"Error processing campaign track: {c_track.track_id}, Error: {e}")
+                continue
+        df = pd.DataFrame(ls_tracks, columns=df_columns)
 
-    start_time_dt = datetime.fromisoformat(start_time)
-    year = start_time_dt.strftime("%Y")
+    # file annuali secondo lo startTime di ogni traccia
+    default_year = datetime.fromisoformat(start_time).strftime("%Y")
 
-    df = pd.DataFrame(ls_tracks, columns=['territory_id', 'player_id', 'track_id', 'campaign_id', 'campaign_type', 
-                                         'start_time', 'end_time', 'mode', 'validation_result', 'distance', 'duration'])
     rows, columns = df.shape
     logger.info(f"Imported Campaign Tracks Rows: {rows}, Columns: {columns}")
-    file_storage.merge_campaign_tracks(territory_id, year, df, save_csv)
+    for year, df_year in split_by_year(df, get_years(df['start_time'], default_year)).items():
+        file_storage.merge_campaign_tracks(territory_id, year, df_year, save_csv)
+    update_watermark(file_storage, territory_id, file_storage.campaign_tracks, last_start_time)
     info_map = {"name": file_storage.campaign_tracks, "rows": rows}
     return info_map
 
 
-def import_campaign_groups_data(territory_id:str, save_csv=False):
+def import_campaign_groups_data(territory_id:str, save_csv=False, columnar=False):
     # Inizializza gli engine
-    playandgo_engine = PlayAndGoEngine()
+    playandgo_engine = get_playandgo_engine()
     file_storage = FileStorage()
 
-    # Ottieni i dati da PlayAndGo
-    # columns=['territory_id', 'player_id', 'campaign_id', 'group_id']
-    ls_groups = []
-    for c_group in playandgo_engine.get_campaign_groups(territory_id):
-        try:
-            ls_groups.append(c_group.__dict__)
-            logger.info(f"Processed campaign group: {c_group.player_id}, {c_group.campaign_id}")
-        except Exception as e:
-            logger.warning(f"Error processing campaign group: {c_group.player_id}, {c_group.campaign_id}, Error: {e}")
-            continue
+    df_columns = ['territory_id', 'player_id', 'campaign_id', 'group_id']
+    if columnar:
+        # estrazione colonnare: i batch Arrow arrivano allo storage senza oggetti per riga
+        batches = playandgo_engine.get_campaign_groups_batches(territory_id)
+        table = pa.Table.from_batches(list(batches), schema=CampaignGroup.arrow_schema)
+        df = file_storage.table_to_df(table, df_columns)
+    else:
+        # Ottieni i dati da PlayAndGo
+        ls_groups = []
+        for c_group in playandgo_engine.get_campaign_groups(territory_id):
+            try:
+                ls_groups.append(c_group.__dict__)
+                logger.info(f"Processed campaign group: {c_group.player_id}, {c_group.campaign_id}")
+            except Exception as e:
+                logger.warning(f"Error processing campaign group: {c_group.player_id}, {c_group.campaign_id}, Error: {e}")
+                continue
+        df = pd.DataFrame(ls_groups, columns=df_columns)
         
     #start_time_dt = datetime.fromisoformat(start_time)
     #year = start_time_dt.strftime("%Y")
 
-    df = pd.DataFrame(ls_groups, columns=['territory_id', 'player_id', 'campaign_id', 'group_id'])
     rows, columns = df.shape
     logger.info(f"Imported Campaign Groups Rows: {rows}, Columns: {columns}")
     file_storage.merge_campaign_groups(territory_id, df, save_csv)
@@ -367,28 +819,46 @@ def merge_campaign_tracks_groups(territory_id:str, year:str, campaign_id:str,
         logger.error(f"File not found for merge_campaign_tracks_groups in territory {territory_id} for year {year}")
 
 
-def import_campaign_tracks_info_data(territory_id:str, start_time, end_time=None, save_csv=False):
+def import_campaign_tracks_info_data(territory_id:str, start_time, end_time=None, save_csv=False, incremental=False, columnar=False):
     # Inizializza gli engine
-    playandgo_engine = PlayAndGoEngine()
+    playandgo_engine = get_playandgo_engine()
     file_storage = FileStorage()
 
-    # columns=['territory_id', 'player_id', 'campaign_id', 'track_id', 'multimodal_id', 'way_back', 'location_id']
-    ls_tracks = []
-    for c_track in playandgo_engine.get_campaign_tracks_info(territory_id, start_time, end_time):
-        try:
-            ls_tracks.append(c_track.__dict__)
-            logger.info(f"Processed campaign info track: {c_track.player_id}, {c_track.track_id}, {c_track.campaign_id}")
-        except Exception as e:
-            logger.warning(f"Error processing campaign info track: {c_track.player_id}, {c_track.track_id}, {c_track.campaign_id}, Error: {e}")
-            continue
+    query_start_time = start_time
+    if incremental:
+        query_start_time = get_incremental_start_time(file_storage, territory_id, file_storage.campaign_tracks_info, start_time)
+    last_start_time = None
+
+    df_columns = ['territory_id', 'player_id', 'campaign_id', 'track_id', 'way_back', 'location_id']
+    if columnar:
+        # estrazione colonnare: i batch Arrow arrivano allo storage senza oggetti per riga
+        batches = playandgo_engine.get_campaign_tracks_info_batches(territory_id, query_start_time, end_time)
+        table = pa.Table.from_batches(list(batches), schema=SpecificCampaingTrackInfo.arrow_schema)
+        last_start_time = get_table_last_start_time(table)
+        start_times = table["start_time"].to_pylist()
+        df = file_storage.table_to_df(table, df_columns)
+    else:
+        ls_tracks = []
+        start_times = []
+        for c_track in playandgo_engine.get_campaign_tracks_info(territory_id, query_start_time, end_time):
+            try:
+                last_start_time = get_last_start_time(last_start_time, c_track.start_time)
+                ls_tracks.append(c_track.__dict__)
+                start_times.append(c_track.start_time)
+                logger.info(f"Processed campaign info track: {c_track.player_id}, {c_track.track_id}, {c_track.campaign_id}")
+            except Exception as e:
+                logger.warning(f"Error processing campaign info track: {c_track.player_id}, {c_track.track_id}, {c_track.campaign_id}, Error: {e}")
+                continue
+        df = pd.DataFrame(ls_tracks, columns=df_columns)
         
-    start_time_dt = datetime.fromisoformat(start_time)
-    year = start_time_dt.strftime("%Y")
+    # file annuali secondo lo startTime di ogni traccia
+    default_year = datetime.fromisoformat(start_time).strftime("%Y")
 
-    df = pd.DataFrame(ls_tracks, columns=['territory_id', 'player_id', 'campaign_id', 'track_id', 'way_back', 'location_id'])
     rows, columns = df.shape
     logger.info(f"Imported Campaign Info Track Rows: {rows}, Columns: {columns}")
-    file_storage.merge_campaign_tracks_info(territory_id, year, df, save_csv)
+    for year, df_year in split_by_year(df, get_years(start_times, default_year)).items():
+        file_storage.merge_campaign_tracks_info(territory_id, year, df_year, save_csv)
+    update_watermark(file_storage, territory_id, file_storage.campaign_tracks_info, last_start_time)
     info_map = {"name": file_storage.campaign_tracks_info, "rows": rows}
     return info_map
 
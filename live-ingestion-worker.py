@@ -0,0 +1,20 @@
+import os
+import signal
+import logging
+
+from import_live_data import LiveIngestionWorker
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    territory_id = os.getenv("LIVE_TERRITORY_ID", "L")
+    track_modes = os.getenv("LIVE_TRACK_MODES", "walk,bike,bus,train,car").split(",")
+    save_csv = eval(os.getenv("LIVE_SAVE_CSV", "False"))
+
+    worker = LiveIngestionWorker(territory_id, track_modes, save_csv)
+    # arresto pulito: il micro-batch corrente viene salvato prima di uscire
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    worker.run()
@@ -0,0 +1,140 @@
+import os
+import json
+import math
+import time
+import random
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import networkx as nx
+import requests
+from bson.objectid import ObjectId
+
+from valhalla.stand_in_server import StandInSettings, start_stand_in_server
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def generate_track(territory_id: str, track_mode: str, bbox: list, points: int, start_time: datetime) -> dict:
+    """Synthetic tracked instance: a random walk inside the bbox, one point every 5 seconds."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon = random.uniform(min_lon, max_lon)
+    lat = random.uniform(min_lat, max_lat)
+    speed = {"walk": 1.4, "bike": 5.0}.get(track_mode, 10.0)
+    heading = random.uniform(0, 2 * math.pi)
+    events = []
+    for index in range(points):
+        events.append({"longitude": lon, "latitude": lat, "recorded_at": start_time + timedelta(seconds=5 * index)})
+        heading += random.gauss(0, 0.3)
+        lat = min(max(lat + math.sin(heading) * speed * 5 / 111320, min_lat), max_lat)
+        lon = min(max(lon + math.cos(heading) * speed * 5 / (111320 * math.cos(math.radians(lat))), min_lon), max_lon)
+    return {"_id": ObjectId(), "territoryId": territory_id, "userId": f"player{random.randint(1, 1000)}",
+            "multimodalId": str(ObjectId()), "freeTrackingTransport": track_mode, "startTime": start_time,
+            "validationResult": {"valid": True}, "geolocationEvents": events}
+
+
+def build_grid_graph(bbox: list, spacing: float = 0.002) -> nx.MultiDiGraph:
+    """Synthetic street grid over the bbox, in the same form of the osmnx graphs (used without the OSM network)."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lons = np.arange(min_lon, max_lon + spacing, spacing)
+    lats = np.arange(min_lat, max_lat + spacing, spacing)
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i, lat in enumerate(lats):
+        for j, lon in enumerate(lons):
+            G.add_node(i * len(lons) + j, x=float(lon), y=float(lat))
+    for i, lat in enumerate(lats):
+        for j, lon in enumerate(lons):
+            node = i * len(lons) + j
+            if j + 1 < len(lons):
+                length = spacing * 111320 * math.cos(math.radians(lat))
+                G.add_edge(node, node + 1, osmid=1000000 + i, length=length)
+                G.add_edge(node + 1, node, osmid=1000000 + i, length=length)
+            if i + 1 < len(lats):
+                G.add_edge(node, node + len(lons), osmid=2000000 + j, length=spacing * 111320)
+                G.add_edge(node + len(lons), node, osmid=2000000 + j, length=spacing * 111320)
+    return G
+
+
+if __name__ == "__main__":
+    territory_id = os.getenv("LOAD_TEST_TERRITORY", "L")
+    track_mode = os.getenv("LOAD_TEST_MODE", "bike")
+    track_count = int(os.getenv("LOAD_TEST_TRACKS", "500"))
+    track_points = int(os.getenv("LOAD_TEST_POINTS", "300"))
+    # "grid" (rete sintetica sul bbox) o "osm" (rete OSM, vedi GraphMap.load_territory_graph)
+    graph_source = os.getenv("LOAD_TEST_GRAPH", "grid")
+    # avvia il server sostitutivo di Valhalla nel processo, altrimenti usa VALHALLA_URI
+    stand_in = eval(os.getenv("LOAD_TEST_STAND_IN", "True"))
+    save = eval(os.getenv("LOAD_TEST_SAVE", "False"))
+
+    server = None
+    if stand_in:
+        settings = StandInSettings()
+        settings.port = 0
+        server = start_stand_in_server(settings, "127.0.0.1")
+        os.environ["VALHALLA_URI"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # importati dopo VALHALLA_URI
+    from import_tracks_data import NearestEdgesImport
+    from valhalla.valhalla_engine import ValhallaEngine
+    from storage.storage_engine import FileStorage
+    from graph.graphmap import GraphMap
+
+    graph_map = GraphMap()
+    bbox = graph_map.get_bbox(territory_id)
+    if graph_source == "grid":
+        graph_map.set_graph(build_grid_graph(bbox))
+    else:
+        graph_map.load_territory_graph(territory_id, track_mode)
+
+    start_time = datetime(2025, 1, 1)
+    tracks = [generate_track(territory_id, track_mode, bbox, track_points, start_time + timedelta(minutes=index))
+              for index in range(track_count)]
+
+    # latenza per traccia: dalla lettura della traccia alla fine della sua elaborazione
+    read_times = {}
+    latencies = []
+
+    class TimedNearestEdgesImport(NearestEdgesImport):
+        def process_track(self, track_mode, track, graph_map=None, trace_route=None):
+            super().process_track(track_mode, track, graph_map, trace_route)
+            latencies.append(time.monotonic() - read_times[track["_id"]])
+
+    def read_tracks():
+        for track in tracks:
+            read_times[track["_id"]] = time.monotonic()
+            yield track
+
+    with ValhallaEngine() as valhalla_engine:
+        nearest_edges_import = TimedNearestEdgesImport(territory_id, FileStorage(), valhalla_engine, graph_map)
+        start = time.monotonic()
+        nearest_edges_import.process_tracks(read_tracks(), track_mode)
+        if save:
+            nearest_edges_import.save(start_time.isoformat())
+        else:
+            nearest_edges_import.flush()
+        stop = time.monotonic()
+
+    report = {
+        "tracks": track_count,
+        "points": track_points,
+        "mode": track_mode,
+        "seconds": round(stop - start, 3),
+        "tracks_per_second": round(track_count / (stop - start), 2),
+        "latency_p50": round(float(np.percentile(latencies, 50)), 4),
+        "latency_p99": round(float(np.percentile(latencies, 99)), 4),
+        "nearest_edges": len(nearest_edges_import.ls_nearest_edges),
+        "new_way_shapes": len(nearest_edges_import.way_shape_index.way_shapes),
+    }
+    if server is not None:
+        report["valhalla"] = server.get_stats()
+        server.shutdown()
+    else:
+        try:
+            # statistiche disponibili solo con un server sostitutivo esterno
+            report["valhalla"] = requests.get(os.environ["VALHALLA_URI"].rstrip("/") + "/stats", timeout=5).json()
+        except Exception:
+            pass
+    logger.info(f"Load test: {json.dumps(report)}")
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+from functools import partial
+from pymongo import AsyncMongoClient
+from bson import decode
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from playandgo.pg_engine import PlayAndGoEngine, CampaignTrack, TransferStats, TRACK_PROJECTION
+from playandgo.pg_engine import get_tracks_query, get_campaign_track_row, get_time_partitions, get_track_partitions
+from playandgo.pg_engine import get_track_query, is_valid_track, get_campaigns_query, get_campaign_tracks_query, add_campaign
+from playandgo.pg_engine import _ShardError, _SHARD_DONE
+
+logger = logging.getLogger(__name__)
+
+
+async def aiter_sharded(fetchers: list, ordered: bool = True, queue_size: int = 1000):
+    """
+    Async counterpart of iter_sharded: runs each fetcher (a callable returning an async iterator)
+    as a task on the running event loop and merges the results into a single async generator.
+    """
+    if len(fetchers) == 1:
+        async for item in fetchers[0]():
+            yield item
+        return
+
+    if ordered:
+        queues = [asyncio.Queue(maxsize=queue_size) for _ in fetchers]
+    else:
+        shared_queue = asyncio.Queue(maxsize=queue_size * len(fetchers))
+        queues = [shared_queue] * len(fetchers)
+
+    async def produce(fetcher, out: asyncio.Queue):
+        try:
+            async for item in fetcher():
+                await out.put(item)
+            await out.put(_SHARD_DONE)
+        except Exception as e:
+            await out.put(_ShardError(e))
+
+    tasks = [asyncio.create_task(produce(fetcher, out)) for fetcher, out in zip(fetchers, queues)]
+    try:
+        pending = len(fetchers)
+        index = 0
+        while pending > 0:
+            item = await queues[index].get()
+            if item is _SHARD_DONE:
+                pending -= 1
+                if ordered:
+                    index += 1
+            elif isinstance(item, _ShardError):
+                raise item.error
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class AsyncPlayAndGoEngine:
+    """
+    Asyncio variant of PlayAndGoEngine, exposing get_tracks and get_campaign_tracks as async iterators.
+    Connection, batching and sharding settings are taken from a PlayAndGoEngine instance.
+    The queries, partitions and row conversions are the module functions of pg_engine shared with the sync engine;
+    only the cursor loops are duplicated, since the AsyncMongoClient cursors are iterated and closed with await
+    and the sharding runs as tasks on the event loop instead of threads.
+    """
+
+    def __init__(self, engine: PlayAndGoEngine = None):
+        self.settings = engine if engine is not None else PlayAndGoEngine()
+        self._client = None
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+    def get_db(self):
+        """
+        Returns the P&G database, backed by the connection pool of the engine.
+        The client is bound to the event loop on which it is first used.
+        """
+        if self._client is None:
+            self._client = AsyncMongoClient(self.settings.mongo_uri, directConnection=self.settings.direct_connection,
+                                            maxPoolSize=self.settings.max_pool_size, minPoolSize=self.settings.min_pool_size)
+        return self._client[self.settings.mongo_db]
+
+
+    async def get_campaigns(self, territory_id: str) -> list:
+        return list((await self.get_campaign_map(territory_id)).values())
+
+
+    async def get_campaign_map(self, territory_id: str) -> dict:
+        """Returns the campaign _id -> campaign map, sharing the campaign cache of the engine."""
+        campaign_map = self.settings.get_cached_campaign_map(territory_id)
+        if campaign_map is None:
+            collection = self.get_db()["campaigns"]
+            cursor = collection.find(get_campaigns_query(territory_id))
+            campaign_map = {}
+            try:
+                async for campaign in cursor:
+                    add_campaign(campaign_map, campaign)
+            finally:
+                await cursor.close()
+            self.settings.set_cached_campaign_map(territory_id, campaign_map)
+        return campaign_map
+
+
+    async def get_track(self, territory_id: str, track_id: str):
+        collection = self.get_db()["trackedInstances"]
+        track = await collection.find_one(get_track_query(territory_id, track_id))
+        if is_valid_track(track):
+            return track
+        return None
+
+
+    async def get_tracks(self, territory_id: str, start_time: str, end_time: str = None, mode: str = None,
+                         projection: dict = TRACK_PROJECTION, batch_size: int = None, shards: int = None, ordered: bool = None,
+                         track_ids: set = None):
+        """
+        Async iterator over the valid tracked instances, see PlayAndGoEngine.get_tracks.
+        """
+        partitions = get_track_partitions(start_time, end_time, shards or self.settings.shards, track_ids, self.settings.in_chunk_size)
+        # statistiche sommate su tutte le partizioni e registrate una volta sola
+        stats = TransferStats(f"get_tracks async Territory ID: {territory_id}, Mode: {mode}, Start Time: {start_time}, End Time: {end_time}")
+        fetchers = [partial(self._find_tracks, territory_id, condition, mode, projection, batch_size, chunk, stats)
+                    for condition, chunk in partitions]
+        if len(fetchers) == 0:
+            return
+        try:
+            async for track in aiter_sharded(fetchers, self.settings.shard_ordered if ordered is None else ordered):
+                yield track
+        finally:
+            stats.log()
+
+
+    async def _find_tracks(self, territory_id: str, start_time_condition: dict, mode: str = None,
+                           projection: dict = TRACK_PROJECTION, batch_size: int = None, track_ids: list = None,
+                           stats: TransferStats = None):
+        db = self.get_db()
+        collection = db["trackedInstances"].with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        query = get_tracks_query(territory_id, start_time_condition, mode, track_ids)
+        cursor = collection.find(query, projection, batch_size=batch_size or self.settings.batch_size)
+        try:
+            async for raw_track in cursor:
+                if stats is not None:
+                    stats.add(raw_track)
+                yield decode(raw_track.raw, db.codec_options)
+        finally:
+            await cursor.close()
+
+
+    async def get_campaign_tracks(self, territory_id: str, start_time: str, end_time: str = None,
+                                  shards: int = None, ordered: bool = None):
+        """
+        Async iterator over the valid campaign tracks, see PlayAndGoEngine.get_campaign_tracks.
+        """
+        campaign_map = await self.get_campaign_map(territory_id)
+
+        conditions = get_time_partitions(start_time, end_time, shards or self.settings.shards)
+        fetchers = [partial(self._find_campaign_tracks, territory_id, campaign_map, condition) for condition in conditions]
+        async for row in aiter_sharded(fetchers, self.settings.shard_ordered if ordered is None else ordered):
+            yield CampaignTrack(*row)
+
+
+    async def _find_campaign_tracks(self, territory_id: str, campaign_map: dict, start_time_condition: dict):
+        collection = self.get_db()["campaignPlayerTracks"]
+        cursor = collection.find(get_campaign_tracks_query(territory_id, start_time_condition), batch_size=self.settings.batch_size)
+        try:
+            async for track in cursor:
+                row = get_campaign_track_row(territory_id, campaign_map, track)
+                if row is not None:
+                    yield row
+        finally:
+            await cursor.close()
@@ -0,0 +1,201 @@
+import os
+import gzip
+import struct
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from bson import decode_all, json_util
+
+from playandgo.pg_engine import CampaignTrack, get_campaign_track_row, get_non_personal_campaign_ids, iter_record_batches
+from storage.storage_engine import FileStorage
+
+logger = logging.getLogger(__name__)
+
+
+def get_naive_utc_datetime(dt):
+    """BSON dates are decoded as naive UTC datetimes: aware datetimes are converted to the same form."""
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def open_dump(file_path: str):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    return open(file_path, "rb")
+
+
+def is_bson_dump(file_path: str) -> bool:
+    return file_path.endswith(".bson") or file_path.endswith(".bson.gz")
+
+
+def read_bson_chunks(file, chunk_size: int):
+    """Splits a mongodump .bson file into chunks of whole documents, using the length prefix of each document."""
+    chunk = bytearray()
+    while True:
+        header = file.read(4)
+        if len(header) < 4:
+            break
+        size = struct.unpack("<i", header)[0]
+        chunk += header
+        chunk += file.read(size - 4)
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+
+def read_line_chunks(file, chunk_size: int):
+    """Splits an extended-JSON lines file into chunks of whole lines."""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        # completa l'ultima riga del chunk
+        chunk += file.readline()
+        yield chunk
+
+
+def match_document(doc: dict, territory_id: str, valid_field: str, start_time: datetime, end_time: datetime, mode: str,
+                   track_ids: set = None) -> bool:
+    """Applies in Python the same filter of the MongoDB track queries (see get_tracks_query)."""
+    if doc.get("territoryId") != territory_id:
+        return False
+    if track_ids is not None and str(doc.get("_id")) not in track_ids:
+        return False
+    valid = doc
+    for key in valid_field.split("."):
+        valid = valid.get(key) if isinstance(valid, dict) else None
+    if valid is not True:
+        return False
+    doc_start_time = get_naive_utc_datetime(doc.get("startTime"))
+    if doc_start_time is None or doc_start_time <= start_time:
+        return False
+    if end_time is not None and doc_start_time >= end_time:
+        return False
+    if isinstance(mode, (list, tuple)):
+        if doc.get("freeTrackingTransport") not in mode:
+            return False
+    elif mode is not None and doc.get("freeTrackingTransport") != mode:
+        return False
+    return True
+
+
+def parse_chunk(chunk: bytes, bson_format: bool, territory_id: str, valid_field: str,
+                start_time: datetime, end_time: datetime, mode: str, track_ids: set = None) -> list:
+    """Worker process: decodes a chunk of the dump and returns the matching documents."""
+    if bson_format:
+        docs = decode_all(chunk)
+    else:
+        docs = [json_util.loads(line) for line in chunk.splitlines() if line.strip()]
+    return [doc for doc in docs if match_document(doc, territory_id, valid_field, start_time, end_time, mode, track_ids)]
+
+
+class DumpTrackSource:
+    """
+    Reads trackedInstances / campaignPlayerTracks exports (mongodump .bson or extended-JSON lines,
+    optionally gzipped) and exposes the same track methods of PlayAndGoEngine, so that the imports
+    can backfill from snapshots instead of the production database.
+    The files are split into chunks decoded and filtered in parallel worker processes.
+    """
+
+    def __init__(self, tracks_path: str = None, campaign_tracks_path: str = None, campaigns_path: str = None):
+        self.tracks_path = tracks_path
+        self.campaign_tracks_path = campaign_tracks_path
+        self.campaigns_path = campaigns_path
+        self.workers = int(os.getenv("DUMP_WORKERS", "0")) or os.cpu_count()
+        self.chunk_size = int(os.getenv("DUMP_CHUNK_MB", "16")) * 1024 * 1024
+        self.batch_size = int(os.getenv("PG_MONGO_BATCH_SIZE", "500"))
+
+
+    def iter_dump(self, file_path: str, territory_id: str, valid_field: str, start_time: str,
+                  end_time: str = None, mode: str = None, track_ids: set = None):
+        if file_path is None:
+            raise ValueError("Dump file not configured")
+        start = datetime.now()
+        start_time_dt = get_naive_utc_datetime(datetime.fromisoformat(start_time))
+        end_time_dt = get_naive_utc_datetime(datetime.fromisoformat(end_time)) if end_time is not None else None
+        bson_format = is_bson_dump(file_path)
+        parse = partial(parse_chunk, bson_format=bson_format, territory_id=territory_id, valid_field=valid_field,
+                        start_time=start_time_dt, end_time=end_time_dt, mode=mode, track_ids=track_ids)
+        count = 0
+        with open_dump(file_path) as file, ProcessPoolExecutor(max_workers=self.workers) as executor:
+            chunks = read_bson_chunks(file, self.chunk_size) if bson_format else read_line_chunks(file, self.chunk_size)
+            # al massimo due chunk in coda per worker, restituiti nell'ordine del file
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(parse, chunk))
+                if len(pending) >= self.workers * 2:
+                    for doc in pending.pop(0).result():
+                        count += 1
+                        yield doc
+            for future in pending:
+                for doc in future.result():
+                    count += 1
+                    yield doc
+        stop = datetime.now()
+        logger.info(f"Dump {file_path} Territory ID: {territory_id}, Mode: {mode}, Documents: {count}, Time:{(stop - start).total_seconds()} seconds")
+
+
+    def get_tracks(self, territory_id: str, start_time: str, end_time: str = None, mode: str = None, 
+                   track_ids: set = None, **kwargs):
+        """
+        Yields the valid tracked instances of the dump, see PlayAndGoEngine.get_tracks.
+        Whole documents are returned: projection, batching and sharding options are ignored.
+        """
+        yield from self.iter_dump(self.tracks_path, territory_id, "validationResult.valid", start_time, end_time, mode, 
+                                  None if track_ids is None else set(track_ids))
+
+
+    def get_campaign_track_ids(self, territory_id: str, start_time: str, end_time: str = None) -> set:
+        """See PlayAndGoEngine.get_campaign_track_ids, read from the campaign tracks dump."""
+        campaign_ids = set(get_non_personal_campaign_ids(self.get_campaign_map(territory_id)))
+        track_ids = set()
+        for track in self.iter_dump(self.campaign_tracks_path, territory_id, "valid", start_time, end_time):
+            if track["campaignId"] in campaign_ids:
+                track_ids.add(track["trackedInstanceId"])
+        return track_ids
+
+
+    def get_campaign_map(self, territory_id: str) -> dict:
+        """
+        Returns the campaign _id -> campaign map from the campaigns dump if configured,
+        otherwise from the campaigns already imported in the storage.
+        """
+        campaign_map = {}
+        if self.campaigns_path is not None:
+            bson_format = is_bson_dump(self.campaigns_path)
+            with open_dump(self.campaigns_path) as file:
+                chunks = read_bson_chunks(file, self.chunk_size) if bson_format else read_line_chunks(file, self.chunk_size)
+                for chunk in chunks:
+                    docs = decode_all(chunk) if bson_format else [json_util.loads(line) for line in chunk.splitlines() if line.strip()]
+                    for campaign in docs:
+                        if campaign.get("territoryId") == territory_id:
+                            campaign_map[str(campaign["_id"])] = campaign
+        else:
+            file_storage = FileStorage()
+            size, df_campaigns = file_storage.load_dataframe(territory_id, file_storage.campaigns)
+            for campaign_id, campaign_type in zip(df_campaigns['campaign_id'], df_campaigns['type']):
+                campaign_map[campaign_id] = {"type": campaign_type}
+        return campaign_map
+
+
+    def get_campaign_tracks(self, territory_id: str, start_time: str, end_time: str = None, **kwargs):
+        for row in self._iter_campaign_track_rows(territory_id, start_time, end_time):
+            yield CampaignTrack(*row)
+
+
+    def get_campaign_tracks_batches(self, territory_id: str, start_time: str, end_time: str = None,
+                                    batch_size: int = None, **kwargs):
+        rows = self._iter_campaign_track_rows(territory_id, start_time, end_time)
+        yield from iter_record_batches(rows, CampaignTrack.arrow_schema, batch_size or self.batch_size)
+
+
+    def _iter_campaign_track_rows(self, territory_id: str, start_time: str, end_time: str = None):
+        campaign_map = self.get_campaign_map(territory_id)
+        for track in self.iter_dump(self.campaign_tracks_path, territory_id, "valid", start_time, end_time):
+            row = get_campaign_track_row(territory_id, campaign_map, track)
+            if row is not None:
+                yield row
@@ -1,8 +1,32 @@
 import os
-from datetime import timezone
+import time
+import queue
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone, timedelta
+import pyarrow as pa
 from pymongo import MongoClient
 from datetime import datetime
+from bson import decode
+from bson.codec_options import CodecOptions
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+logger = logging.getLogger(__name__)
+
+# campi di trackedInstances effettivamente usati da import_tracks_data (extract_track_data_osm / extract_track_data_h3)
+TRACK_PROJECTION = {
+    "userId": 1,
+    "multimodalId": 1,
+    "freeTrackingTransport": 1,
+    "startTime": 1,
+    "validationResult.valid": 1,
+    "geolocationEvents.longitude": 1,
+    "geolocationEvents.latitude": 1,
+    "geolocationEvents.recorded_at": 1,
+}
 
 
 def get_utc_datetime(dt):
@@ -36,7 +60,275 @@ def get_company_subscription(user, campaign_id:str):
     return None
 
 
+def get_tracks_query(territory_id: str, start_time_condition: dict, mode = None, track_ids: list = None) -> dict:
+    """
+    Builds the trackedInstances query for the valid tracks started in the given startTime condition.
+    mode can be a single freeTrackingTransport or a list of them; track_ids restricts the query to the given ids.
+    """
+    query = {"territoryId":territory_id, "validationResult.valid": True, "startTime": start_time_condition}
+    if isinstance(mode, (list, tuple)):
+        query["freeTrackingTransport"] = {"$in": list(mode)}
+    elif mode is not None:
+        query["freeTrackingTransport"] = mode
+    if track_ids is not None:
+        query["_id"] = {"$in": [ObjectId(track_id) for track_id in track_ids]}
+    return query
+
+
+def get_track_query(territory_id: str, track_id: str) -> dict:
+    return {"territoryId": territory_id, "_id": ObjectId(track_id)}
+
+
+def is_valid_track(track: dict) -> bool:
+    return bool(track and "validationResult" in track and "valid" in track["validationResult"] 
+                and track["validationResult"]["valid"] is True)
+
+
+def get_campaigns_query(territory_id: str) -> dict:
+    return {"territoryId": territory_id}
+
+
+def get_campaign_tracks_query(territory_id: str, start_time_condition: dict) -> dict:
+    return {"territoryId": territory_id, "startTime": start_time_condition}
+
+
+def add_campaign(campaign_map: dict, campaign: dict):
+    """Adds a campaigns document to the campaign _id -> campaign map."""
+    campaign_map[str(campaign["_id"])] = campaign
+
+
+def get_track_partitions(start_time: str, end_time: str, shards: int, track_ids: set, chunk_size: int) -> list:
+    """
+    Returns the (startTime condition, track id chunk) pairs read by the shards of a get_tracks call.
+    """
+    return [(condition, chunk) for condition in get_time_partitions(start_time, end_time, shards)
+            for chunk in get_track_id_chunks(track_ids, chunk_size)]
+
+
+def get_track_id_chunks(track_ids, chunk_size: int) -> list:
+    """
+    Splits the track ids in chunks for the $in queries, [None] (no restriction) if track_ids is None.
+    Ids that are not valid ObjectIds cannot match a tracked instance and are dropped.
+    """
+    if track_ids is None:
+        return [None]
+    track_ids = sorted(track_id for track_id in track_ids if ObjectId.is_valid(track_id))
+    return [track_ids[i:i + chunk_size] for i in range(0, len(track_ids), chunk_size)]
+
+
+def get_non_personal_campaign_ids(campaign_map: dict) -> list:
+    """Returns the ids of the campaigns that reach the analyses (all but the personal ones)."""
+    return [campaign_id for campaign_id, campaign in campaign_map.items() if campaign["type"] != "personal"]
+
+
+def get_campaign_track_row(territory_id: str, campaign_map: dict, track: dict) -> tuple:
+    """
+    Converts a campaignPlayerTracks document to a row ordered as CampaignTrack.arrow_schema,
+    None if the track is not valid or its campaign is not in campaign_map.
+    """
+    campaign_id = track["campaignId"]
+    if campaign_id not in campaign_map:
+        return None
+    if not "modeType" in track:
+        return None
+    if track["valid"] is not True:
+        return None
+    return (territory_id, track["playerId"], track["trackedInstanceId"], campaign_id, campaign_map[campaign_id]["type"],
+            track["startTime"], track["endTime"], track["modeType"], track["valid"], track["distance"], track["duration"])
+
+
+def get_change_stream_pipeline(territory_id: str, valid_field: str, projection: dict = None) -> list:
+    """
+    Builds the change stream pipeline for the documents of the territory that are valid after the change:
+    inserts and replaces of valid documents, and updates that touched the valid_field path.
+    """
+    validation_root = valid_field.split(".")[0]
+    pipeline = [
+        {"$match": {
+            "operationType": {"$in": ["insert", "update", "replace"]},
+            "fullDocument.territoryId": territory_id,
+            f"fullDocument.{valid_field}": True,
+        }},
+        # negli update i campi modificati sono chiavi con path puntato (es. "validationResult.valid")
+        {"$match": {"$expr": {"$or": [
+            {"$ne": ["$operationType", "update"]},
+            {"$gt": [{"$size": {"$filter": {
+                "input": {"$objectToArray": {"$ifNull": ["$updateDescription.updatedFields", {}]}},
+                "cond": {"$regexMatch": {"input": "$$this.k", "regex": f"^{validation_root}(\\.|$)"}},
+            }}}, 0]},
+        ]}}},
+    ]
+    if projection is not None:
+        fields = {"_id": 1, "operationType": 1, "fullDocument._id": 1}
+        for field in projection:
+            fields[f"fullDocument.{field}"] = 1
+        pipeline.append({"$project": fields})
+    return pipeline
+
+
+def get_utc_bound(dt: datetime) -> datetime:
+    """Aware UTC datetime of a query bound, the naive ones are taken as UTC (as stored by MongoDB)."""
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def get_time_partitions(start_time: str, end_time: str = None, shards: int = 1) -> list[dict]:
+    """
+    Splits the (start_time, end_time) window into contiguous startTime conditions, one per shard.
+    The first partition keeps the exclusive lower bound of the window; without end_time the
+    partitions are computed up to now and the last one stays open-ended.
+    The bounds can mix naive and aware datetimes: all of them are converted to UTC.
+    """
+    start_time_dt = get_utc_bound(datetime.fromisoformat(start_time))
+    end_time_dt = get_utc_bound(datetime.fromisoformat(end_time)) if end_time is not None else None
+    upper_dt = end_time_dt if end_time_dt is not None else datetime.now(timezone.utc)
+    if shards <= 1 or upper_dt <= start_time_dt:
+        shards = 1
+    else:
+        # i datetime di MongoDB hanno precisione al millisecondo: niente partizioni vuote sulle finestre brevi
+        shards = max(1, min(shards, (upper_dt - start_time_dt) // timedelta(milliseconds=1)))
+    step = (upper_dt - start_time_dt) / shards
+    bounds = [start_time_dt + step * i for i in range(shards)] + [end_time_dt]
+    conditions = []
+    for i in range(shards):
+        condition = {"$gt": bounds[i]} if i == 0 else {"$gte": bounds[i]}
+        if i < shards - 1:
+            condition["$lt"] = bounds[i + 1]
+        elif end_time_dt is not None:
+            condition["$lt"] = end_time_dt
+        conditions.append(condition)
+    return conditions
+
+
+class _ShardError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_SHARD_DONE = object()
+
+
+def iter_sharded(fetchers: list, ordered: bool = True, max_workers: int = None, queue_size: int = 1000):
+    """
+    Runs each fetcher (a callable returning an iterator) on a thread pool and merges the results
+    into a single generator. With ordered=True the items of a shard are yielded only after all the
+    items of the previous shards, otherwise they are yielded as soon as they arrive.
+    Every shard buffers at most queue_size items.
+    """
+    if len(fetchers) == 1:
+        yield from fetchers[0]()
+        return
+
+    stop_event = threading.Event()
+    if ordered:
+        queues = [queue.Queue(maxsize=queue_size) for _ in fetchers]
+    else:
+        shared_queue = queue.Queue(maxsize=queue_size * len(fetchers))
+        queues = [shared_queue] * len(fetchers)
+
+    def put(out: queue.Queue, item) -> bool:
+        while not stop_event.is_set():
+            try:
+                out.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(fetcher, out: queue.Queue):
+        items = fetcher()
+        try:
+            for item in items:
+                if not put(out, item):
+                    return
+            put(out, _SHARD_DONE)
+        except Exception as e:
+            put(out, _ShardError(e))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(fetchers), thread_name_prefix="pg-shard")
+    try:
+        for fetcher, out in zip(fetchers, queues):
+            executor.submit(produce, fetcher, out)
+        pending = len(fetchers)
+        index = 0
+        while pending > 0:
+            item = queues[index].get()
+            if item is _SHARD_DONE:
+                pending -= 1
+                if ordered:
+                    index += 1
+            elif isinstance(item, _ShardError):
+                raise item.error
+            else:
+                yield item
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_record_batches(rows, schema: pa.Schema, batch_size: int):
+    """
+    Accumulates the rows (tuples ordered as the schema fields) column by column and
+    yields them as Arrow record batches of at most batch_size rows.
+    """
+    columns = [[] for _ in schema]
+    count = 0
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        count += 1
+        if count >= batch_size:
+            yield pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+            columns = [[] for _ in schema]
+            count = 0
+    if count > 0:
+        yield pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+
+class TransferStats:
+    """
+    Counts the documents and BSON bytes received from MongoDB by a single call, summed across its shards.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = 0
+        self.bytes = 0
+        self.start = datetime.now()
+        # le partizioni vengono lette in thread diversi
+        self.lock = threading.Lock()
+
+    def add(self, raw_doc: RawBSONDocument):
+        with self.lock:
+            self.documents += 1
+            self.bytes += len(raw_doc.raw)
+
+    def log(self):
+        elapsed = (datetime.now() - self.start).total_seconds()
+        logger.info(f"{self.name} Documents: {self.documents}, KB: {int(self.bytes / 1024)}, Time:{elapsed} seconds")
+
+    def __repr__(self):
+        return f"TransferStats(name={self.name}, documents={self.documents}, bytes={self.bytes})"
+
+
 class CampaignTrack:
+    # schema colonnare, nell'ordine dei parametri del costruttore
+    arrow_schema = pa.schema([
+        ("territory_id", pa.string()),
+        ("player_id", pa.string()),
+        ("track_id", pa.string()),
+        ("campaign_id", pa.string()),
+        ("campaign_type", pa.string()),
+        ("start_time", pa.timestamp("us", tz="UTC")),
+        ("end_time", pa.timestamp("us", tz="UTC")),
+        ("mode", pa.string()),
+        ("validation_result", pa.bool_()),
+        ("distance", pa.float64()),
+        ("duration", pa.float64()),
+    ])
+
     def __init__(self, territory_id, player_id, track_id, campaign_id, campaign_type, 
                  start_time, end_time, mode, validation_result, distance, duration):
         self.territory_id = territory_id
@@ -57,6 +349,14 @@ class CampaignTrack:
 
 
 class CampaignGroup:
+    # schema colonnare, nell'ordine dei parametri del costruttore
+    arrow_schema = pa.schema([
+        ("territory_id", pa.string()),
+        ("player_id", pa.string()),
+        ("campaign_id", pa.string()),
+        ("group_id", pa.string()),
+    ])
+
     def __init__(self, territory_id, player_id, campaign_id, group_id):
         self.group_id = group_id
         self.territory_id = territory_id
@@ -69,13 +369,25 @@ class CampaignGroup:
 
 
 class SpecificCampaingTrackInfo:
-    def __init__(self, territory_id, player_id, track_id, campaign_id, way_back, location_id):
+    # schema colonnare, nell'ordine dei parametri del costruttore
+    arrow_schema = pa.schema([
+        ("territory_id", pa.string()),
+        ("player_id", pa.string()),
+        ("track_id", pa.string()),
+        ("campaign_id", pa.string()),
+        ("way_back", pa.bool_()),
+        ("location_id", pa.string()),
+        ("start_time", pa.timestamp("us", tz="UTC")),
+    ])
+
+    def __init__(self, territory_id, player_id, track_id, campaign_id, way_back, location_id, start_time=None):
         self.territory_id = territory_id
         self.player_id = player_id
         self.track_id = track_id
         self.campaign_id = campaign_id
         self.way_back = way_back
         self.location_id = location_id 
+        self.start_time = start_time
 
     def __repr__(self):
         return f"SpecificCampaingTrackInfo(territory_id={self.territory_id}, player_id={self.player_id}, \
@@ -89,171 +401,359 @@ class PlayAndGoEngine:
         self.mongo_uri = os.getenv("PG_MONGO_URI", "mongodb://localhost:27017/")
         self.mongo_db = os.getenv("PG_MONGO_DB", "playngo-engine")
         self.direct_connection = eval(os.getenv("PG_MONGO_DIRECT_CONNECTION", "False"))
+        self.max_pool_size = int(os.getenv("PG_MONGO_MAX_POOL_SIZE", "20"))
+        self.min_pool_size = int(os.getenv("PG_MONGO_MIN_POOL_SIZE", "0"))
         # P&G Aziendale MongoDB connection settings
         self.company_mongo_uri = os.getenv("PG_COMPANY_MONGO_URI", "mongodb://localhost:27017/")
         self.company_mongo_db = os.getenv("PG_COMPANY_MONGO_DB", "pgaziendale-dev")
         self.company_direct_connection = eval(os.getenv("PG_COMPANY_MONGO_DIRECT_CONNECTION", "False"))
+        self.company_max_pool_size = int(os.getenv("PG_COMPANY_MONGO_MAX_POOL_SIZE", "10"))
+        self.company_min_pool_size = int(os.getenv("PG_COMPANY_MONGO_MIN_POOL_SIZE", "0"))
         # P&G HSC MongoDB connection settings
         self.hsc_mongo_uri = os.getenv("PG_HSC_MONGO_URI", "mongodb://localhost:27017/")
         self.hsc_mongo_db = os.getenv("PG_HSC_MONGO_DB", "pghsc-dev")
         self.hsc_direct_connection = eval(os.getenv("PG_HSC_MONGO_DIRECT_CONNECTION", "False"))
+        self.hsc_max_pool_size = int(os.getenv("PG_HSC_MONGO_MAX_POOL_SIZE", "10"))
+        self.hsc_min_pool_size = int(os.getenv("PG_HSC_MONGO_MIN_POOL_SIZE", "0"))
+        # numero di documenti per batch restituiti dal cursore
+        self.batch_size = int(os.getenv("PG_MONGO_BATCH_SIZE", "500"))
+        # lettura parallela: numero di partizioni della finestra temporale, thread e ordinamento dei risultati
+        self.shards = int(os.getenv("PG_MONGO_SHARDS", "1"))
+        self.shard_workers = int(os.getenv("PG_MONGO_SHARD_WORKERS", "0")) or None
+        self.shard_ordered = eval(os.getenv("PG_MONGO_SHARD_ORDERED", "True"))
+        # numero massimo di id per query $in
+        self.in_chunk_size = int(os.getenv("PG_MONGO_IN_CHUNK_SIZE", "1000"))
+        # attesa massima del server per un nuovo evento dei change stream
+        self.watch_max_await_ms = int(os.getenv("PG_MONGO_WATCH_MAX_AWAIT_MS", "1000"))
+        # cache delle campagne per territorio: durata in secondi (0 = disabilitata)
+        self.campaign_cache_ttl = float(os.getenv("PG_CAMPAIGN_CACHE_TTL", "300"))
+        self._campaign_cache_lock = threading.Lock()
+        self._campaign_cache = {}
+        # client condivisi, creati alla prima richiesta e riusati tra chiamate e thread
+        self._client_lock = threading.Lock()
+        self._client = None
+        self._company_client = None
+        self._hsc_client = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """
+        Closes the pooled MongoDB clients. A closed engine can be reused: the clients are recreated on demand.
+        """
+        with self._client_lock:
+            for client in (self._client, self._company_client, self._hsc_client):
+                if client is not None:
+                    client.close()
+            self._client = None
+            self._company_client = None
+            self._hsc_client = None
+
+
+    def get_db(self):
+        """
+        Returns the P&G database, backed by the shared connection pool.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = MongoClient(self.mongo_uri, directConnection=self.direct_connection,
+                                               maxPoolSize=self.max_pool_size, minPoolSize=self.min_pool_size)
+        return self._client[self.mongo_db]
+
+
+    def get_company_db(self):
+        """
+        Returns the P&G Aziendale database, backed by the shared connection pool.
+        """
+        if self._company_client is None:
+            with self._client_lock:
+                if self._company_client is None:
+                    self._company_client = MongoClient(self.company_mongo_uri, directConnection=self.company_direct_connection,
+                                                       maxPoolSize=self.company_max_pool_size, minPoolSize=self.company_min_pool_size)
+        return self._company_client[self.company_mongo_db]
+
+
+    def get_hsc_db(self):
+        """
+        Returns the P&G HSC database, backed by the shared connection pool.
+        """
+        if self._hsc_client is None:
+            with self._client_lock:
+                if self._hsc_client is None:
+                    self._hsc_client = MongoClient(self.hsc_mongo_uri, directConnection=self.hsc_direct_connection,
+                                                   maxPoolSize=self.hsc_max_pool_size, minPoolSize=self.hsc_min_pool_size)
+        return self._hsc_client[self.hsc_mongo_db]
 
 
     def get_campaigns(self, territory_id: str):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-
-        # Seleziona il database
-        db = client[self.mongo_db]
+        """
+        Returns the campaigns of the territory, served from the campaign cache.
+        """
+        return list(self.get_campaign_map(territory_id).values())
+
+
+    def get_campaign_map(self, territory_id: str) -> dict:
+        """
+        Returns the campaign _id -> campaign map of the territory. The map is cached for
+        PG_CAMPAIGN_CACHE_TTL seconds and shared across calls and threads: do not modify it.
+        """
+        campaign_map = self.get_cached_campaign_map(territory_id)
+        if campaign_map is None:
+            # Seleziona il database dal pool condiviso
+            db = self.get_db()
+
+            # Seleziona la collection
+            collection = db["campaigns"]
+
+            # Ottieni un cursore per tutti i documenti della collection
+            cursor = collection.find(get_campaigns_query(territory_id))
+            campaign_map = {}
+            try:
+                for campaign in cursor:
+                    add_campaign(campaign_map, campaign)
+            finally:
+                cursor.close()
+            self.set_cached_campaign_map(territory_id, campaign_map)
+        return campaign_map
+
+
+    def get_cached_campaign_map(self, territory_id: str) -> dict:
+        """Returns the cached campaign map of the territory, None if missing or expired."""
+        with self._campaign_cache_lock:
+            entry = self._campaign_cache.get(territory_id)
+            if entry is None:
+                return None
+            expires_at, campaign_map = entry
+            if time.monotonic() >= expires_at:
+                del self._campaign_cache[territory_id]
+                return None
+            return campaign_map
+
+
+    def set_cached_campaign_map(self, territory_id: str, campaign_map: dict):
+        if self.campaign_cache_ttl <= 0:
+            return
+        with self._campaign_cache_lock:
+            self._campaign_cache[territory_id] = (time.monotonic() + self.campaign_cache_ttl, campaign_map)
+
+
+    def invalidate_campaigns(self, territory_id: str = None):
+        """
+        Drops the cached campaigns of the territory, or of all the territories if territory_id is None.
+        """
+        with self._campaign_cache_lock:
+            if territory_id is None:
+                self._campaign_cache.clear()
+            else:
+                self._campaign_cache.pop(territory_id, None)
 
-        # Seleziona la collection
-        collection = db["campaigns"]
 
-        # Ottieni un cursore per tutti i documenti della collection
-        cursor = collection.find({"territoryId":territory_id})
-        # Restituisce la lista delle campagne
-        campaigns = []
-        for campaign in cursor:
-            campaigns.append(campaign)
-        cursor.close()
-        client.close()  
-        return campaigns
-    
-    
     def get_track(self, territory_id: str, track_id: str):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-
-        # Seleziona il database
-        db = client[self.mongo_db]
+        # Seleziona il database dal pool condiviso
+        db = self.get_db()
 
         # Seleziona la collection
         collection = db["trackedInstances"]
 
         # Ottieni il documento specifico per track_id
-        track = collection.find_one({"territoryId": territory_id, "_id": ObjectId(track_id)})
-
-        client.close()
+        track = collection.find_one(get_track_query(territory_id, track_id))
 
-        if track and "validationResult" in track and "valid" in track["validationResult"] and track["validationResult"]["valid"] is True:
+        if is_valid_track(track):
             return track
         return None
 
 
-    def get_tracks(self, territory_id: str, start_time: str, end_time: str = None, mode: str = None):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-
-        # Seleziona il database
-        db = client[self.mongo_db]
-
-        # Seleziona la collection
-        collection = db["trackedInstances"]
-
-        query = {"territoryId":territory_id}
-
-        start_time_dt = datetime.fromisoformat(start_time)
-        if end_time is not None:
-            end_time_dt = datetime.fromisoformat(end_time)
-            query["startTime"] = {"$gt": start_time_dt, "$lt": end_time_dt}
-        else:
-            query["startTime"] = {"$gt": start_time_dt}
-
-        if mode is not None:
-            query["freeTrackingTransport"] = mode
+    def get_tracks(self, territory_id: str, start_time: str, end_time: str = None, mode: str = None,
+                   projection: dict = TRACK_PROJECTION, batch_size: int = None, shards: int = None, ordered: bool = None,
+                   track_ids: set = None):
+        """
+        Yields the valid tracked instances of the territory started in the given time window.
+        Invalid tracks are filtered by the query and only the fields in projection are transferred
+        (pass projection=None to get whole documents). With shards > 1 the window is split into
+        partitions read concurrently (see iter_sharded for the ordering guarantees).
+        With track_ids only the given tracks are read, with $in queries of PG_MONGO_IN_CHUNK_SIZE ids.
+        """
+        partitions = get_track_partitions(start_time, end_time, shards or self.shards, track_ids, self.in_chunk_size)
+        # statistiche sommate su tutte le partizioni e registrate una volta sola
+        stats = TransferStats(f"get_tracks Territory ID: {territory_id}, Mode: {mode}, Start Time: {start_time}, End Time: {end_time}")
+        fetchers = [partial(self._find_tracks, territory_id, condition, mode, projection, batch_size, chunk, stats) 
+                    for condition, chunk in partitions]
+        if len(fetchers) == 0:
+            return
+        try:
+            yield from iter_sharded(fetchers, self.shard_ordered if ordered is None else ordered, self.shard_workers)
+        finally:
+            stats.log()
+
+
+    def _find_tracks(self, territory_id: str, start_time_condition: dict, mode: str = None, 
+                     projection: dict = TRACK_PROJECTION, batch_size: int = None, track_ids: list = None,
+                     stats: TransferStats = None):
+        # Seleziona il database dal pool condiviso
+        db = self.get_db()
+
+        # Seleziona la collection, leggendo i documenti come BSON grezzo per contare i byte ricevuti
+        collection = db["trackedInstances"].with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+
+        query = get_tracks_query(territory_id, start_time_condition, mode, track_ids)
         
         # Ottieni un cursore per tutti i documenti della collection
-        cursor = collection.find(query, batch_size=10)
-        # Itera sui documenti
-        for track in cursor:
-            #get only valid docuemt
-            if "validationResult" in track and "valid" in track["validationResult"] and track["validationResult"]["valid"] is True:
-                yield track
-        cursor.close()
-        client.close()
-
-
-    def get_campaign_tracks(self, territory_id: str, start_time: str, end_time: str = None):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-
-        # Seleziona il database
-        db = client[self.mongo_db]
-
-        # estrae le campagne
-        campaign_collection = db["campaigns"]
-        campaign_cursor = campaign_collection.find({"territoryId":territory_id})
-        campaign_map = {}
-        for campaign in campaign_cursor:
-            campaign_map[str(campaign["_id"])] = campaign
-
+        cursor = collection.find(query, projection, batch_size=batch_size or self.batch_size)
+        try:
+            # Itera sui documenti
+            for raw_track in cursor:
+                if stats is not None:
+                    stats.add(raw_track)
+                yield decode(raw_track.raw, db.codec_options)
+        finally:
+            cursor.close()
+
+
+    def get_campaign_track_ids(self, territory_id: str, start_time: str, end_time: str = None) -> set:
+        """
+        Returns the ids of the tracked instances referenced by the valid campaignPlayerTracks of the
+        non-personal campaigns started in the given time window, the only tracks used by the analyses.
+        """
+        start = datetime.now()
+        campaign_ids = get_non_personal_campaign_ids(self.get_campaign_map(territory_id))
+        collection = self.get_db()["campaignPlayerTracks"]
+        track_ids = set()
+        for condition in get_time_partitions(start_time, end_time):
+            query = {"territoryId":territory_id, "campaignId": {"$in": campaign_ids}, "valid": True, "startTime": condition}
+            cursor = collection.find(query, {"_id": 0, "trackedInstanceId": 1}, batch_size=self.batch_size)
+            try:
+                for track in cursor:
+                    track_ids.add(track["trackedInstanceId"])
+            finally:
+                cursor.close()
+        stop = datetime.now()
+        logger.info(f"get_campaign_track_ids Territory ID: {territory_id}, Tracks: {len(track_ids)}, Time:{(stop - start).total_seconds()} seconds")
+        return track_ids
+
+
+    def get_campaign_tracks(self, territory_id: str, start_time: str, end_time: str = None, 
+                            shards: int = None, ordered: bool = None):
+        for row in self._iter_campaign_track_rows(territory_id, start_time, end_time, shards, ordered):
+            yield CampaignTrack(*row)
+
+
+    def get_campaign_tracks_batches(self, territory_id: str, start_time: str, end_time: str = None, 
+                                    shards: int = None, ordered: bool = None, batch_size: int = None):
+        """
+        Columnar variant of get_campaign_tracks: yields Arrow record batches with CampaignTrack.arrow_schema.
+        """
+        rows = self._iter_campaign_track_rows(territory_id, start_time, end_time, shards, ordered)
+        yield from iter_record_batches(rows, CampaignTrack.arrow_schema, batch_size or self.batch_size)
+
+
+    def _iter_campaign_track_rows(self, territory_id: str, start_time: str, end_time: str = None, 
+                                  shards: int = None, ordered: bool = None):
+        # estrae le campagne dalla cache
+        campaign_map = self.get_campaign_map(territory_id)
+
+        conditions = get_time_partitions(start_time, end_time, shards or self.shards)
+        fetchers = [partial(self._find_campaign_tracks, territory_id, campaign_map, condition) for condition in conditions]
+        yield from iter_sharded(fetchers, self.shard_ordered if ordered is None else ordered, self.shard_workers)
+
+
+    def _find_campaign_tracks(self, territory_id: str, campaign_map: dict, start_time_condition: dict):
         # Seleziona la collection
-        collection = db["campaignPlayerTracks"]
+        collection = self.get_db()["campaignPlayerTracks"]
 
         # Ottieni un cursore per tutti i documenti della collection
-        start_time_dt = datetime.fromisoformat(start_time)
-        if end_time is not None:
-            end_time_dt = datetime.fromisoformat(end_time)
-            cursor = collection.find({"territoryId":territory_id, "startTime":{"$gt":start_time_dt, "$lt":end_time_dt}})
-        else:
-            cursor = collection.find({"territoryId":territory_id, "startTime":{"$gt":start_time_dt}})
-
-        # Itera sui documenti
-        for track in cursor:
-            campaign_id = track["campaignId"]
-            if campaign_id in campaign_map:
-                campaign = campaign_map[campaign_id]
-                if not "modeType" in track:
-                    continue
-                if track["valid"] is not True:
-                    continue
-                c_track = CampaignTrack(
-                    territory_id=territory_id,
-                    player_id=track["playerId"],
-                    track_id=track["trackedInstanceId"],
-                    campaign_id=campaign_id,
-                    campaign_type=campaign["type"],
-                    start_time=track["startTime"],
-                    end_time=track["endTime"],
-                    mode=track["modeType"],
-                    validation_result=track["valid"],
-                    distance=track["distance"],
-                    duration=track["duration"]
-                )
-                yield c_track
-        client.close()
+        cursor = collection.find(get_campaign_tracks_query(territory_id, start_time_condition), batch_size=self.batch_size)
+
+        # Itera sui documenti, restituendo le righe nell'ordine di CampaignTrack.arrow_schema
+        try:
+            for track in cursor:
+                row = get_campaign_track_row(territory_id, campaign_map, track)
+                if row is not None:
+                    yield row
+        finally:
+            cursor.close()
+
+
+    def watch_tracks(self, territory_id: str, resume_after: dict = None, projection: dict = TRACK_PROJECTION):
+        """
+        Opens a change stream on trackedInstances returning the tracks of the territory when they become valid.
+        Each change carries the track in fullDocument (restricted to projection) and its resume token in _id.
+        Requires a replica set (a single-node one is enough).
+        """
+        collection = self.get_db()["trackedInstances"]
+        pipeline = get_change_stream_pipeline(territory_id, "validationResult.valid", projection)
+        return collection.watch(pipeline, full_document="updateLookup", resume_after=resume_after,
+                                batch_size=self.batch_size, max_await_time_ms=self.watch_max_await_ms)
+
+
+    def watch_campaign_tracks(self, territory_id: str, resume_after: dict = None):
+        """
+        Opens a change stream on campaignPlayerTracks returning the campaign tracks of the territory when they become valid.
+        """
+        collection = self.get_db()["campaignPlayerTracks"]
+        pipeline = get_change_stream_pipeline(territory_id, "valid")
+        return collection.watch(pipeline, full_document="updateLookup", resume_after=resume_after,
+                                batch_size=self.batch_size, max_await_time_ms=self.watch_max_await_ms)
 
 
     def get_campaign_groups(self, territory_id: str):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-        # Seleziona il database
-        db = client[self.mongo_db]
-
-        # estrae le campagne
-        campaign_collection = db["campaigns"]
-        campaign_cursor = campaign_collection.find({"territoryId":territory_id})
-        for campaign in campaign_cursor:
+        for row in self._iter_campaign_group_rows(territory_id):
+            yield CampaignGroup(*row)
+
+
+    def get_campaign_groups_batches(self, territory_id: str, batch_size: int = None):
+        """
+        Columnar variant of get_campaign_groups: yields Arrow record batches with CampaignGroup.arrow_schema.
+        """
+        rows = self._iter_campaign_group_rows(territory_id)
+        yield from iter_record_batches(rows, CampaignGroup.arrow_schema, batch_size or self.batch_size)
+
+
+    def _iter_campaign_group_rows(self, territory_id: str):
+        # estrae le campagne dalla cache
+        for campaign_id, campaign in self.get_campaign_map(territory_id).items():
             if campaign["type"] == "company":
-                for c_group in self.get_company_group_info(territory_id, str(campaign["_id"])):
-                    yield c_group    
+                yield from self._find_company_groups(territory_id, campaign_id)
             elif campaign["type"] == "school":
-                for c_group in self.get_hsc_group_info(territory_id, str(campaign["_id"])):
-                    yield c_group
+                yield from self._find_hsc_groups(territory_id, campaign_id)
             elif (campaign["type"] == "personal") or (campaign["type"] == "city"):
-                for c_group in self.get_basic_campaign_info(territory_id, str(campaign["_id"])):
-                    yield c_group
-        campaign_cursor.close()
-
-        client.close()
+                yield from self._find_basic_groups(territory_id, campaign_id)
 
 
     def get_basic_campaign_info(self, territory_id: str, campaign_id: str):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
+        for row in self._find_basic_groups(territory_id, campaign_id):
+            yield CampaignGroup(*row)
+
+
+    def get_company_group_info(self, territory_id: str, campaign_id: str):
+        """
+        Yields the company of every user registered to the campaign whose employee record
+        tracks the campaign. Users and employees are joined on the server by the
+        companyCode__employeeCode key and only (playerId, companyCode) pairs are returned.
+        """
+        for row in self._find_company_groups(territory_id, campaign_id):
+            yield CampaignGroup(*row)
+
+
+    def get_hsc_group_info(self, territory_id: str, campaign_id: str):
+        """
+        Yields the team of every member of the campaign initiatives.
+        Teams and members are resolved on the server with a single aggregation.
+        """
+        for row in self._find_hsc_groups(territory_id, campaign_id):
+            yield CampaignGroup(*row)
+
 
-        # Seleziona il database
-        db = client[self.mongo_db]
+    def _find_basic_groups(self, territory_id: str, campaign_id: str):
+        # Seleziona il database dal pool condiviso
+        db = self.get_db()
 
         # Seleziona la collection
         collection = db["campaignSubscriptions"]
@@ -261,152 +761,157 @@ class PlayAndGoEngine:
         # Ottieni il documento specifico per campaign_id
         sub_cursor = collection.find({"territoryId": territory_id, "campaignSubscriptions": campaign_id})
         for sub in sub_cursor:
-            c_group = CampaignGroup(
-                territory_id=territory_id,
-                player_id=sub["playerId"],
-                campaign_id=campaign_id,
-                group_id="-1"  # no group id for personal and city campaigns
-            )
-            yield c_group
+            yield (territory_id, sub["playerId"], campaign_id, "-1")  # no group id for personal and city campaigns
         sub_cursor.close()
-        client.close()
 
 
-    def get_company_group_info(self, territory_id: str, campaign_id: str):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.company_mongo_uri, directConnection=self.company_direct_connection)
-
-        # Seleziona il database
-        db = client[self.company_mongo_db]
+    def _find_company_groups(self, territory_id: str, campaign_id: str):
+        # Seleziona il database dal pool condiviso
+        db = self.get_company_db()
 
-        employee_collection = db["employee"]
         user_collection = db["user"]
 
-        # estrale le company
-        company_map = {}
-        company_collection = db["company"]
-        company_cursor = company_collection.find({"territoryId":territory_id})
-        for company in company_cursor:
-            company_id = str(company["_id"])
-            company_map[company_id] = company
-
-        employee_map = {}
-        # seleziona gli employee con trackingRecord.campaign_id esistente
-        employee_cursor = employee_collection.find({"trackingRecord." + campaign_id: {"$exists": True}})
-        for employee in employee_cursor:
-            company_id = employee["companyId"]
-            if company_id not in company_map:
-                continue
-            company_code = company_map[company_id]["code"]
-            employee_code = employee["code"]
-            employee_key = f"{company_code}__{employee_code}"
-            employee_map[employee_key] = employee
-        employee_cursor.close()
-
-        # seleziona gli user registrati alla campagna
-        user_cursor = user_collection.find({"roles.subscriptions.campaign": campaign_id})
-        for user in user_cursor:
-            sub = get_company_subscription(user, campaign_id)
-            if sub is None:
-                continue
-            company_code = str(sub["companyCode"])
-            employee_code = str(sub["key"])
-            employee_key = f"{company_code}__{employee_code}"
-            if employee_key in employee_map:
-                employee = employee_map[employee_key]
-                c_group = CampaignGroup(
-                    territory_id=territory_id,
-                    player_id=user["playerId"],
-                    campaign_id=campaign_id,
-                    group_id=company_code
-                )
-                yield c_group
-        user_cursor.close()
-
-        client.close()
-
-
-    def get_hsc_group_info(self, territory_id: str, campaign_id: str):
-        client = MongoClient(self.hsc_mongo_uri, directConnection=self.hsc_direct_connection)
-        db = client[self.hsc_mongo_db]
+        # prima iscrizione alla campagna tra quelle di tutti i ruoli dell'utente
+        subscription = {"$arrayElemAt": [{"$filter": {
+            "input": {"$reduce": {"input": "$roles.subscriptions", "initialValue": [], "in": {"$concatArrays": ["$$value", "$$this"]}}},
+            "as": "sub",
+            "cond": {"$eq": ["$$sub.campaign", campaign_id]},
+        }}, 0]}
+        pipeline = [
+            # seleziona gli user registrati alla campagna
+            {"$match": {"roles.subscriptions.campaign": campaign_id}},
+            {"$project": {"_id": 0, "playerId": 1, "sub": subscription}},
+            {"$match": {"sub": {"$exists": True}}},
+            {"$project": {"playerId": 1, "companyCode": {"$toString": "$sub.companyCode"}, "employee": {"$literal": False},
+                          "key": {"$concat": [{"$toString": "$sub.companyCode"}, "__", {"$toString": "$sub.key"}]}}},
+            # aggiunge gli employee delle company del territorio con trackingRecord.campaign_id esistente
+            {"$unionWith": {"coll": "employee", "pipeline": [
+                {"$match": {"trackingRecord." + campaign_id: {"$exists": True}}},
+                # companyId convertito in ObjectId, così il $lookup usa l'indice su company._id
+                {"$addFields": {"companyObjectId": {"$convert": {"input": "$companyId", "to": "objectId", 
+                                                                 "onError": None, "onNull": None}}}},
+                {"$lookup": {"from": "company", "localField": "companyObjectId", "foreignField": "_id", "as": "company"}},
+                {"$unwind": "$company"},
+                {"$match": {"company.territoryId": territory_id}},
+                {"$project": {"_id": 0, "employee": {"$literal": True},
+                              "key": {"$concat": [{"$toString": "$company.code"}, "__", {"$toString": "$code"}]}}},
+            ]}},
+            # tiene gli user che hanno un employee con la stessa chiave
+            {"$group": {"_id": "$key", "members": {"$push": {"playerId": "$playerId", "companyCode": "$companyCode", 
+                                                             "employee": "$employee"}},
+                        "has_employee": {"$max": "$employee"}}},
+            {"$match": {"_id": {"$ne": None}, "has_employee": True}},
+            {"$unwind": "$members"},
+            {"$match": {"members.employee": False}},
+            {"$project": {"_id": 0, "playerId": "$members.playerId", "companyCode": "$members.companyCode"}},
+        ]
+        cursor = user_collection.aggregate(pipeline, allowDiskUse=True, batchSize=self.batch_size)
+        try:
+            for member in cursor:
+                yield (territory_id, member["playerId"], campaign_id, member["companyCode"])
+        finally:
+            cursor.close()
+
+
+    def _find_hsc_groups(self, territory_id: str, campaign_id: str):
+        db = self.get_hsc_db()
 
         initiative_collection = db["initiative"]
-        initiative_cursor = initiative_collection.find({"campaign.territoryId":territory_id, "campaign.campaignId":campaign_id})
-        for initiative in initiative_cursor:
-            team_collection = db["playerTeam"]
-            team_cursor = team_collection.find({"initiativeId":str(initiative["_id"])})
-            for team in team_cursor:
-                for player in team["members"]:
-                    c_group = CampaignGroup(
-                        territory_id=territory_id,
-                        player_id=player["playerId"],
-                        campaign_id=campaign_id,
-                        group_id=str(team["_id"])
-                    )
-                    yield c_group
-            team_cursor.close()
-        initiative_cursor.close()
-
-        client.close()
-
-
-    def get_campaign_tracks_info(self, territory_id: str, start_time: str, end_time: str = None):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.mongo_uri, directConnection=self.direct_connection)
-        # Seleziona il database
-        db = client[self.mongo_db]
-
-        # estrae le campagne
-        campaign_collection = db["campaigns"]
-        campaign_cursor = campaign_collection.find({"territoryId":territory_id})
-        for campaign in campaign_cursor:
+        pipeline = [
+            {"$match": {"campaign.territoryId":territory_id, "campaign.campaignId":campaign_id}},
+            # playerTeam.initiativeId contiene l'_id dell'iniziativa come stringa
+            {"$project": {"_id": 0, "initiativeId": {"$toString": "$_id"}}},
+            {"$lookup": {"from": "playerTeam", "localField": "initiativeId", "foreignField": "initiativeId", "as": "team"}},
+            {"$unwind": "$team"},
+            {"$unwind": "$team.members"},
+            {"$project": {"groupId": {"$toString": "$team._id"}, "playerId": "$team.members.playerId"}},
+        ]
+        cursor = initiative_collection.aggregate(pipeline, batchSize=self.batch_size)
+        try:
+            for member in cursor:
+                yield (territory_id, member["playerId"], campaign_id, member["groupId"])
+        finally:
+            cursor.close()
+
+
+    def get_campaign_tracks_info(self, territory_id: str, start_time: str, end_time: str = None, ordered: bool = None):
+        """
+        Yields the track info of the company campaigns of the territory. The dayStat documents
+        are not indexed by time, so the campaigns are the partitions read concurrently.
+        """
+        for row in self._iter_campaign_track_info_rows(territory_id, start_time, end_time, ordered):
+            yield SpecificCampaingTrackInfo(*row)
+
+
+    def get_campaign_tracks_info_batches(self, territory_id: str, start_time: str, end_time: str = None, 
+                                         ordered: bool = None, batch_size: int = None):
+        """
+        Columnar variant of get_campaign_tracks_info: yields Arrow record batches with SpecificCampaingTrackInfo.arrow_schema.
+        """
+        rows = self._iter_campaign_track_info_rows(territory_id, start_time, end_time, ordered)
+        yield from iter_record_batches(rows, SpecificCampaingTrackInfo.arrow_schema, batch_size or self.batch_size)
+
+
+    def _iter_campaign_track_info_rows(self, territory_id: str, start_time: str, end_time: str = None, ordered: bool = None):
+        # estrae le campagne dalla cache
+        fetchers = []
+        for campaign_id, campaign in self.get_campaign_map(territory_id).items():
             if campaign["type"] != "company" and campaign["type"] != "school":
                 continue
             if campaign["type"] == "company":
-                for c_group in self.get_company_tracks_info(territory_id, str(campaign["_id"]), start_time, end_time):
-                    yield c_group    
+                fetchers.append(partial(self._find_company_tracks_info, territory_id, campaign_id, start_time, end_time))
             elif campaign["type"] == "school":
                 continue
-                #for c_group in self.get_hsc_group_info(territory_id, str(campaign["_id"])):
+                #for c_group in self.get_hsc_group_info(territory_id, campaign_id):
                 #    yield c_group
-        campaign_cursor.close()
-
-        client.close()
+        if len(fetchers) > 0:
+            yield from iter_sharded(fetchers, self.shard_ordered if ordered is None else ordered, 
+                                    self.shard_workers or self.shards)
 
 
     def get_company_tracks_info(self, territory_id: str, campaign_id: str, start_time: str, end_time: str = None):
-        # Connessione al server MongoDB (modifica la stringa di connessione se necessario)
-        client = MongoClient(self.company_mongo_uri, directConnection=self.company_direct_connection)
+        """
+        Yields the tracks of the campaign dayStat documents started in the given time window.
+        The tracks are unwound and filtered by date on the server.
+        """
+        for row in self._find_company_tracks_info(territory_id, campaign_id, start_time, end_time):
+            yield SpecificCampaingTrackInfo(*row)
 
-        # Seleziona il database
-        db = client[self.company_mongo_db]
 
-        collection = db["dayStat"]
+    def _find_company_tracks_info(self, territory_id: str, campaign_id: str, start_time: str, end_time: str = None):
+        # Seleziona il database dal pool condiviso
+        db = self.get_company_db()
 
-        start_time_dt = datetime.fromisoformat(start_time)
-        if end_time is not None:
-            end_time_dt = datetime.fromisoformat(end_time)
+        collection = db["dayStat"].with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
 
-        cursor = collection.find({"campaign": campaign_id})
-        for doc in cursor:
-            if "tracks" not in doc:
-                continue
-            for track in doc["tracks"]:
-                # check if track date is in range
-                track_date = get_utc_datetime(datetime.fromisoformat(track["startedAt"]))
-                if track_date < start_time_dt:
-                    continue
-                if end_time is not None and track_date > end_time_dt:
-                    continue
-                s_info = SpecificCampaingTrackInfo(
-                    territory_id=territory_id,
-                    player_id=doc["playerId"],
-                    track_id=track["trackId"],
-                    campaign_id=campaign_id,
-                    way_back=track.get("wayBack", False),
-                    location_id=track.get("locationId", None)
-                )
-                yield s_info
-        cursor.close()
-
-        client.close()
+        started_at_condition = {"$gte": datetime.fromisoformat(start_time)}
+        if end_time is not None:
+            started_at_condition["$lte"] = datetime.fromisoformat(end_time)
+
+        pipeline = [
+            {"$match": {"campaign": campaign_id, "tracks": {"$exists": True}}},
+            {"$unwind": "$tracks"},
+            # startedAt è salvato come stringa ISO, le date senza fuso orario sono considerate UTC
+            {"$addFields": {"startedAt": {"$dateFromString": {"dateString": "$tracks.startedAt", "onError": None, "onNull": None}}}},
+            {"$match": {"startedAt": started_at_condition}},
+            {"$project": {
+                "_id": 0,
+                "playerId": 1,
+                "trackId": "$tracks.trackId",
+                "wayBack": "$tracks.wayBack",
+                "locationId": "$tracks.locationId",
+                "startedAt": 1,
+            }},
+        ]
+
+        stats = TransferStats(f"get_company_tracks_info Campaign ID: {campaign_id}")
+        cursor = collection.aggregate(pipeline, batchSize=self.batch_size)
+        try:
+            for raw_doc in cursor:
+                stats.add(raw_doc)
+                doc = decode(raw_doc.raw, db.codec_options)
+                yield (territory_id, doc["playerId"], doc["trackId"], campaign_id, doc.get("wayBack", False), 
+                       doc.get("locationId", None), get_utc_datetime(doc["startedAt"]))
+        finally:
+            cursor.close()
+            stats.log()
@@ -0,0 +1,25 @@
+import os
+import json
+import logging
+
+from graph.graphmap import GraphMap
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    # costruisce offline la cache dei grafi dei territori di data/territory_map.json, dalla sorgente di GRAPH_SOURCE
+    with open("data/territory_map.json", "r", encoding="utf-8") as file:
+        territory_map = json.load(file)
+    territories = os.getenv("GRAPH_PREBUILD_TERRITORIES", ",".join(territory_map.keys())).split(",")
+    track_modes = os.getenv("GRAPH_PREBUILD_MODES", "walk,bike,bus,car").split(",")
+
+    for territory_id in territories:
+        for track_mode in track_modes:
+            graph_map = GraphMap()
+            try:
+                graph_map.load_territory_graph(territory_id, track_mode)
+                logger.info(f"Graph cached - Territory ID: {territory_id}, Mode: {track_mode}, Nodes: {len(graph_map.node_ids)}")
+            except Exception as e:
+                logger.error(f"Error building graph - Territory ID: {territory_id}, Mode: {track_mode}: {e}")
@@ -53,7 +53,7 @@ def analyze_territory(playandgo_engine: PlayAndGoEngine, file_storage: FileStora
 
 
 if __name__ == "__main__":
-    playandgo_engine = PlayAndGoEngine()
     file_storage = FileStorage()
-    analyze_territory(playandgo_engine, file_storage, "Ferrara")
+    with PlayAndGoEngine() as playandgo_engine:
+        analyze_territory(playandgo_engine, file_storage, "Ferrara")
 
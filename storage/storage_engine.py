@@ -1,10 +1,17 @@
 import os
+import json
 import pandas as pd
+import pyarrow as pa
 import csv
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
+# serializza gli aggiornamenti del file dei watermark tra import concorrenti
+_watermark_lock = threading.Lock()
+
+
 class FileStorage:
     def __init__(self):
         self.store_path = os.getenv("STORAGE_PATH", "./files/")
@@ -20,6 +27,7 @@ class FileStorage:
         self.way_shapes = "way_shapes"
         self.h3_info = "h3_info"
         self.mapped_campaign_groups = "mapped_campaign_groups"
+        self.watermarks = "watermarks"
         #self.duck_nearest_edges = "duck_nearest_edges"
         #self.duck_tracks_info = "duck_tracks_info"
 
@@ -108,7 +116,8 @@ class FileStorage:
         file_path = self.get_filename(territory_id, self.nearest_edges, year)
         if os.path.exists(file_path):
             existing_df = pd.read_parquet(file_path, engine="pyarrow")
-            combined_df = self.merge_dataframes(existing_df, df, ['track_id', 'ordinal'])
+            # una traccia reimportata sostituisce tutte le sue righe: il numero di punti può cambiare
+            combined_df = self.replace_dataframes(existing_df, df, 'track_id')
             combined_df.to_parquet(file_path, engine="pyarrow")
             if save_csv:
                 self.save_csv(file_path, combined_df) 
@@ -266,8 +275,22 @@ class FileStorage:
         rows, columns = combined_df.shape
         logger.info(f"Storage Rows: {rows}, Columns: {columns}")
         return combined_df
+
+
+    def replace_dataframes(self, df_old:pd.DataFrame, df_new:pd.DataFrame, column:str) -> pd.DataFrame:
+        """Replace all the rows of df_old with a column value present in df_new."""
+        combined_df = pd.concat([df_old[~df_old[column].isin(df_new[column])], df_new], ignore_index=True) \
+            .reset_index(drop=True)
+        rows, columns = combined_df.shape
+        logger.info(f"Storage Rows: {rows}, Columns: {columns}")
+        return combined_df
     
 
+    def table_to_df(self, table:pa.Table, columns:list) -> pd.DataFrame:
+        """Convert an Arrow table to a dataframe with the given storage columns."""
+        return table.select(columns).to_pandas(coerce_temporal_nanoseconds=True)
+
+
     def save_df(self, territory_id:str, df_file:str, df:pd.DataFrame, year:str=None, save_csv:bool=False):
         file_path = self.get_filename(territory_id, df_file, year)
         df.to_parquet(file_path, engine="pyarrow") 
@@ -281,12 +304,12 @@ class FileStorage:
         df.to_csv(file_path, index=False, quoting=csv.QUOTE_NONNUMERIC)                   
 
 
-    def load_dataframe(self, territory_id:str, df_file:str, year:str=None) -> tuple:
-        """Load a dataframe from a file."""
+    def load_dataframe(self, territory_id:str, df_file:str, year:str=None, columns:list=None) -> tuple:
+        """Load a dataframe from a file, optionally only the given columns."""
         file_path = self.get_filename(territory_id, df_file, year)
         if os.path.exists(file_path):
             file_stats = os.stat(file_path)
-            return file_stats.st_size, pd.read_parquet(file_path, engine="pyarrow")
+            return file_stats.st_size, pd.read_parquet(file_path, engine="pyarrow", columns=columns)
         else:
             raise FileNotFoundError(f"File {file_path} does not exist.")
 
@@ -316,4 +339,37 @@ class FileStorage:
                 df_result = df
             else:
                 df_result = pd.concat([df_result, df], ignore_index=True)
-        return df_result
\ No newline at end of file
+        return df_result
+
+
+    def get_watermark_filename(self, territory_id:str) -> str:
+        """Get the filename for the import watermarks of a territory."""
+        return f"{self.store_path}/{territory_id}/{self.watermarks}.json"
+
+
+    def load_watermarks(self, territory_id:str) -> dict:
+        """Load all the import watermarks of a territory."""
+        file_path = self.get_watermark_filename(territory_id)
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        return {}
+
+
+    def load_watermark(self, territory_id:str, dataset:str) -> dict:
+        """Load the import watermark of a dataset, None if the dataset was never imported."""
+        return self.load_watermarks(territory_id).get(dataset, None)
+
+
+    def save_watermark(self, territory_id:str, dataset:str, watermark:dict):
+        """Save the import watermark of a dataset."""
+        self.check_directory(territory_id)
+        file_path = self.get_watermark_filename(territory_id)
+        with _watermark_lock:
+            watermarks = self.load_watermarks(territory_id)
+            watermarks[dataset] = watermark
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(watermarks, file, indent=2)
+            os.replace(tmp_path, file_path)
+        logger.info(f"Watermark {territory_id}/{dataset}: {watermark}")
@@ -8,7 +8,8 @@ if __name__ == "__main__":
     playandgo_engine = PlayAndGoEngine()
 
     file_path = "./files/tracks/ferrara.json"
-    with open(file_path, "r", encoding="utf-8") as file:
+    # il client MongoDB viene riusato per tutte le chiamate a get_track e chiuso alla fine
+    with playandgo_engine, open(file_path, "r", encoding="utf-8") as file:
         nearest_edges = []
         for line in file:
             track_json = json.loads(line.strip())  # Converte la riga in un oggetto Python
@@ -0,0 +1,131 @@
+import time
+import threading
+import unittest
+from unittest import mock
+
+from valhalla import matching_executor
+from valhalla.matching_executor import AdaptiveLimit, MatchingExecutor
+from valhalla.valhalla_engine import TraceRoute
+
+# latenza simulata di una richiesta a Valhalla e tempo lato client (decodifica JSON, colonne) di alcune tracce
+MISS_LATENCY = 0.005
+CLIENT_TIME = 0.05
+POINTS = 10
+
+
+class FakeValhallaEngine:
+    """
+    Stand-in of ValhallaEngine.match_trace: the tracks flagged as hits come from the cache, the others wait
+    MISS_LATENCY in the HTTP request and CLIENT_TIME after it when flagged as slow.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start_request_timer(self):
+        self.local.request_time = 0.0
+
+    def get_request_time(self) -> float:
+        return getattr(self.local, "request_time", 0.0)
+
+    def match_trace(self, track, track_id) -> TraceRoute:
+        if track["hit"]:
+            return TraceRoute.from_cache_value(track_id, {"shape": "", "columns": {}})
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(MISS_LATENCY)
+            self.local.request_time = self.get_request_time() + MISS_LATENCY
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if track.get("slow"):
+            time.sleep(CLIENT_TIME)
+        return TraceRoute(track_id=track_id, shape="")
+
+
+def get_track(index: int, hit: bool, slow: bool = False) -> dict:
+    return {"_id": f"track{index}", "hit": hit, "slow": slow, "geolocationEvents": [{}] * POINTS}
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def test_unmeasured_release_keeps_limit(self):
+        limit = AdaptiveLimit(1, 8, 4, 2.0)
+        limit.acquire()
+        limit.release(0.0001, POINTS, False, measured=False)
+        self.assertEqual(limit.in_flight, 0)
+        self.assertIsNone(limit.baseline_latency)
+        self.assertEqual(limit.limit, 4.0)
+
+    def test_measured_release_sets_baseline(self):
+        limit = AdaptiveLimit(1, 8, 4, 2.0)
+        limit.acquire()
+        limit.release(0.01, POINTS, False)
+        self.assertAlmostEqual(limit.baseline_latency, 0.001)
+        self.assertGreater(limit.limit, 4.0)
+
+    def test_recovers_after_fast_outlier(self):
+        limit = AdaptiveLimit(1, 8, 4, 2.0, window=20, smoothing=0.1)
+        # una risposta molto veloce, poi latenze normali dieci volte più alte
+        limit.acquire()
+        limit.release(0.001, POINTS, False)
+        for _ in range(100):
+            limit.acquire()
+            limit.release(0.01, POINTS, False)
+        self.assertAlmostEqual(limit.baseline_latency, 0.001, places=4)
+        self.assertEqual(limit.limit, 8.0)
+
+
+class MatchingExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeValhallaEngine()
+        self.executor = MatchingExecutor(self.engine)
+        self.executor.max_concurrency = 8
+        self.executor.min_concurrency = 1
+        self.executor.initial_concurrency = 2
+        self.executor.latency_tolerance = 10.0
+        self.limits = []
+        limits = self.limits
+
+        class RecordingLimit(AdaptiveLimit):
+            def __init__(self, *args):
+                super().__init__(*args)
+                limits.append(self)
+
+        patcher = mock.patch.object(matching_executor, "AdaptiveLimit", RecordingLimit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_hits_do_not_collapse_concurrency(self):
+        tracks = [get_track(index, index % 2 == 0, index % 10 == 1) for index in range(200)]
+        results = list(self.executor.map(tracks))
+
+        # ordine di input e provenienza dei risultati
+        self.assertEqual([track["_id"] for track, _ in results], [track["_id"] for track in tracks])
+        self.assertEqual([trace_route.from_cache for _, trace_route in results], [track["hit"] for track in tracks])
+
+        limit = self.limits[0]
+        # la latenza minima è quella delle richieste, non quella (quasi nulla) delle hit
+        self.assertGreaterEqual(limit.baseline_latency, MISS_LATENCY / POINTS)
+        self.assertGreater(limit.limit, self.executor.initial_concurrency)
+        self.assertGreater(self.engine.max_in_flight, self.executor.initial_concurrency)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_only_hits_leave_limit_unchanged(self):
+        tracks = [get_track(index, True) for index in range(20)]
+        results = list(self.executor.map(tracks))
+
+        self.assertEqual(len(results), 20)
+        limit = self.limits[0]
+        self.assertIsNone(limit.baseline_latency)
+        self.assertEqual(limit.limit, float(self.executor.initial_concurrency))
+
+
+if __name__ == "__main__":
+    unittest.main()
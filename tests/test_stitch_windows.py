@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from valhalla.valhalla_engine import stitch_windows, get_trace_columns
+
+
+def get_points(size: int) -> list:
+    return [{"latitude": 46.0 + index * 0.0001, "longitude": 11.0, "time": 1000 * index} for index in range(size)]
+
+
+def get_window_result(points: list, start: int, edge_index: list, way_ids: list) -> tuple:
+    """Result of match_window with all the points of the window matched, on the given edges and ways (one per edge)."""
+    window_points = points[start:start + len(edge_index)]
+    indexes = np.arange(len(edge_index), dtype=np.int64)
+    columns = get_trace_columns({
+        'edge_index': edge_index,
+        'distance_from_trace_point': [0.0] * len(edge_index),
+        'distance_along_edge': [0.0] * len(edge_index),
+        'lon': [point["longitude"] for point in window_points],
+        'lat': [point["latitude"] for point in window_points],
+        'way_id': [way_ids[edge] for edge in edge_index],
+        'travel_mode': ["bicycle"] * len(edge_index),
+        'timestamp': [point["time"] for point in window_points],
+    })
+    return None, indexes, columns
+
+
+class StitchWindowsTest(unittest.TestCase):
+
+    def test_edge_crossing_overlap_midpoint(self):
+        points = get_points(10)
+        # finestre [0, 6) e [4, 10): punto di giunzione 5, l'arco della way 30 copre i punti 4 e 5
+        windows = [(0, 6), (4, 10)]
+        results = [get_window_result(points, 0, [0, 0, 1, 1, 2, 2], [10, 20, 30]),
+                   get_window_result(points, 4, [0, 0, 1, 1, 2, 2], [30, 40, 50])]
+        trace_route = stitch_windows("track", points, windows, results)
+        self.assertEqual(trace_route.way_id.tolist(), [10, 10, 20, 20, 30, 30, 40, 40, 50, 50])
+        self.assertEqual(trace_route.edge_index.tolist(), [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        self.assertEqual(trace_route.timestamp.tolist(), [point["time"] for point in points])
+
+    def test_edge_ending_at_overlap_midpoint(self):
+        points = get_points(10)
+        windows = [(0, 6), (4, 10)]
+        results = [get_window_result(points, 0, [0, 0, 1, 1, 2, 2], [10, 20, 30]),
+                   get_window_result(points, 4, [0, 1, 1, 1, 2, 2], [30, 40, 50])]
+        trace_route = stitch_windows("track", points, windows, results)
+        self.assertEqual(trace_route.way_id.tolist(), [10, 10, 20, 20, 30, 40, 40, 40, 50, 50])
+        self.assertEqual(trace_route.edge_index.tolist(), [0, 0, 1, 1, 2, 3, 3, 3, 4, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
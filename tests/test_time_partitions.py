@@ -0,0 +1,74 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from playandgo.pg_engine import get_time_partitions
+
+
+class TimePartitionsTest(unittest.TestCase):
+
+    def test_aware_start_naive_end(self):
+        # start dal watermark di un import incrementale, end passato da API/CLI
+        conditions = get_time_partitions("2025-01-01T00:00:00+00:00", "2025-01-04T00:00:00", 3)
+        self.assertEqual(len(conditions), 3)
+        self.assertEqual(conditions[0]["$gt"], datetime(2025, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(conditions[1]["$gte"], datetime(2025, 1, 2, tzinfo=timezone.utc))
+        self.assertEqual(conditions[2]["$gte"], datetime(2025, 1, 3, tzinfo=timezone.utc))
+        self.assertEqual(conditions[2]["$lt"], datetime(2025, 1, 4, tzinfo=timezone.utc))
+
+    def test_offset_start_is_converted_to_utc(self):
+        conditions = get_time_partitions("2025-01-01T02:00:00+02:00", "2025-01-02T00:00:00", 2)
+        self.assertEqual(conditions[0]["$gt"], datetime(2025, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(conditions[1]["$gte"], datetime(2025, 1, 1, 12, tzinfo=timezone.utc))
+
+    def assert_contiguous(self, conditions, start_dt, end_dt):
+        # la prima partizione esclude start, le successive iniziano dove finisce la precedente
+        self.assertEqual(conditions[0]["$gt"], start_dt)
+        self.assertNotIn("$gte", conditions[0])
+        for previous, condition in zip(conditions, conditions[1:]):
+            self.assertEqual(previous["$lt"], condition["$gte"])
+            self.assertNotIn("$gt", condition)
+        for condition in conditions:
+            lower = condition.get("$gte", condition.get("$gt"))
+            if "$lt" in condition:
+                self.assertLess(lower, condition["$lt"])
+        if end_dt is None:
+            self.assertNotIn("$lt", conditions[-1])
+        else:
+            self.assertEqual(conditions[-1]["$lt"], end_dt)
+
+    def test_contiguous_partitions(self):
+        for shards in (1, 2, 3, 7, 24):
+            conditions = get_time_partitions("2025-03-01T00:00:00", "2025-03-02T00:00:00", shards)
+            self.assertEqual(len(conditions), shards)
+            self.assert_contiguous(conditions, datetime(2025, 3, 1, tzinfo=timezone.utc), datetime(2025, 3, 2, tzinfo=timezone.utc))
+
+    def test_uneven_partitions(self):
+        # finestra non divisibile per il numero di partizioni
+        conditions = get_time_partitions("2025-03-01T00:00:00", "2025-03-01T00:00:00.010", 3)
+        self.assertEqual(len(conditions), 3)
+        self.assert_contiguous(conditions, datetime(2025, 3, 1, tzinfo=timezone.utc), 
+                               datetime(2025, 3, 1, tzinfo=timezone.utc) + timedelta(milliseconds=10))
+
+    def test_more_shards_than_span(self):
+        start_dt = datetime(2025, 3, 1, tzinfo=timezone.utc)
+        conditions = get_time_partitions("2025-03-01T00:00:00", "2025-03-01T00:00:00.002", 5)
+        self.assertEqual(len(conditions), 2)
+        self.assert_contiguous(conditions, start_dt, start_dt + timedelta(milliseconds=2))
+        # finestra vuota o invertita: una sola partizione
+        self.assertEqual(len(get_time_partitions("2025-03-01T00:00:00", "2025-03-01T00:00:00", 5)), 1)
+        self.assertEqual(len(get_time_partitions("2025-03-02T00:00:00", "2025-03-01T00:00:00", 5)), 1)
+
+    def test_open_end(self):
+        start_dt = datetime.now(timezone.utc) - timedelta(days=3)
+        conditions = get_time_partitions(start_dt.isoformat(), None, 3)
+        self.assertEqual(len(conditions), 3)
+        self.assert_contiguous(conditions, start_dt, None)
+        # l'ultima partizione resta aperta per le tracce successive al calcolo dei limiti
+        self.assertEqual(set(conditions[-1]), {"$gte"})
+        # start nel futuro: una sola partizione aperta
+        future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+        self.assertEqual(get_time_partitions(future, None, 3), [{"$gt": datetime.fromisoformat(future)}])
+
+
+if __name__ == "__main__":
+    unittest.main()
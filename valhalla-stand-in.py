@@ -0,0 +1,18 @@
+import logging
+
+from valhalla.stand_in_server import StandInServer, StandInSettings
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    settings = StandInSettings()
+    server = StandInServer(settings)
+    logger.info(f"Valhalla stand-in listening on port {settings.port}, mode {settings.mode}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
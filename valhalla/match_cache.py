@@ -0,0 +1,118 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# da incrementare quando cambia il formato dei valori o la semantica della chiave
+CACHE_VERSION = 2
+
+
+class MatchCache:
+    """
+    On-disk, content-addressed cache of /trace_attributes results. The key is the SHA-256 of the
+    request body (costing, sorted points and Valhalla parameters), the value the parsed route
+    as zlib-compressed JSON. When the cache grows over max_bytes the least recently used
+    entries (by file mtime, refreshed on every hit) are evicted.
+    """
+
+    def __init__(self, cache_path: str, max_bytes: int):
+        self.cache_path = cache_path.rstrip("/")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_key(self, request: dict) -> str:
+        body = json.dumps([CACHE_VERSION, request], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+    def get_filename(self, key: str) -> str:
+        return f"{self.cache_path}/{key[:2]}/{key}.json.z"
+
+
+    def get(self, key: str) -> dict:
+        """Returns the cached value, None on a miss."""
+        file_path = self.get_filename(key)
+        try:
+            with open(file_path, "rb") as file:
+                value = json.loads(zlib.decompress(file.read()))
+            # aggiorna l'mtime per l'eviction LRU
+            os.utime(file_path)
+            self.hits += 1
+            return value
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Invalid cache entry {file_path}: {e}")
+            self.misses += 1
+            return None
+
+
+    def put(self, key: str, value: dict):
+        file_path = self.get_filename(key)
+        data = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        with self.lock:
+            # una chiave già presente viene sovrascritta: conta solo la differenza di dimensione
+            try:
+                replaced_bytes = os.path.getsize(file_path)
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(tmp_path, file_path)
+            if self.total_bytes is None:
+                self.total_bytes = self.get_size()
+            else:
+                self.total_bytes += len(data) - replaced_bytes
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+
+    def list_entries(self) -> list:
+        entries = []
+        if not os.path.exists(self.cache_path):
+            return entries
+        for directory in os.scandir(self.cache_path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".json.z"):
+                    try:
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    except FileNotFoundError:
+                        continue
+        return entries
+
+
+    def get_size(self) -> int:
+        return sum(size for _, size, _ in self.list_entries())
+
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is at 90% of max_bytes."""
+        entries = sorted(self.list_entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+                removed += 1
+            except FileNotFoundError:
+                continue
+        self.total_bytes = total_bytes
+        logger.info(f"Match cache eviction: {removed} entries removed, {total_bytes} bytes")
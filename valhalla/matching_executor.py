@@ -0,0 +1,150 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from valhalla.valhalla_engine import ValhallaEngine, TraceRoute
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit: grows by one request per round trip while the latency per point stays
+    close to the baseline, and halves on errors or when the latency grows beyond tolerance
+    (at most once per round trip, so a burst of slow responses counts as a single congestion event).
+    The baseline is an EWMA of the 10th percentile of the last window latencies, so that it follows
+    the server over time and a single fast response does not keep the limit down.
+    """
+
+    def __init__(self, min_limit: int, max_limit: int, initial_limit: int, tolerance: float,
+                 window: int = 50, smoothing: float = 0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.tolerance = tolerance
+        self.latencies = deque(maxlen=window)
+        self.smoothing = smoothing
+        self.baseline_latency = None
+        self.next_decrease = 0.0
+        self.condition = threading.Condition()
+        self.in_flight = 0
+
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+
+    def release(self, latency: float, points: int, error: bool, measured: bool = True):
+        """
+        Frees the slot of a request. With measured False (e.g. a MatchCache hit, that never reached Valhalla)
+        the latency is not a sample of the server and the limit is left unchanged.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if not measured:
+                self.condition.notify_all()
+                return
+            now = time.monotonic()
+            latency_per_point = latency / max(points, 1)
+            if not error:
+                self.latencies.append(latency_per_point)
+                p10 = float(np.percentile(self.latencies, 10))
+                if self.baseline_latency is None:
+                    self.baseline_latency = p10
+                else:
+                    self.baseline_latency += self.smoothing * (p10 - self.baseline_latency)
+            congested = error or (self.baseline_latency is not None and latency_per_point > self.baseline_latency * self.tolerance)
+            if congested:
+                if now >= self.next_decrease:
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self.next_decrease = now + latency
+                    logger.debug(f"Matching concurrency decreased to {int(self.limit)} (error: {error}, latency: {latency:.3f}s)")
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class MatchingExecutor:
+    """
+    Runs ValhallaEngine.match_trace for a stream of tracks with a bounded, adaptive number of
+    in-flight requests, returning the results in the input order.
+    """
+
+    def __init__(self, valhalla_engine: ValhallaEngine):
+        self.valhalla_engine = valhalla_engine
+        self.max_concurrency = int(os.getenv("VALHALLA_MAX_CONCURRENCY", "8"))
+        self.min_concurrency = int(os.getenv("VALHALLA_MIN_CONCURRENCY", "1"))
+        self.initial_concurrency = int(os.getenv("VALHALLA_INITIAL_CONCURRENCY", "2"))
+        # rapporto massimo tra latenza per punto osservata e latenza di riferimento prima di ridurre la concorrenza
+        self.latency_tolerance = float(os.getenv("VALHALLA_LATENCY_TOLERANCE", "2.0"))
+        # richieste considerate per la latenza di riferimento e suo fattore di smorzamento
+        self.latency_window = int(os.getenv("VALHALLA_LATENCY_WINDOW", "50"))
+        self.latency_smoothing = float(os.getenv("VALHALLA_LATENCY_SMOOTHING", "0.1"))
+
+
+    def match(self, limit: AdaptiveLimit, track) -> TraceRoute:
+        track_id = str(track["_id"])
+        points = len(track.get("geolocationEvents", []))
+        error = False
+        # le tracce senza punti e i risultati della cache non inviano richieste a Valhalla
+        measured = points > 0
+        # solo il tempo delle richieste HTTP, senza la decodifica JSON e la costruzione delle colonne
+        self.valhalla_engine.start_request_timer()
+        try:
+            trace_route = self.valhalla_engine.match_trace(track, track_id)
+            measured = measured and not trace_route.from_cache
+            return trace_route
+        except Exception as e:
+            error = True
+            logger.error(f"Exception[{track_id}]: {e}")
+            return TraceRoute(track_id=track_id)
+        finally:
+            limit.release(self.valhalla_engine.get_request_time(), points, error, measured)
+
+
+    def map(self, tracks, needs_matching=None, local_matchers=None):
+        """
+        Yields (track, trace_route) in the order of tracks. The tracks for which needs_matching returns
+        False are not sent to Valhalla and are yielded with trace_route None.
+        local_matchers maps a track mode to a pool with a submit(track) method (e.g. HmmMatcherPool):
+        the tracks of those modes are matched by the pool instead of Valhalla.
+        """
+        local_matchers = local_matchers or {}
+        limit = AdaptiveLimit(self.min_concurrency, self.max_concurrency, self.initial_concurrency, self.latency_tolerance,
+                              self.latency_window, self.latency_smoothing)
+        max_pending = max([self.max_concurrency] + [local_matcher.workers for local_matcher in local_matchers.values()]) * 2
+        pending = deque()
+        start = time.monotonic()
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="valhalla-match") as executor:
+            for track in tracks:
+                local_matcher = local_matchers.get(track.get("freeTrackingTransport"))
+                if needs_matching is not None and not needs_matching(track):
+                    pending.append((track, None))
+                elif local_matcher is not None:
+                    pending.append((track, local_matcher.submit(track)))
+                else:
+                    # attende uno slot libero, restituendo intanto i risultati già pronti in testa
+                    while len(pending) > 0 and pending[0][1] is not None and pending[0][1].done():
+                        head_track, head_future = pending.popleft()
+                        yield head_track, head_future.result()
+                    limit.acquire()
+                    pending.append((track, executor.submit(self.match, limit, track)))
+                    count += 1
+                # limita i risultati in attesa per non accumulare tracce in memoria
+                while len(pending) > max_pending or (len(pending) > 0 and pending[0][1] is None):
+                    head_track, head_future = pending.popleft()
+                    yield head_track, None if head_future is None else head_future.result()
+            while len(pending) > 0:
+                head_track, head_future = pending.popleft()
+                yield head_track, None if head_future is None else head_future.result()
+        stop = time.monotonic()
+        logger.info(f"Matched Tracks: {count}, Concurrency: {int(limit.limit)}, Time:{stop - start} seconds")
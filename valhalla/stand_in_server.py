@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from valhalla.valhalla_engine import encode_polyline, decode_polyline
+
+logger = logging.getLogger(__name__)
+
+# dimensione (gradi) delle celle usate come way sintetiche, circa 100 metri
+WAY_CELL_SIZE = 0.001
+
+
+def get_way_id(lat: float, lon: float) -> int:
+    """Synthetic way id: the same for the points of the same cell, so that the way shapes repeat as in real tracks."""
+    return int((lat + 90) / WAY_CELL_SIZE) * 1000000 + int((lon + 180) / WAY_CELL_SIZE)
+
+
+def get_way_shape(way_id: int) -> str:
+    """Synthetic way shape: the diagonal of the cell of the way."""
+    lat = (way_id // 1000000) * WAY_CELL_SIZE - 90
+    lon = (way_id % 1000000) * WAY_CELL_SIZE - 180
+    return encode_polyline([{"latitude": lat, "longitude": lon},
+                            {"latitude": lat + WAY_CELL_SIZE, "longitude": lon + WAY_CELL_SIZE}])
+
+
+def get_request_points(request: dict) -> list:
+    """(lat, lon) of the points of a /trace_attributes request, with shape or encoded_polyline."""
+    if "encoded_polyline" in request:
+        return decode_polyline(request["encoded_polyline"])
+    return [(point["lat"], point["lon"]) for point in request.get("shape", [])]
+
+
+def get_travel_mode(costing: str) -> str:
+    match costing:
+        case "pedestrian":
+            return "pedestrian"
+        case "bicycle":
+            return "bicycle"
+        case _:
+            return "drive"
+
+
+def build_trace_attributes_response(request: dict, unmatched_rate: float = 0.0) -> dict:
+    """Response of /trace_attributes with the fields read by ValhallaEngine.match_window."""
+    points = get_request_points(request)
+    travel_mode = get_travel_mode(request.get("costing"))
+    edges = []
+    matched_points = []
+    for lat, lon in points:
+        way_id = get_way_id(lat, lon)
+        if len(edges) == 0 or edges[-1]["way_id"] != way_id:
+            edges.append({"way_id": way_id, "travel_mode": travel_mode})
+        matched_type = "unmatched" if random.random() < unmatched_rate else "matched"
+        matched_points.append({"type": matched_type, "edge_index": len(edges) - 1, "lat": lat, "lon": lon,
+                               "distance_from_trace_point": round(random.uniform(0, 10), 3),
+                               "distance_along_edge": round(random.random(), 3)})
+    shape = encode_polyline([{"latitude": lat, "longitude": lon} for lat, lon in points])
+    return {"shape": shape, "edges": edges, "matched_points": matched_points}
+
+
+def build_locate_response(request: dict) -> list:
+    """Response of /locate: for each location the edge of its synthetic way."""
+    response = []
+    for location in request.get("locations", []):
+        way_id = get_way_id(location["lat"], location["lon"])
+        response.append({"input_lat": location["lat"], "input_lon": location["lon"],
+                         "edges": [{"edge_info": {"way_id": way_id, "shape": get_way_shape(way_id)}}]})
+    return response
+
+
+class StandInSettings:
+    """Settings of the stand-in server, from the environment."""
+
+    def __init__(self):
+        self.port = int(os.getenv("STAND_IN_PORT", "8002"))
+        # "synthetic" (risposte generate), "record" (proxy verso STAND_IN_UPSTREAM con salvataggio) o "replay"
+        self.mode = os.getenv("STAND_IN_MODE", "synthetic")
+        self.upstream = os.getenv("STAND_IN_UPSTREAM", "http://localhost:8002").rstrip("/")
+        self.record_path = os.getenv("STAND_IN_RECORD_PATH", "./files/valhalla_recordings").rstrip("/")
+        # latenza: base, per punto e variazione casuale (millisecondi)
+        self.latency_ms = float(os.getenv("STAND_IN_LATENCY_MS", "20"))
+        self.latency_per_point_ms = float(os.getenv("STAND_IN_LATENCY_PER_POINT_MS", "0.05"))
+        self.jitter_ms = float(os.getenv("STAND_IN_JITTER_MS", "10"))
+        # frazione di risposte 503 e 400 e di punti non associati
+        self.error_rate = float(os.getenv("STAND_IN_ERROR_RATE", "0"))
+        self.client_error_rate = float(os.getenv("STAND_IN_CLIENT_ERROR_RATE", "0"))
+        self.unmatched_rate = float(os.getenv("STAND_IN_UNMATCHED_RATE", "0.02"))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local stand-in of Valhalla for /trace_attributes and /locate, with synthetic responses shaped as the real ones,
+    configurable latency and error injection, and recording/replay of the responses of a real server.
+    GET /stats returns the number of calls and errors per service.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, settings: StandInSettings, host: str = "0.0.0.0"):
+        super().__init__((host, settings.port), StandInHandler)
+        self.settings = settings
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+
+    def count(self, service: str, key: str):
+        with self.stats_lock:
+            service_stats = self.stats.setdefault(service, {"calls": 0, "errors": 0, "points": 0})
+            service_stats[key] = service_stats.get(key, 0) + 1
+
+
+    def add_points(self, service: str, points: int):
+        with self.stats_lock:
+            self.stats.setdefault(service, {"calls": 0, "errors": 0, "points": 0})["points"] += points
+
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            return json.loads(json.dumps(self.stats))
+
+
+    def get_recording_file(self, service: str, body: bytes) -> str:
+        key = hashlib.sha256(service.encode("utf-8") + b"\n" + body).hexdigest()
+        return f"{self.settings.record_path}/{service.strip('/')}/{key}.json"
+
+
+    def record(self, service: str, body: bytes) -> tuple:
+        """Forwards the request to the upstream Valhalla and saves the response."""
+        response = requests.post(self.settings.upstream + service, data=body, headers={"Content-Type": "application/json"},
+                                 timeout=60)
+        if response.status_code == 200:
+            file_path = self.get_recording_file(service, body)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as file:
+                file.write(response.content)
+        return response.status_code, response.content
+
+
+    def replay(self, service: str, body: bytes) -> tuple:
+        file_path = self.get_recording_file(service, body)
+        if not os.path.exists(file_path):
+            return 404, json.dumps({"error": "recording not found"}).encode("utf-8")
+        with open(file_path, "rb") as file:
+            return 200, file.read()
+
+
+    def synthetic(self, service: str, request: dict) -> tuple:
+        if service == "/trace_attributes":
+            return 200, json.dumps(build_trace_attributes_response(request, self.settings.unmatched_rate)).encode("utf-8")
+        return 200, json.dumps(build_locate_response(request)).encode("utf-8")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+    def send_body(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_body(200, json.dumps(self.server.get_stats()).encode("utf-8"))
+        else:
+            self.send_body(404, b'{"error":"not found"}')
+
+
+    def do_POST(self):
+        server = self.server
+        settings = server.settings
+        service = self.path.split("?")[0]
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        if service not in ("/trace_attributes", "/locate"):
+            self.send_body(404, b'{"error":"not found"}')
+            return
+        server.count(service, "calls")
+        try:
+            request = json.loads(body)
+        except ValueError:
+            server.count(service, "errors")
+            self.send_body(400, b'{"error":"invalid json"}')
+            return
+        points = len(get_request_points(request)) if service == "/trace_attributes" else len(request.get("locations", []))
+        server.add_points(service, points)
+
+        # latenza simulata, proporzionale al numero di punti
+        latency = settings.latency_ms + settings.latency_per_point_ms * points + random.uniform(0, settings.jitter_ms)
+        time.sleep(latency / 1000)
+
+        draw = random.random()
+        if draw < settings.error_rate:
+            server.count(service, "errors")
+            self.send_body(503, b'{"error":"injected server error"}')
+            return
+        if draw < settings.error_rate + settings.client_error_rate:
+            server.count(service, "errors")
+            self.send_body(400, b'{"error_code":171,"error":"No suitable edges near location"}')
+            return
+
+        try:
+            if settings.mode == "record":
+                status, response_body = server.record(service, body)
+            elif settings.mode == "replay":
+                status, response_body = server.replay(service, body)
+            else:
+                status, response_body = server.synthetic(service, request)
+        except Exception as e:
+            logger.error(f"Stand-in error[{service}]: {e}")
+            status, response_body = 500, json.dumps({"error": str(e)}).encode("utf-8")
+        if status != 200:
+            server.count(service, "errors")
+        self.send_body(status, response_body)
+
+
+def start_stand_in_server(settings: StandInSettings = None, host: str = "0.0.0.0") -> StandInServer:
+    """Starts the stand-in server in a daemon thread; with port 0 a free port is chosen (see server_address)."""
+    server = StandInServer(settings or StandInSettings(), host)
+    thread = threading.Thread(target=server.serve_forever, name="valhalla-stand-in", daemon=True)
+    thread.start()
+    logger.info(f"Valhalla stand-in listening on port {server.server_address[1]}, mode {server.settings.mode}")
+    return server
@@ -0,0 +1,146 @@
+import os
+import math
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+
+def get_cos_lat0(lats) -> float:
+    """Scale of the longitudes of the local projection, at the mean latitude (1.0 without points)."""
+    lats = np.asarray(lats, dtype=float)
+    return math.cos(math.radians(float(lats.mean()))) if len(lats) > 0 else 1.0
+
+
+def project_lonlat(lons, lats, cos_lat0: float) -> tuple:
+    """
+    Local equirectangular projection in meters, accurate enough at the scale of a territory: used by the
+    preprocessing, the nearest-node index and the HMM matcher, so that their distances agree.
+    """
+    x = np.radians(np.asarray(lons, dtype=float)) * cos_lat0 * EARTH_RADIUS
+    y = np.radians(np.asarray(lats, dtype=float)) * EARTH_RADIUS
+    return x, y
+
+
+def unproject_xy(x, y, cos_lat0: float) -> tuple:
+    """Inverse of project_lonlat: the lon and lat arrays."""
+    return np.degrees(np.asarray(x) / (cos_lat0 * EARTH_RADIUS)), np.degrees(np.asarray(y) / EARTH_RADIUS)
+
+
+def project_points(points, lat0: float = None) -> tuple:
+    """
+    Projects the points (dicts with latitude and longitude) on a local equirectangular plane in meters,
+    centered on lat0 or on their mean latitude. Returns the x and y arrays.
+    """
+    lats = np.array([point["latitude"] for point in points], dtype=float)
+    lons = np.array([point["longitude"] for point in points], dtype=float)
+    cos_lat0 = get_cos_lat0(lats) if lat0 is None else math.cos(math.radians(lat0))
+    return project_lonlat(lons, lats, cos_lat0)
+
+
+def decimate_points(points, min_distance: float) -> list:
+    """
+    Drops the near-duplicate and stationary points: a point is kept only if it is at least min_distance
+    meters from the last kept point. The first and last points are always kept.
+    """
+    if len(points) <= 2 or min_distance <= 0:
+        return list(points)
+    x, y = project_points(points)
+    min_distance2 = min_distance * min_distance
+    kept = [0]
+    for index in range(1, len(points) - 1):
+        last = kept[-1]
+        if (x[index] - x[last]) ** 2 + (y[index] - y[last]) ** 2 >= min_distance2:
+            kept.append(index)
+    kept.append(len(points) - 1)
+    return [points[index] for index in kept]
+
+
+def simplify_points(points, tolerance: float, max_gap: float = None) -> list:
+    """
+    Douglas-Peucker simplification of the points within tolerance meters. With max_gap the segments
+    longer than max_gap meters are split anyway, since the matching needs points close enough to
+    follow the road network.
+    """
+    if len(points) <= 2 or tolerance <= 0:
+        return list(points)
+    x, y = project_points(points)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        length = math.hypot(dx, dy)
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        if length > 0:
+            distances = np.abs(px * dy - py * dx) / length
+        else:
+            distances = np.hypot(px, py)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+        elif max_gap is not None and length > max_gap:
+            split = (first + last) // 2
+        else:
+            continue
+        keep[split] = True
+        stack.append((first, split))
+        stack.append((split, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def split_windows(size: int, window_size: int, overlap: int) -> list:
+    """
+    Splits size points into windows [start, end) of at most window_size points, each one overlapping
+    the previous one by overlap points.
+    """
+    if window_size <= 0 or size <= window_size:
+        return [(0, size)]
+    overlap = max(0, min(overlap, window_size // 2))
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_size, size)
+        windows.append((start, end))
+        if end >= size:
+            break
+        start = end - overlap
+    return windows
+
+
+class TracePreprocessor:
+    """
+    Pre-matching stage of the traces: decimation of the near-duplicate/stationary points, simplification
+    within a distance tolerance and split of the long traces into overlapping windows.
+    """
+
+    def __init__(self):
+        # distanza minima (metri) dall'ultimo punto tenuto, 0 per disabilitare
+        self.min_distance = float(os.getenv("VALHALLA_MIN_POINT_DISTANCE", "0"))
+        # tolleranza (metri) della semplificazione Douglas-Peucker, 0 per disabilitare
+        self.simplify_tolerance = float(os.getenv("VALHALLA_SIMPLIFY_TOLERANCE", "0"))
+        # distanza massima (metri) tra punti consecutivi dopo la semplificazione
+        self.max_point_gap = float(os.getenv("VALHALLA_MAX_POINT_GAP", "200"))
+        # punti per finestra, 0 per non dividere le tracce, e punti di sovrapposizione tra finestre
+        self.window_size = int(os.getenv("VALHALLA_WINDOW_SIZE", "0"))
+        self.window_overlap = int(os.getenv("VALHALLA_WINDOW_OVERLAP", "50"))
+
+
+    def get_settings(self) -> dict:
+        """Settings that change the matching result, part of the match cache key."""
+        return {"min_distance": self.min_distance, "simplify_tolerance": self.simplify_tolerance,
+                "max_point_gap": self.max_point_gap, "window_size": self.window_size, "window_overlap": self.window_overlap}
+
+
+    def prepare(self, points) -> list:
+        """Decimates and simplifies the points, sorted by time."""
+        points = decimate_points(points, self.min_distance)
+        return simplify_points(points, self.simplify_tolerance, self.max_point_gap)
+
+
+    def split(self, size: int) -> list:
+        return split_windows(size, self.window_size, self.window_overlap)
@@ -1,14 +1,27 @@
 import os
 import json
+import math
+import time
+import threading
+import numpy as np
 import logging
 from datetime import datetime
 from datetime import timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from jinja2 import Template
+from valhalla.match_cache import MatchCache
+from valhalla.trace_preprocess import TracePreprocessor
 import traceback
 
 logger = logging.getLogger(__name__)
 
+
+class ValhallaError(Exception):
+    """Valhalla server error (5xx) after the retries of the session."""
+
+
 class EndgeInfo:    
     """
     EdgeInfo class to handle edge information.
@@ -55,18 +68,65 @@ class TraceInfo:
             'timestamp': self.timestamp
         } 
 
+# colonne di TraceRoute, nell'ordine degli argomenti di TraceInfo
+TRACE_COLUMNS = ['edge_index', 'distance_from_trace_point', 'distance_along_edge', 'lon', 'lat', 'way_id', 'travel_mode', 'timestamp']
+TRACE_DTYPES = {'edge_index': np.int32, 'distance_from_trace_point': np.float64, 'distance_along_edge': np.float64, 
+                'lon': np.float64, 'lat': np.float64, 'way_id': np.int64, 'travel_mode': object, 'timestamp': np.int64}
+
+# attributi di /trace_attributes usati da match_window, gli altri non vengono restituiti da Valhalla
+TRACE_ATTRIBUTES = ['shape', 'edge.way_id', 'edge.travel_mode', 'matched.point', 'matched.type', 'matched.edge_index',
+                    'matched.distance_from_trace_point', 'matched.distance_along_edge']
+
+
+def get_trace_columns(values: dict = None) -> dict:
+    """Column arrays of a TraceRoute from lists (or arrays) of values, empty columns for the missing ones."""
+    values = values or {}
+    return {column: np.asarray(values.get(column, []), dtype=TRACE_DTYPES[column]) for column in TRACE_COLUMNS}
+
+
 class TraceRoute:
-    def __init__(self, track_id:str, shape:str=None, trace_infos:list[TraceInfo]=[]):
+    """
+    Matched points of a track, held as column arrays (see TRACE_COLUMNS). trace_infos is built on demand
+    for the code that works on TraceInfo objects. from_cache is set when the route was read from MatchCache.
+    """
+
+    def __init__(self, track_id:str, shape:str=None, trace_infos:list[TraceInfo]=None, columns:dict=None):
         self.track_id = track_id
         self.shape = shape
-        self.trace_infos = trace_infos
+        self.from_cache = False
+        if columns is None:
+            columns = {column: [getattr(info, column) for info in trace_infos or []] for column in TRACE_COLUMNS}
+        self.columns = get_trace_columns(columns)
 
     def __repr__(self):
         return f"TraceRoute(track_id={self.track_id})"
-    
+
+    def __len__(self):
+        return len(self.columns['lon'])
+
+    def __getattr__(self, name):
+        # colonne come attributi: trace_route.lon, trace_route.way_id, ...
+        if name in TRACE_COLUMNS and 'columns' in self.__dict__:
+            return self.__dict__['columns'][name]
+        raise AttributeError(name)
+
+    @property
+    def trace_infos(self) -> list[TraceInfo]:
+        return [TraceInfo(*values) for values in zip(*(self.columns[column].tolist() for column in TRACE_COLUMNS))]
+
     def to_dict(self):
         return {'track_id': self.track_id, 'shape': self.shape, 'trace_infos': [info.to_dict() for info in self.trace_infos]}    
 
+    def to_cache_value(self) -> dict:
+        """Compact form used by MatchCache: the columns as lists, without the track id."""
+        return {'shape': self.shape, 'columns': {column: self.columns[column].tolist() for column in TRACE_COLUMNS}}
+
+    @staticmethod
+    def from_cache_value(track_id:str, value:dict):
+        trace_route = TraceRoute(track_id=track_id, shape=value['shape'], columns=value['columns'])
+        trace_route.from_cache = True
+        return trace_route
+
 def get_transit_mode(track):
     """
     Get the transit mode from the track.
@@ -109,6 +169,140 @@ def convert_tracked_instance_to_points(track):
     return points
 
 
+def encode_polyline(points, precision: int = 6) -> str:
+    """
+    Encodes the points (dicts with latitude and longitude) with the Google polyline algorithm,
+    at the precision used by Valhalla (6 decimals).
+    """
+    factor = 10 ** precision
+    encoded = []
+    prev_lat = 0
+    prev_lon = 0
+    for point in points:
+        lat = int(round(point["latitude"] * factor))
+        lon = int(round(point["longitude"] * factor))
+        for value in (lat - prev_lat, lon - prev_lon):
+            value = ~(value << 1) if value < 0 else (value << 1)
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        prev_lat = lat
+        prev_lon = lon
+    return "".join(encoded)
+
+
+def decode_polyline(encoded: str, precision: int = 6) -> list:
+    """Decodes a Valhalla encoded polyline into a list of (lat, lon)."""
+    factor = 10 ** precision
+    coordinates = []
+    index = 0
+    lat = 0
+    lon = 0
+    while index < len(encoded):
+        values = []
+        for _ in range(2):
+            shift = 0
+            result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += values[0]
+        lon += values[1]
+        coordinates.append((lat / factor, lon / factor))
+    return coordinates
+
+
+def get_nearest_vertex(coordinates: list, point: dict) -> int:
+    """Index of the vertex of the shape nearest to the point."""
+    scale = math.cos(math.radians(point["latitude"])) ** 2
+    distances = [(lat - point["latitude"]) ** 2 + scale * (lon - point["longitude"]) ** 2 for lat, lon in coordinates]
+    return distances.index(min(distances))
+
+
+def stitch_windows(track_id: str, points: list, windows: list, results: list) -> TraceRoute:
+    """
+    Stitches the routes matched on overlapping windows of the points into a single TraceRoute: each window
+    contributes the matched points up to the middle of the overlap with the next one, the shapes are cut
+    at the vertex nearest to that point and the edge indexes renumbered along the stitched route
+    (an edge crossing the stitch point keeps a single index).
+    """
+    boundaries = [0] + [start + (windows[k - 1][1] - start) // 2 for k, (start, end) in enumerate(windows) if k > 0] + [len(points)]
+    parts = {column: [] for column in TRACE_COLUMNS}
+    edge_offset = 0
+    last_way_id = None
+    coordinates = []
+    for k, ((start, end), (shape, indexes, columns)) in enumerate(zip(windows, results)):
+        lo = boundaries[k]
+        hi = boundaries[k + 1]
+        mask = (start + indexes >= lo) & (start + indexes < hi)
+        for column in TRACE_COLUMNS:
+            parts[column].append(columns[column][mask])
+        # indici degli archi della finestra rinumerati dopo quelli delle finestre precedenti
+        edge_indexes, inverse = np.unique(parts['edge_index'][-1], return_inverse=True)
+        way_ids = parts['way_id'][-1]
+        # la stessa way ai due lati del punto di giunzione è un unico attraversamento dell'arco
+        shift = 1 if len(way_ids) > 0 and last_way_id is not None and way_ids[0] == last_way_id else 0
+        parts['edge_index'][-1] = (inverse.reshape(-1) + edge_offset - shift).astype(np.int32)
+        edge_offset += len(edge_indexes) - shift
+        if len(way_ids) > 0:
+            last_way_id = way_ids[-1]
+        if shape:
+            window_coordinates = decode_polyline(shape)
+            first = get_nearest_vertex(window_coordinates, points[lo]) if k > 0 else 0
+            last = get_nearest_vertex(window_coordinates, points[hi - 1]) if k < len(windows) - 1 else len(window_coordinates) - 1
+            if first <= last:
+                part = window_coordinates[first:last + 1]
+                if len(coordinates) > 0 and len(part) > 0 and coordinates[-1] == part[0]:
+                    part = part[1:]
+                coordinates.extend(part)
+    shape = encode_polyline([{"latitude": lat, "longitude": lon} for lat, lon in coordinates]) if coordinates else None
+    return TraceRoute(track_id=track_id, shape=shape, columns={column: np.concatenate(parts[column]) for column in TRACE_COLUMNS})
+
+
+def get_location_type(index: int, size: int) -> str:
+    return "break" if index == 0 or index == size - 1 else "via"
+
+
+def build_locate_request(points, costing: str) -> dict:
+    """Body of a /locate request, the same produced by data/valhalla_locate_template.txt."""
+    return {
+        "verbose": True,
+        "locations": [{"lat": point["latitude"], "lon": point["longitude"], "type": get_location_type(index, len(points))}
+                      for index, point in enumerate(points)],
+        "costing": costing,
+        "shape_match": "map_snap",
+        "trace_options": {"search_radius": 15},
+    }
+
+
+def build_trace_attributes_request(points, costing: str, encoded: bool = False) -> dict:
+    """
+    Body of a /trace_attributes request, the same produced by data/valhalla_trace_attributes_template.txt.
+    With encoded the shape is sent as an encoded polyline, with begin_time and the durations between the points.
+    """
+    request = {}
+    if encoded:
+        request["encoded_polyline"] = encode_polyline(points)
+        if len(points) > 0:
+            request["begin_time"] = points[0]["time"]
+            request["durations"] = [points[i]["time"] - points[i - 1]["time"] for i in range(1, len(points))]
+    else:
+        request["shape"] = [{"lat": point["latitude"], "lon": point["longitude"], "time": point["time"],
+                             "type": get_location_type(index, len(points))} for index, point in enumerate(points)]
+    request["costing"] = costing
+    request["shape_match"] = "walk_or_snap"
+    request["use_timestamps"] = True
+    request["trace_options"] = {"search_radius": 15}
+    request["filters"] = {"attributes": TRACE_ATTRIBUTES, "action": "include"}
+    return request
+
+
 class ValhallaEngine:
     """
     ValhallaEngine class to handle Valhalla engine operations.
@@ -125,7 +319,88 @@ class ValhallaEngine:
         self.template_trace_attribuutes = Template(template_content)
         
         self.valhalla_uri = os.getenv("VALHALLA_URI", "http://localhost:8002/locate").rstrip("/")
-        
+        # connessioni keep-alive: dimensione del pool (almeno una per richiesta concorrente di MatchingExecutor), 
+        # timeout (connessione, lettura) e retry con backoff
+        self.pool_size = max(int(os.getenv("VALHALLA_POOL_SIZE", "10")), int(os.getenv("VALHALLA_MAX_CONCURRENCY", "8")))
+        self.timeout = (float(os.getenv("VALHALLA_CONNECT_TIMEOUT", "5")), float(os.getenv("VALHALLA_READ_TIMEOUT", "60")))
+        self.retries = int(os.getenv("VALHALLA_RETRIES", "3"))
+        self.backoff_factor = float(os.getenv("VALHALLA_BACKOFF_FACTOR", "0.5"))
+        self.session = self.create_session()
+        # costruzione delle richieste: "shape" (strutture native), "polyline" (shape codificata) o "template" (Jinja2)
+        self.request_mode = os.getenv("VALHALLA_REQUEST_MODE", "shape")
+        # cache su disco dei risultati di /trace_attributes (disabilitata se VALHALLA_CACHE_PATH è vuoto)
+        cache_path = os.getenv("VALHALLA_CACHE_PATH", "")
+        self.match_cache = MatchCache(cache_path, int(os.getenv("VALHALLA_CACHE_MAX_MB", "1024")) * 1024 * 1024) if cache_path else None
+        # distingue i risultati di tileset o versioni di Valhalla diverse
+        self.cache_namespace = os.getenv("VALHALLA_CACHE_NAMESPACE", "")
+        # numero massimo di location per richiesta /locate (vedi service_limits.<costing>.max_locations di Valhalla)
+        self.locate_batch_size = int(os.getenv("VALHALLA_LOCATE_BATCH_SIZE", "20"))
+        # decimazione, semplificazione e divisione in finestre delle tracce prima del matching
+        self.trace_preprocessor = TracePreprocessor()
+        # tempo delle richieste HTTP del thread corrente (vedi start_request_timer)
+        self.local = threading.local()
+
+
+    def create_session(self) -> requests.Session:
+        """
+        Creates the HTTP session shared by all the requests of the engine. The Valhalla services
+        used here are read-only, so POST requests are retried on connection errors and 5xx responses.
+        """
+        retry = Retry(total=self.retries, connect=self.retries, read=self.retries, status=self.retries,
+                      backoff_factor=self.backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        self.session.close()
+
+
+    def post(self, service: str, data: dict) -> requests.Response:
+        # JSON compatto, senza gli spazi aggiunti dal parametro json di requests
+        body = json.dumps(data, separators=(",", ":"))
+        start = time.monotonic()
+        try:
+            return self.session.post(self.valhalla_uri + service, data=body, headers={"Content-Type": "application/json"}, 
+                                     timeout=self.timeout)
+        finally:
+            self.local.request_time = self.get_request_time() + time.monotonic() - start
+
+
+    def start_request_timer(self):
+        """Resets the time spent in the HTTP requests of the current thread."""
+        self.local.request_time = 0.0
+
+
+    def get_request_time(self) -> float:
+        """Seconds spent in the HTTP round trips of the current thread since start_request_timer."""
+        return getattr(self.local, "request_time", 0.0)
+
+
+    def get_locate_request(self, track, points, costing:str=None) -> dict:
+        costing = costing or get_transit_mode(track)
+        if self.request_mode == "template":
+            return json.loads(self.template_locate.render(costing=costing, points=points))
+        return build_locate_request(points, costing)
+
+
+    def get_trace_attributes_request(self, track, points) -> dict:
+        if self.request_mode == "template":
+            return json.loads(self.template_trace_attribuutes.render(costing=get_transit_mode(track), points=points))
+        return build_trace_attributes_request(points, get_transit_mode(track), self.request_mode == "polyline")
+
 
     def find_nearest_edges_by_osm_way(self, track, way_id, lon, lat) -> EndgeInfo:
         """
@@ -137,11 +412,9 @@ class ValhallaEngine:
                 "longitude": lon,
                 "latitude": lat
             }   
-            rendered = self.template_locate.render(costing=get_transit_mode(track), points=[point_new])
-            # Convertilo in oggetto Python se serve
-            data_points = json.loads(rendered)
+            data_points = self.get_locate_request(track, [point_new])
             # Invio della richiesta POST con il body in JSON
-            response = requests.post(self.valhalla_uri + "/locate", json=data_points)
+            response = self.post("/locate", data_points)
             if response.status_code == 200:
                 # Parsare la risposta JSON in un dizionario Python
                 data_locate = response.json()
@@ -164,6 +437,33 @@ class ValhallaEngine:
         return None
     
 
+    def find_way_shapes_by_locate(self, costing:str, ways:list) -> dict:
+        """
+        Resolves the shapes of many ways with a single /locate request: ways is a list of (way_id, lon, lat)
+        with a point of each way. Returns way_id -> shape for the ways found among the edges of their point.
+        Errors are logged and the ways of the request are left unresolved.
+        """
+        way_shapes = {}
+        if len(ways) == 0:
+            return way_shapes
+        try:
+            points = [{"longitude": lon, "latitude": lat} for way_id, lon, lat in ways]
+            response = self.post("/locate", self.get_locate_request(None, points, costing))
+            if response.status_code == 200:
+                # una location nella risposta per ogni punto, nello stesso ordine
+                for (way_id, lon, lat), location in zip(ways, response.json()):
+                    for edge in location.get("edges") or []:
+                        edge_info = edge.get("edge_info")
+                        if edge_info is not None and edge_info["way_id"] == way_id:
+                            way_shapes[way_id] = edge_info["shape"]
+                            break
+            else:
+                logger.error(f"Errore: {response.status_code} - {response.text}")
+        except Exception as e:
+            logger.error(f"Exception[{costing}, {len(ways)} ways]: {e}")
+        return way_shapes
+
+
     def find_nearest_edges_by_locate(self, track, track_id) -> list[EndgeInfo]:
         """
         Find the nearest edges in the graph for the given points.
@@ -174,12 +474,9 @@ class ValhallaEngine:
             points = convert_tracked_instance_to_points(track)
             logger.info(f"Track ID: {track_id}, Points: {len(points)}")
             if len(points) > 0:
-                # Sostituisci i valori
-                rendered = self.template_locate.render(costing=get_transit_mode(track), points=points)
-                # Convertilo in oggetto Python se serve
-                data_points = json.loads(rendered)
+                data_points = self.get_locate_request(track, points)
                 # Invio della richiesta POST con il body in JSON
-                response = requests.post(self.valhalla_uri + "/locate", json=data_points)
+                response = self.post("/locate", data_points)
                 if response.status_code == 200:
                     # Parsare la risposta JSON in un dizionario Python
                     data_locate = response.json()
@@ -205,50 +502,91 @@ class ValhallaEngine:
         """
         Find the nearest edges in the graph for the given points.
         """
-        trace_route = TraceRoute(track_id=track_id)
         try:
-            #start = datetime.now()
-            points = convert_tracked_instance_to_points(track)
-            sorted_points = sorted(points, key=lambda x: x["time"])
-            logger.info(f"Track ID: {track_id}, Points: {len(points)}")
-            if len(points) > 0:
-                # Sostituisci i valori
-                rendered = self.template_trace_attribuutes.render(costing=get_transit_mode(track), points=sorted_points)
-                # Convertilo in oggetto Python se serve
-                data_points = json.loads(rendered)
-                # Invio della richiesta POST con il body in JSON
-                response = requests.post(self.valhalla_uri + "/trace_attributes", json=data_points)
-                if response.status_code == 200:
-                    # Parsare la risposta JSON in un dizionario Python
-                    data_trace = response.json()
-                    trace_route.shape = data_trace["shape"]
-                    trace_infos = []
-                    data_edges = data_trace["edges"]
-                    for index, matched_point in enumerate(data_trace["matched_points"]):
-                        if matched_point["type"] == "matched":
-                            edge_index = matched_point["edge_index"]
-                            if edge_index >= len(data_edges):
-                                continue
-                            trace_info = TraceInfo(
-                                edge_index=edge_index,
-                                distance_from_trace_point=matched_point["distance_from_trace_point"],
-                                distance_along_edge=matched_point["distance_along_edge"],
-                                lon=matched_point["lon"],
-                                lat=matched_point["lat"],
-                                way_id=data_edges[edge_index]["way_id"],
-                                travel_mode=data_edges[edge_index]["travel_mode"],
-                                timestamp=sorted_points[index]['time']
-                            )
-                            #TODO some logic about travel_mode or distances 
-                            trace_infos.append(trace_info)
-                    trace_route.trace_infos = trace_infos
-                else:
-                    logger.error(f"Errore[{track_id}]: {response.status_code} - {response.text}")
-            #stop = datetime.now()
-            #logger.info(f"Track ID: {track_id}, Edges: {len(trace_route.trace_infos)}, Time:{(stop - start).total_seconds()} seconds")
-            return trace_route
+            return self.match_trace(track, track_id)
         except Exception as e:
             traceback.print_exc()
             logger.error(f"Exception[{track_id}]: {e}")
             
         return TraceRoute(track_id=track_id)
+
+
+    def match_trace(self, track, track_id) -> TraceRoute:
+        """
+        Same as find_nearest_edges_by_trace, but Valhalla errors are raised instead of returning an empty route.
+        The points are decimated and simplified (see TracePreprocessor), the long traces are matched on
+        overlapping windows one after the other and stitched back into a single route: the concurrency
+        of the requests is bounded by the caller (see MatchingExecutor).
+        """
+        trace_route = TraceRoute(track_id=track_id)
+        #start = datetime.now()
+        points = convert_tracked_instance_to_points(track)
+        sorted_points = sorted(points, key=lambda x: x["time"])
+        logger.info(f"Track ID: {track_id}, Points: {len(points)}")
+        if len(points) > 0:
+            cache_key = None
+            if self.match_cache is not None:
+                # la chiave non dipende dal formato della richiesta (template, shape o polyline)
+                cache_key = self.match_cache.get_key({"namespace": self.cache_namespace, 
+                                                      "preprocess": self.trace_preprocessor.get_settings(),
+                                                      "request": build_trace_attributes_request(sorted_points, get_transit_mode(track))})
+                cached_value = self.match_cache.get(cache_key)
+                if cached_value is not None:
+                    return TraceRoute.from_cache_value(track_id, cached_value)
+            prepared_points = self.trace_preprocessor.prepare(sorted_points)
+            windows = self.trace_preprocessor.split(len(prepared_points))
+            if len(windows) == 1:
+                shape, indexes, columns = self.match_window(track, track_id, prepared_points)
+                trace_route = TraceRoute(track_id=track_id, shape=shape, columns=columns)
+            else:
+                logger.info(f"Track ID: {track_id}, Prepared Points: {len(prepared_points)}, Windows: {len(windows)}")
+                results = [self.match_window(track, track_id, prepared_points[start:end]) for start, end in windows]
+                trace_route = stitch_windows(track_id, prepared_points, windows, results)
+            if cache_key is not None:
+                self.match_cache.put(cache_key, trace_route.to_cache_value())
+        #stop = datetime.now()
+        #logger.info(f"Track ID: {track_id}, Edges: {len(trace_route.trace_infos)}, Time:{(stop - start).total_seconds()} seconds")
+        return trace_route
+
+
+    def match_window(self, track, track_id, points) -> tuple:
+        """
+        Matches the points (sorted by time) with a single /trace_attributes request.
+        Returns the shape, the indexes of the matched points and the columns of the matched points (see TRACE_COLUMNS).
+        """
+        shape = None
+        indexes = np.zeros(0, dtype=np.int64)
+        columns = get_trace_columns()
+        data_points = self.get_trace_attributes_request(track, points)
+        # Invio della richiesta POST con il body in JSON
+        response = self.post("/trace_attributes", data_points)
+        if response.status_code == 200:
+            # Parsare la risposta JSON in un dizionario Python
+            data_trace = response.json()
+            shape = data_trace["shape"]
+            data_edges = data_trace["edges"]
+            matched_points = data_trace["matched_points"]
+            indexes = np.array([index for index, matched_point in enumerate(matched_points) 
+                                if matched_point["type"] == "matched" and matched_point["edge_index"] < len(data_edges)], dtype=np.int64)
+            matched = [matched_points[index] for index in indexes.tolist()]
+            edge_index = np.array([matched_point["edge_index"] for matched_point in matched], dtype=np.int32)
+            edge_way_ids = np.array([edge["way_id"] for edge in data_edges], dtype=np.int64)
+            edge_travel_modes = np.array([edge.get("travel_mode") for edge in data_edges], dtype=object)
+            times = np.array([point["time"] for point in points], dtype=np.int64)
+            #TODO some logic about travel_mode or distances 
+            columns = get_trace_columns({
+                'edge_index': edge_index,
+                'distance_from_trace_point': [matched_point["distance_from_trace_point"] for matched_point in matched],
+                'distance_along_edge': [matched_point["distance_along_edge"] for matched_point in matched],
+                'lon': [matched_point["lon"] for matched_point in matched],
+                'lat': [matched_point["lat"] for matched_point in matched],
+                'way_id': edge_way_ids[edge_index],
+                'travel_mode': edge_travel_modes[edge_index],
+                'timestamp': times[indexes]
+            })
+        elif response.status_code >= 500:
+            raise ValhallaError(f"{response.status_code} - {response.text}")
+        else:
+            # errori 4xx: traccia non associabile alla rete, non è un problema del server
+            logger.error(f"Errore[{track_id}]: {response.status_code} - {response.text}")
+        return shape, indexes, columns